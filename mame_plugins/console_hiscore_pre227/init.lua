@@ -35,6 +35,9 @@ function hiscore.startplugin()
 	local found_hiscore_entry = false;
 	local timed_save = true;
 	local delaytime = 0;
+	local check_interval = 30;  -- frames between two checks for new hiscores
+	local frames_since_check = 0;
+	local has_read_range = nil;  -- nil until the memory API was probed
 
 	local positions = {};
 	-- Configuration file will be searched in the first path defined
@@ -54,6 +57,7 @@ function hiscore.startplugin()
 		end
 		hiscore_path = lfs.env_replace(_conf["hi_path"] or hiscore_path);
 		timed_save = _conf["only_save_at_exit"] ~= "1"
+		check_interval = tonumber(_conf["check_interval"] or "") or check_interval
 		-- hiscoredata_path = _conf["dat_path"]; -- don't know if I should do it, but wathever
 		return true
 	  end
@@ -96,9 +100,65 @@ function hiscore.startplugin()
 	end
 
 
+	local function index_hash ( key )
+	  local h = 0;
+	  for i = 1, #key do
+		h = (h * 31 + key:byte(i)) & 0xffffffff;
+	  end
+	  return h;
+	end
+
+
+	-- seek straight to the entry using the index built with "hiscore_dat.py build-index"
+	-- returns nil if the index is missing or does not match the dat (size and mtime), or if no key was found
+	local function read_hiscore_index ( index_name, datfile, dat_path, keys )
+	  local index = io.open( hiscore_plugin_path .. "/" .. index_name, "rb" );
+	  if index == nil then
+		return nil
+	  end
+	  local dat_size, dat_mtime, bucket_count = string.match(index:read("*l") or "", '^;console_hiscore.idx v2 (%d+) (%d+) (%d+)$');
+	  if not dat_size or tonumber(dat_size) ~= datfile:seek("end") or tonumber(dat_mtime) ~= math.floor(lfs.attributes(dat_path, "modification") or -1) then
+		emu.print_verbose( "console_hiscore: stale index, rebuild " .. index_name );
+		index:close();
+		return nil
+	  end
+	  local table_offset = index:seek();
+	  local cluster = nil;
+	  for _, key in ipairs(keys) do
+		index:seek("set", table_offset + (index_hash(key) % tonumber(bucket_count)) * 9);
+		local bucket_offset = tonumber(index:read(8), 16);
+		if bucket_offset ~= 0xffffffff then
+		  index:seek("set", bucket_offset);
+		  repeat
+			local line = index:read("*l");
+			if line == nil or line == "" then break end
+			local line_key, offs, len = string.match(line, '^(.*)\t(%d+)\t(%d+)$');
+			if line_key == key then
+			  datfile:seek("set", tonumber(offs));
+			  cluster = "";
+			  for row in string.gmatch(datfile:read(tonumber(len)), '([^\n]+)') do
+				row = row:gsub( '[ \t\r\n]*;.+$', '' ):gsub( '%s+$', '' );
+				if string.find(row, '^@') then
+				  cluster = cluster .. "\n" .. row;
+				end
+			  end
+			end
+		  until cluster
+		end
+		if cluster then break end
+	  end
+	  index:close();
+	  if cluster == "" then
+		cluster = nil;  -- no rows at the indexed offset, let the caller scan the dat
+	  end
+	  return cluster;
+	end
+
+
 	local function read_hiscore_dat (hiscoredata_path)
 	  -- emu.print_verbose( "hiscore_plugin_path: " .. hiscore_plugin_path );
-	  local file = io.open( hiscore_plugin_path .. "/" .. hiscoredata_path, "r" );
+	  -- binary mode: the index holds byte offsets (text mode breaks them with CRLF files on Windows)
+	  local file = io.open( hiscore_plugin_path .. "/" .. hiscoredata_path, "rb" );
 	  if file == nil then
 		-- file not found
 		emu.print_verbose( "hiscore file not found: " .. hiscoredata_path );
@@ -123,14 +183,25 @@ function hiscore.startplugin()
 	  else
 		rm_match = emu.romname() .. ':';
 	  end
+	  -- fast path: lookup the index
+	  local keys = { rm_match:sub(1, -2) };
+	  if rm_match_crc ~= 0 then
+		keys[2] = rm_match_crc:sub(1, -2);
+	  end
+	  local indexed_cluster = read_hiscore_index( (hiscoredata_path:gsub("%.dat$", "")) .. ".idx", file, hiscore_plugin_path .. "/" .. hiscoredata_path, keys );
+	  if indexed_cluster then
+		file:close();
+		return indexed_cluster;
+	  end
+	  file:seek("set", 0);
 	  local cluster = "";
 	  local current_is_match = false;
 	  if file then
 		repeat
 		  line = file:read("*l");
 		  if line then
-			-- remove comments
-			line = line:gsub( '[ \t\r\n]*;.+$', '' );
+			-- remove comments (and the CR of CRLF files, read in binary mode)
+			line = line:gsub( '[ \t\r\n]*;.+$', '' ):gsub( '\r$', '' );
 			-- handle lines
 			if string.find(line, '^@') then -- data line
 			  if current_is_match then
@@ -194,6 +265,22 @@ function hiscore.startplugin()
 	end
 
 
+	-- read a whole region as a string, in a single call when the MAME version has read_range
+	local function read_region ( row )
+	  if has_read_range == nil then
+		has_read_range = pcall(function() return row["mem"]:read_range(row["addr"], row["addr"], 8) end);
+	  end
+	  if has_read_range then
+		return row["mem"]:read_range(row["addr"], row["addr"] + row["size"] - 1, 8);
+	  end
+	  local t = {};
+	  for i=0,row["size"]-1 do
+		t[i+1] = string.char(row["mem"]:read_u8(row["addr"] + i));
+	  end
+	  return table.concat(t);
+	end
+
+
 	local function write_scores ( posdata )
 	  emu.print_verbose("console hiscore: write_scores")
 	  local output = io.open(get_file_name(), "wb");
@@ -205,11 +292,7 @@ function hiscore.startplugin()
 	  emu.print_verbose("console_hiscore: write_scores output")
 	  if output then
 		for ri,row in ipairs(posdata) do
-		  t = {};
-		  for i=0,row["size"]-1 do
-			t[i+1] = row["mem"]:read_u8(row["addr"] + i)
-		  end
-		  output:write(string.char(table.unpack(t)));
+		  output:write(read_region(row));
 		end
 		output:close();
 	  end
@@ -224,9 +307,9 @@ function hiscore.startplugin()
 	  if input then
 		for ri,row in ipairs(posdata) do
 		  local str = input:read(row["size"]);
+		  local bytes = { str:byte(1, -1) };
 		  for i=0,row["size"]-1 do
-			local b = str:sub(i+1,i+1):byte();
-			row["mem"]:write_u8( row["addr"] + i, b );
+			row["mem"]:write_u8( row["addr"] + i, bytes[i+1] );
 		  end
 		end
 		input:close();
@@ -236,14 +319,14 @@ function hiscore.startplugin()
 	end
 
 
+	-- fingerprint of the hiscore regions: their contents, compared as strings
+	-- (a sum of the bytes misses the changes keeping the same sum, e.g. swapped name letters)
 	local function check_scores ( posdata )
-	  local r = 0;
+	  local t = {};
 	  for ri,row in ipairs(posdata) do
-		for i=0,row["size"]-1 do
-			r = r + row["mem"]:read_u8( row["addr"] + i );
-		end
+		t[ri] = read_region(row);
 	  end
-	  return r;
+	  return table.concat(t);
 	end
 
 
@@ -275,6 +358,12 @@ function hiscore.startplugin()
 	  init();
 	  -- only allow save check to run when
 	  if mem_check_passed and timed_save then
+		-- no need to check on every frame
+		frames_since_check = frames_since_check + 1;
+		if frames_since_check < check_interval then
+		  return;
+		end
+		frames_since_check = 0;
 		-- The reason for this complicated mess is that
 		-- MAME does expose a hook for "exit". Once it does,
 		-- this should obviously just be done when the emulator
@@ -312,6 +401,7 @@ function hiscore.startplugin()
 		mem_check_passed = false
 		scores_have_been_read = false;
 		last_write_time = -10
+		frames_since_check = 0
 		emu.print_verbose("Starting " .. emu.gamename())
 		config_read = read_config();
 		local dat = read_hiscore_dat("console_hiscore.dat")
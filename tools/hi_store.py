@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+single-file store for .hi blobs, an alternative to the one-file-per-game layout for big libraries on slow flash.
+
+the store is an append-only list of records, indexed in memory at open time by walking the record headers via mmap.
+a record is never rewritten in place: the new one is appended, then the old one is marked dead, so an interrupted write keeps the old data.
+dead records are dropped by compact(), automatically when they waste more space than the live ones.
+the writes are serialized between processes (e.g. state2hi.py and the companion) with a lock on STORE_PATH.lock,
+the records appended by the others and their compactions are picked up before every write.
+
+usage:
+  hi_store.py import STORE_PATH HI_DIR   # import the loose hi/<system>/*.hi layout
+  hi_store.py export STORE_PATH HI_DIR   # export back to the loose layout
+  hi_store.py list STORE_PATH
+  hi_store.py compact STORE_PATH
+"""
+
+import sys
+import os
+import mmap
+import zlib
+import struct
+import logging
+import contextlib
+try:
+	import fcntl
+except ImportError:
+	fcntl = None  # Windows: no inter-process locking
+
+STORE_MAGIC = b"HISTORE1"
+RECORD_LIVE = b"HIR1"
+RECORD_DEAD = b"HIRX"
+RECORD_HEADER = struct.Struct("<4sHII")  # tag, key len, data len, data crc32
+
+# automatic compaction thresholds
+COMPACT_MIN_DEAD_BYTES = 64 * 1024
+
+
+def make_key(system, content_name):
+	return system + "," + content_name
+
+
+class HiStore(object):
+
+	"""Usage:
+	store = HiStore("hiscores.histore")
+	store.put("nes", "Super Mario Bros. (W) [!]", data)
+	data = store.get("nes", "Super Mario Bros. (W) [!]")  # None if missing
+	data = store.get_any([ "nes", "famicom" ], "Super Mario Bros. (W) [!]")
+	store.close()
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._index = {}  # key -> ( record offset, data len )
+		self._dead_bytes = 0
+		self._live_bytes = 0
+		self._end = 0  # the records are indexed up to this offset
+		self._mmap = None
+		self._file = None
+		self._lock_file = open(path + ".lock", 'a+b') if fcntl is not None else None
+		with self._locked():
+			if not os.path.isfile(path) or os.path.getsize(path) == 0:
+				with open(path, 'wb') as store_file:
+					store_file.write(STORE_MAGIC)
+			self._file = open(path, 'r+b')
+			if self._file.read(len(STORE_MAGIC)) != STORE_MAGIC:
+				self.close()
+				raise ValueError("not a hiscore store: " + path)
+			self._build_index()
+
+
+	@contextlib.contextmanager
+	def _locked(self):
+		""" exclusive lock shared with the other processes using the store, not reentrant """
+		if self._lock_file is None:
+			yield
+			return
+		fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+
+	def _remap(self):
+		if self._mmap is not None:
+			self._mmap.close()
+		self._file.flush()
+		self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+	def _build_index(self):
+		""" walk all the record headers """
+		self._index = {}
+		self._dead_bytes = 0
+		self._live_bytes = 0
+		self._remap()
+		self._scan(len(STORE_MAGIC))
+
+
+	def _scan(self, pos):
+		""" index the records from pos to the end, a truncated record at the end (interrupted write) is discarded """
+		size = len(self._mmap)
+		while pos + RECORD_HEADER.size <= size:
+			tag, key_len, data_len, data_crc = RECORD_HEADER.unpack_from(self._mmap, pos)
+			record_len = RECORD_HEADER.size + key_len + data_len
+			if tag not in (RECORD_LIVE, RECORD_DEAD) or pos + record_len > size:
+				break
+			if tag == RECORD_LIVE:
+				key = self._mmap[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + key_len].decode('utf-8')
+				if key in self._index:
+					# replaced by another process, the newest record wins
+					self._dead_bytes += RECORD_HEADER.size + len(key.encode('utf-8')) + self._index[key][1]
+					self._live_bytes -= self._index[key][1]
+				self._index[key] = ( pos, data_len )
+				self._live_bytes += data_len
+			else:
+				self._dead_bytes += record_len
+			pos += record_len
+		if pos < size:
+			logging.warning("hiscore store has a truncated record, dropped: " + self.path)
+			self._file.truncate(pos)
+			self._remap()
+		self._end = pos
+
+
+	def _refresh(self):
+		""" pick up the changes done by the other processes (called with the lock held) """
+		try:
+			replaced = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+		except OSError:
+			replaced = False
+		if replaced:
+			# compacted by another process
+			self._mmap.close()
+			self._mmap = None
+			self._file.close()
+			self._file = open(self.path, 'r+b')
+			self._build_index()
+		elif os.fstat(self._file.fileno()).st_size != self._end:
+			# records appended by another process
+			self._remap()
+			self._scan(self._end)
+
+
+	def close(self):
+		if self._mmap is not None:
+			self._mmap.close()
+			self._mmap = None
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+		if self._lock_file is not None:
+			self._lock_file.close()
+			self._lock_file = None
+
+
+	def __contains__(self, key):
+		return key in self._index
+
+
+	def keys(self):
+		""" returns a list of ( system, content_name ) """
+		return [ tuple(key.split(",", 1)) for key in self._index ]
+
+
+	def get(self, system, content_name):
+		record = self._index.get(make_key(system, content_name))
+		if record is None:
+			return None
+		pos, data_len = record
+		if pos + RECORD_HEADER.size >= len(self._mmap):
+			self._remap()
+		tag, key_len, data_len, data_crc = RECORD_HEADER.unpack_from(self._mmap, pos)
+		if tag != RECORD_LIVE:
+			# deleted by another process
+			return None
+		data_start = pos + RECORD_HEADER.size + key_len
+		data = self._mmap[data_start:data_start + data_len]
+		if zlib.crc32(data) != data_crc:
+			logging.error("hiscore store record is corrupted: " + make_key(system, content_name))
+			return None
+		return data
+
+
+	def get_any(self, candidate_systems, content_name):
+		""" returns the data stored for the 1st matching system, or None """
+		with self._locked():
+			self._refresh()
+		for system in candidate_systems:
+			data = self.get(system, content_name)
+			if data is not None:
+				return data
+		return None
+
+
+	def get_signature(self, candidate_systems, content_name):
+		""" returns [ record offset, data crc32 ] of the 1st matching system or None, it changes only when that entry is written """
+		with self._locked():
+			self._refresh()
+		for system in candidate_systems:
+			record = self._index.get(make_key(system, content_name))
+			if record is not None:
+				tag, key_len, data_len, data_crc = RECORD_HEADER.unpack_from(self._mmap, record[0])
+				return [ record[0], data_crc ]
+		return None
+
+
+	def find_system(self, candidate_systems, content_name):
+		with self._locked():
+			self._refresh()
+		for system in candidate_systems:
+			if make_key(system, content_name) in self._index:
+				return system
+		return None
+
+
+	def put(self, system, content_name, data):
+		""" add or replace an entry, returns True if it was a new entry """
+		with self._locked():
+			self._refresh()
+			return self._put(system, content_name, data)
+
+
+	def _put(self, system, content_name, data):
+		key = make_key(system, content_name)
+		key_bytes = key.encode('utf-8')
+		data = bytes(data)
+		data_crc = zlib.crc32(data)
+		record = self._index.get(key)
+		self._file.seek(0, os.SEEK_END)
+		pos = self._file.tell()
+		self._file.write(RECORD_HEADER.pack(RECORD_LIVE, len(key_bytes), len(data), data_crc) + key_bytes + data)
+		self._file.flush()
+		self._end = self._file.tell()
+		if record is not None:
+			# only once the new record is complete, if both are live after a crash the newest one wins
+			self._kill_record(key, record)
+			self._file.flush()
+		self._index[key] = ( pos, len(data) )
+		self._live_bytes += len(data)
+		self._remap()
+		if self._dead_bytes > COMPACT_MIN_DEAD_BYTES and self._dead_bytes > self._live_bytes:
+			self._compact()
+		return record is None
+
+
+	def _kill_record(self, key, record):
+		pos, data_len = record
+		self._file.seek(pos)
+		self._file.write(RECORD_DEAD)
+		self._dead_bytes += RECORD_HEADER.size + len(key.encode('utf-8')) + data_len
+		self._live_bytes -= data_len
+
+
+	def delete(self, system, content_name):
+		key = make_key(system, content_name)
+		with self._locked():
+			self._refresh()
+			record = self._index.pop(key, None)
+			if record is None:
+				return False
+			self._kill_record(key, record)
+			self._file.flush()
+		return True
+
+
+	def compact(self):
+		""" rewrite the store with the live records only """
+		with self._locked():
+			self._refresh()
+			self._compact()
+
+
+	def _compact(self):
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, 'wb') as tmp_file:
+			tmp_file.write(STORE_MAGIC)
+			new_index = {}
+			for key in sorted(self._index):
+				system, content_name = key.split(",", 1)
+				data = self.get(system, content_name)
+				if data is None:
+					continue
+				key_bytes = key.encode('utf-8')
+				new_index[key] = ( tmp_file.tell(), len(data) )
+				tmp_file.write(RECORD_HEADER.pack(RECORD_LIVE, len(key_bytes), len(data), zlib.crc32(data)) + key_bytes + data)
+			end = tmp_file.tell()
+		self._mmap.close()
+		self._mmap = None
+		self._file.close()
+		os.replace(tmp_path, self.path)
+		self._file = open(self.path, 'r+b')
+		self._index = new_index
+		self._dead_bytes = 0
+		self._live_bytes = sum(data_len for pos, data_len in new_index.values())
+		self._end = end
+		self._remap()
+		logging.debug("hiscore store compacted: " + self.path)
+
+
+	def import_dir(self, hi_dir):
+		""" import a hi/<system>/*.hi tree, returns the number of imported files """
+		imported = 0
+		for system in sorted(os.listdir(hi_dir)):
+			system_dir = os.path.join(hi_dir, system)
+			if not os.path.isdir(system_dir):
+				continue
+			for filename in sorted(os.listdir(system_dir)):
+				if not filename.endswith(".hi"):
+					continue
+				with open(os.path.join(system_dir, filename), 'rb') as hi_file:
+					self.put(system, filename[:-len(".hi")], hi_file.read())
+				imported += 1
+		return imported
+
+
+	def export_dir(self, hi_dir):
+		""" export the store as a hi/<system>/*.hi tree, returns the number of exported files """
+		exported = 0
+		for system, content_name in self.keys():
+			data = self.get(system, content_name)
+			if data is None:
+				continue
+			system_dir = os.path.join(hi_dir, system)
+			if not os.path.isdir(system_dir):
+				os.makedirs(system_dir)
+			with open(os.path.join(system_dir, content_name + ".hi"), 'wb') as hi_file:
+				hi_file.write(data)
+			exported += 1
+		return exported
+# end of HiStore
+
+
+if __name__ == '__main__':
+	logging.getLogger().setLevel(logging.INFO)
+	if len(sys.argv) < 3 or sys.argv[1] not in [ "import", "export", "list", "compact" ]:
+		print("usage: hi_store.py import|export STORE_PATH HI_DIR")
+		print("       hi_store.py list|compact STORE_PATH")
+		sys.exit(1)
+	command = sys.argv[1]
+	store = HiStore(sys.argv[2])
+	if command == "import":
+		logging.info("imported " + str(store.import_dir(sys.argv[3])) + " files")
+	elif command == "export":
+		logging.info("exported " + str(store.export_dir(sys.argv[3])) + " files")
+	elif command == "list":
+		for system, content_name in sorted(store.keys()):
+			print(system + "," + content_name + " (" + str(len(store.get(system, content_name) or b"")) + " bytes)")
+	elif command == "compact":
+		store.compact()
+	store.close()
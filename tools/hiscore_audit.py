@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+integrity audit of hiscore directories against the dat, to catch the .hi files that would be injected as garbage.
+
+the dat is indexed once, then the directories (savefile_directory or the hi/<system>/ layout) are walked with a thread pool.
+checks for each .hi file:
+  - the length against the summed region lengths of its entry (truncated writes, dat edits, the old offset-0 multi-region bug)
+  - the sentinel bytes (start_byte/end_byte) at the region boundaries, only reported with --verbose:
+    they are the bytes of the default table, so they often differ once the scores were saved
+  - all-zero images and images holding only the prefill value (never written by the game),
+    unless the sentinels of every region are that value too (e.g. a default table of zeros)
+
+usage:
+  hiscore_audit.py [--verbose] [--quarantine DIR] [--repair] [HI_DIR ...]   # default: HISCORE_PATH
+  --quarantine DIR   move the files with errors in DIR (same relative paths)
+  --repair           truncate the files longer than expected, when the extra bytes are zero padding or the sentinels of the
+                     truncated image match. the original is kept in the quarantine dir (or as .bak), the other errors can not be repaired
+exit status is 1 if any error was left, or if no dat entries were loaded.
+"""
+
+import sys
+import os
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from hiscore_dat import get_default_dat, build_file_lookup, walk_hiscore_files
+from state2hi import parse_hiscore_row
+
+AUDIT_WORKERS = 16
+
+
+class EntryLayout(object):
+
+	""" the regions of a dat entry, compiled once for all the files of the same game """
+
+	def __init__(self, entry):
+		self.regions = []  # list of ( offset in the image, length, start_byte, end_byte )
+		self.prefill = None
+		offset = 0
+		for row in entry.rows:
+			if row.startswith("@delay="):
+				continue
+			cputag, addresspace, address, length, start_byte, end_byte, prefill = parse_hiscore_row(row)
+			self.regions.append(( offset, length, start_byte, end_byte ))
+			if prefill is not None:
+				self.prefill = prefill
+			offset += length
+		self.length = offset
+
+	def sentinel_mismatches(self, image):
+		""" returns the list of the region indexes whose sentinel bytes do not match """
+		return [ region_index for region_index, ( offset, length, start_byte, end_byte ) in enumerate(self.regions)
+			if image[offset] != start_byte or image[offset + length - 1] != end_byte ]
+
+	def sentinels_are(self, value):
+		""" True if all the sentinel bytes are value, so an image filled with it can be the default table """
+		return all(start_byte == value and end_byte == value for offset, length, start_byte, end_byte in self.regions)
+
+
+def check_image(layout, image):
+	""" returns a list of ( level, message ) """
+	problems = []
+	if len(image) != layout.length:
+		message = "size mismatch: %d bytes, %d expected" % (len(image), layout.length)
+		if len(layout.regions) > 1 and len(image) in [ length for offset, length, start_byte, end_byte in layout.regions ]:
+			message += " (only one region, looks like the offset-0 multi-region bug)"
+		elif len(image) < layout.length:
+			message += " (truncated)"
+		problems.append(( "error", message ))
+		return problems
+	if image and image.count(image[0]) == len(image) and image[0] in [ 0, layout.prefill ]:
+		message = "all-zero image" if image[0] == 0 else "image holds only the prefill value %02x" % layout.prefill
+		if layout.sentinels_are(image[0]):
+			# the sentinels allow it, e.g. a default table of zeros (nes,smb: 7d7,6,0,0,ff)
+			problems.append(( "info", message + ", same as the sentinels" ))
+		else:
+			problems.append(( "error", message ))
+		return problems
+	mismatches = layout.sentinel_mismatches(image)
+	if mismatches:
+		problems.append(( "info", "sentinel bytes differ from the default table in region(s) " + ", ".join(str(region_index) for region_index in mismatches) ))
+	return problems
+
+
+def repair_image(layout, image):
+	""" returns the repaired image, or None when it can not be repaired """
+	if len(image) > layout.length:
+		truncated = image[0:layout.length]
+		if any(truncated) and (not any(image[layout.length:]) or not layout.sentinel_mismatches(truncated)):
+			return truncated
+	return None
+
+
+def move_to(path, hi_dir, quarantine_dir):
+	""" move a file in the quarantine dir keeping its path relative to hi_dir, returns the new path """
+	out_path = os.path.join(quarantine_dir, os.path.basename(os.path.normpath(hi_dir)), os.path.relpath(path, hi_dir))
+	os.makedirs(os.path.dirname(out_path), exist_ok=True)
+	shutil.move(path, out_path)
+	return out_path
+
+
+def audit_file(hi_dir, path, layout, quarantine_dir=None, repair=False):
+	""" runs in the worker threads, returns a tuple: path, list of ( level, message ), action taken (str or None) """
+	try:
+		with open(path, 'rb') as hiscore_file:
+			image = hiscore_file.read()
+	except OSError as e:
+		return path, [ ( "error", "unable to read: " + str(e) ) ], None
+	problems = check_image(layout, image)
+	if not any(level == "error" for level, message in problems):
+		return path, problems, None
+
+	action = None
+	if repair:
+		repaired = repair_image(layout, image)
+		if repaired is not None:
+			if quarantine_dir:
+				backup_path = move_to(path, hi_dir, quarantine_dir)
+			else:
+				backup_path = path + ".bak"
+				os.replace(path, backup_path)
+			tmp_path = path + ".tmp"
+			with open(tmp_path, 'wb') as hiscore_file:
+				hiscore_file.write(repaired)
+			os.replace(tmp_path, path)
+			return path, problems, "repaired (original in " + backup_path + ")"
+	if quarantine_dir:
+		action = "quarantined in " + move_to(path, hi_dir, quarantine_dir)
+	return path, problems, action
+
+
+def audit(hi_dirs, quarantine_dir=None, repair=False, workers=AUDIT_WORKERS):
+	""" returns a tuple: list of ( path, problems, action ) for the files with problems, stats dict """
+	hiscore_dat = get_default_dat()
+	if not any(True for entry in hiscore_dat.entries()):
+		raise ValueError("no entries found in: " + ", ".join(hiscore_dat.paths) + " (check HISCORE_DAT_PATH)")
+	file_lookup = build_file_lookup(hiscore_dat)
+	layouts = {}  # id(DatEntry) -> EntryLayout, or the error message of a malformed entry
+	jobs = []
+	results = []
+	unmatched = 0
+	unchecked = 0  # files of malformed dat entries
+	for hi_dir, system, name, path, entry in walk_hiscore_files(hi_dirs, file_lookup):
+		if entry is None:
+			unmatched += 1
+			continue
+		layout = layouts.get(id(entry))
+		if layout is None:
+			try:
+				layout = EntryLayout(entry)
+			except (ValueError, IndexError) as e:
+				layout = "malformed dat entry at " + entry.source + ":" + str(entry.line_number) + ": " + str(e)
+			layouts[id(entry)] = layout
+		if isinstance(layout, str):
+			# the file can not be checked, but it is not the file to blame (not quarantined)
+			results.append(( path, [ ( "error", layout ) ], None ))
+			unchecked += 1
+			continue
+		jobs.append(( hi_dir, path, layout ))
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [ executor.submit(audit_file, hi_dir, path, layout, quarantine_dir, repair) for hi_dir, path, layout in jobs ]
+		for future in futures:
+			path, problems, action = future.result()
+			if problems:
+				results.append(( path, problems, action ))
+	stats = {
+		"files": len(jobs) + unchecked,
+		"unmatched": unmatched,
+		"errors": sum(1 for path, problems, action in results if any(level == "error" for level, message in problems)),
+		"fixed": sum(1 for path, problems, action in results if action is not None),
+	}
+	return results, stats
+
+
+if __name__ == '__main__':
+	logging.getLogger().setLevel(logging.INFO)
+	args = sys.argv[1:]
+	quarantine_dir = None
+	repair = "--repair" in args
+	verbose = "--verbose" in args
+	hi_dirs = []
+	i = 0
+	while i < len(args):
+		if args[i] == "--quarantine" and i + 1 < len(args):
+			quarantine_dir = args[i + 1]
+			i += 1
+		elif not args[i] in [ "--repair", "--verbose" ]:
+			hi_dirs.append(args[i])
+		i += 1
+	if not hi_dirs and os.getenv("HISCORE_PATH"):
+		hi_dirs = [ os.getenv("HISCORE_PATH") ]
+	if not hi_dirs:
+		print("usage: hiscore_audit.py [--verbose] [--quarantine DIR] [--repair] [HI_DIR ...]   # default: HISCORE_PATH")
+		sys.exit(1)
+
+	try:
+		results, stats = audit(hi_dirs, quarantine_dir, repair)
+	except ValueError as e:
+		logging.error(str(e))
+		sys.exit(1)
+	for path, problems, action in sorted(results):
+		for level, message in problems:
+			if level != "info" or verbose:
+				print(path + ": " + level + ": " + message)
+		if action:
+			print(path + ": " + action)
+	logging.info("%d files checked, %d with errors (%d repaired or quarantined), %d not in the dat" % (stats["files"], stats["errors"], stats["fixed"], stats["unmatched"]))
+	sys.exit(1 if stats["errors"] > stats["fixed"] else 0)
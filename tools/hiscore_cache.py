@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+persistent cache for the game lookups done by the retroarch companion on every game switch.
+
+entries are keyed by (core, content name, crc32) and hold the resolved hiscore.dat rows, the compiled regions,
+the address translation for the core and the last-known .hi file contents.
+recently used entries are kept in memory (LRU) so switching back to a game does not touch the disk at all,
+the whole cache is also mirrored in a json file so it survives restarts (written by save() only when some entry was changed).
+on a hit the .hi file is checked with a single stat, so the files changed by the other tools are reloaded (see check_hiscore_file()).
+the json file is discarded when the dat files, the hiscore path or the store path were changed since it was written.
+with a store (see hi_store.py) the entries are checked against their own record, not the signature of the whole store file.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+HISCORE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "console_hiscore", "companion_cache.json")
+if("HISCORE_CACHE_PATH" in os.environ):
+	HISCORE_CACHE_PATH = os.environ['HISCORE_CACHE_PATH']
+
+HISCORE_CACHE_SIZE = 32  # max entries kept in memory and on disk
+if("HISCORE_CACHE_SIZE" in os.environ):
+	HISCORE_CACHE_SIZE = int(os.environ['HISCORE_CACHE_SIZE'])
+
+HISCORE_CACHE_FORMAT_VERSION = 2
+
+# min. seconds between two checks of the dat file for changes
+DAT_CHECK_INTERVAL = 30
+
+
+def get_file_signature(path):
+	""" returns a [ mtime_ns, size ] list used to detect file changes, or None if the file is missing """
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return [ st.st_mtime_ns, st.st_size ]
+
+
+def get_dat_signature(dat_path):
+	""" signature of all the dat files listed in dat_path (separated by os.pathsep) """
+	return [ get_file_signature(path) for path in dat_path.split(os.pathsep) if path ]
+
+
+class HiscoreResolutionCache(object):
+
+	"""Usage:
+	cache = HiscoreResolutionCache(dat_path=HISCORE_DAT_PATH, hiscore_path=HISCORE_PATH, store_path=HISCORE_STORE_PATH, store=hiscore_store)
+	entry = cache.get("Nestopia", "Super Mario Bros. (W) [!]", "d445f698")
+	if entry is None:
+		entry = { ... }  # resolve the game the slow way
+		cache.put("Nestopia", "Super Mario Bros. (W) [!]", "d445f698", entry)
+	cache.update_hiscore_data("Nestopia", "Super Mario Bros. (W) [!]", "d445f698", data)  # after a .hi file was (re-)written
+	cache.check_hiscore_file("Nestopia", "Super Mario Bros. (W) [!]", "d445f698")  # True if the .hi file was changed by someone else
+	if cache.dirty:
+		cache.save()  # persist the entries
+
+	entry fields:
+	  content_name, candidate_systems, rows, regions (list of [ address, length, start_byte, end_byte, prefill ] with the address already translated),
+	  address_offset, byteswap, hiscore_file_path, hiscore_file_data (bytes or None), hiscore_file_signature
+	"""
+
+	def __init__(self, cache_path=HISCORE_CACHE_PATH, max_entries=HISCORE_CACHE_SIZE, dat_path=None, hiscore_path=None, store_path=None, store=None):
+		self.cache_path = cache_path
+		self.max_entries = max_entries
+		self.dat_path = dat_path
+		self.hiscore_path = hiscore_path  # the entries hold .hi file paths in this dir
+		self.store_path = store_path  # ... or the path of the single-file store (see hi_store.py)
+		self.store = store  # the open HiStore of store_path, only to be used from the thread doing the .hi reads and writes
+		self._entries = OrderedDict()
+		self._lock = threading.RLock()  # save() may run in another thread
+		self._dat_signature = None
+		self._dat_checked_time = 0
+		self._dirty = False  # entries changed since the last save()
+		self.hits = 0
+		self.misses = 0
+		if self.dat_path:
+			self._dat_signature = get_dat_signature(self.dat_path)
+			self._dat_checked_time = time.monotonic()
+		self._load()
+
+
+	@staticmethod
+	def make_key(core, content_name, crc32):
+		return "\t".join([ core or "", content_name or "", (crc32 or "").lower() ])
+
+
+	@property
+	def dirty(self):
+		return self._dirty
+
+
+	def _get_signature(self, entry):
+		""" signature of the .hi file of an entry, or of its record in the store """
+		if not entry.get("hiscore_file_path"):
+			return None
+		if self.store is not None:
+			return self.store.get_signature(entry.get("candidate_systems", []), entry.get("content_name", ""))
+		return get_file_signature(entry["hiscore_file_path"])
+
+
+	def _mark_stale(self, entry):
+		entry["hiscore_file_data"] = None
+		entry["hiscore_file_signature"] = None
+		entry["hiscore_file_stale"] = True
+
+
+	def _load(self):
+		""" read the on-disk cache, dropping it when the dat file, the hiscore path or the store path were changed since it was written """
+		if not self.cache_path:
+			return
+		try:
+			with open(self.cache_path, 'r') as cache_file:
+				cache_data = json.load(cache_file)
+		except (OSError, ValueError):
+			return
+		if cache_data.get("version") != HISCORE_CACHE_FORMAT_VERSION or cache_data.get("dat_path") != self.dat_path or cache_data.get("dat_signature") != self._dat_signature or cache_data.get("hiscore_path") != self.hiscore_path or cache_data.get("store_path") != self.store_path:
+			logging.debug("hiscore cache is stale, discarded")
+			return
+		for key, entry in cache_data.get("entries", []):
+			if entry.get("hiscore_file_data") is not None:
+				entry["hiscore_file_data"] = bytes.fromhex(entry["hiscore_file_data"])
+			# the .hi file may have been changed by another tool while we were not running
+			if entry.get("hiscore_file_path") and self._get_signature(entry) != entry.get("hiscore_file_signature"):
+				self._mark_stale(entry)
+			self._entries[key] = entry
+		while len(self._entries) > self.max_entries:
+			self._entries.popitem(last=False)
+		logging.debug("hiscore cache loaded: " + str(len(self._entries)) + " entries")
+
+
+	def save(self):
+		""" write the cache on disk (atomically), nothing is done if no entry was changed since the last save """
+		if not self.cache_path:
+			return
+		with self._lock:
+			if not self._dirty:
+				return
+			self._dirty = False
+			entries = []
+			for key, entry in self._entries.items():
+				entry = dict(entry)
+				if entry.get("hiscore_file_data") is not None:
+					entry["hiscore_file_data"] = bytes(entry["hiscore_file_data"]).hex()
+				entries.append([ key, entry ])
+			cache_data = {
+				"version": HISCORE_CACHE_FORMAT_VERSION,
+				"dat_path": self.dat_path,
+				"dat_signature": self._dat_signature,
+				"hiscore_path": self.hiscore_path,
+				"store_path": self.store_path,
+				"entries": entries
+			}
+		try:
+			cache_dir = os.path.dirname(self.cache_path)
+			if cache_dir and not os.path.isdir(cache_dir):
+				os.makedirs(cache_dir)
+			tmp_path = self.cache_path + ".tmp"
+			with open(tmp_path, 'w') as cache_file:
+				json.dump(cache_data, cache_file)
+			os.replace(tmp_path, self.cache_path)
+		except OSError:
+			logging.warning("unable to write the hiscore cache: " + self.cache_path)
+			self._dirty = True
+
+
+	def _check_dat(self):
+		""" drop everything if any dat file was edited, checked at most every DAT_CHECK_INTERVAL seconds """
+		if not self.dat_path:
+			return
+		now = time.monotonic()
+		if now - self._dat_checked_time < DAT_CHECK_INTERVAL:
+			return
+		self._dat_checked_time = now
+		dat_signature = get_dat_signature(self.dat_path)
+		if dat_signature != self._dat_signature:
+			logging.info("hiscore dat was changed, cache invalidated")
+			with self._lock:
+				self._dat_signature = dat_signature
+				self._entries.clear()
+				self._dirty = True
+
+
+	def get(self, core, content_name, crc32):
+		""" returns the cached entry (a dict) or None """
+		self._check_dat()
+		key = self.make_key(core, content_name, crc32)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return entry
+
+
+	def put(self, core, content_name, crc32, entry, save=True):
+		key = self.make_key(core, content_name, crc32)
+		entry.setdefault("hiscore_file_data", None)
+		entry.setdefault("hiscore_file_signature", None)
+		if entry.get("hiscore_file_path") and entry["hiscore_file_signature"] is None and entry["hiscore_file_data"] is not None:
+			entry["hiscore_file_signature"] = self._get_signature(entry)
+		with self._lock:
+			self._dirty = True
+			self._entries[key] = entry
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+		if save:
+			self.save()
+
+
+	def update_hiscore_data(self, core, content_name, crc32, data, written=True):
+		"""
+		keep the last-known .hi contents in sync after the file was written (or read), only in memory: call save() to persist them
+		with written=False the file signature is not refreshed (the write is still pending, a later call will do it)
+		"""
+		with self._lock:
+			entry = self._entries.get(self.make_key(core, content_name, crc32))
+			if entry is None:
+				return
+			entry["hiscore_file_data"] = bytes(data) if data is not None else None
+			entry.pop("hiscore_file_stale", None)
+			self._dirty = True
+			if not written:
+				return
+			entry["hiscore_file_signature"] = self._get_signature(entry)
+
+
+	def check_hiscore_file(self, core, content_name, crc32):
+		"""
+		flag the entry as stale when its .hi file was changed by another tool (e.g. hiscore_audit.py --repair), a single stat.
+		returns True if the .hi file must be reloaded
+		"""
+		with self._lock:
+			entry = self._entries.get(self.make_key(core, content_name, crc32))
+			if entry is None or not entry.get("hiscore_file_path"):
+				return False
+			if entry.get("hiscore_file_stale"):
+				return True
+			if self._get_signature(entry) == entry.get("hiscore_file_signature"):
+				return False
+			logging.info("hiscore file was changed outside the companion: " + entry["hiscore_file_path"])
+			self._mark_stale(entry)
+			self._dirty = True
+			return True
+
+
+	def set_hiscore_path(self, hiscore_path):
+		""" drop all the entries if the .hi files are moved to another dir (e.g. savefile_directory was changed) """
+		if hiscore_path == self.hiscore_path:
+			return
+		self.hiscore_path = hiscore_path
+		self.invalidate()
+
+
+	def invalidate(self, core=None, content_name=None, crc32=None):
+		""" drop a single entry, or all the entries if called without args """
+		with self._lock:
+			if core is None and content_name is None and crc32 is None:
+				self._entries.clear()
+			else:
+				self._entries.pop(self.make_key(core, content_name, crc32), None)
+			self._dirty = True
+		self.save()
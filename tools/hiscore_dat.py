@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+merged index over a list of dat files, e.g. the upstream console_hiscore.dat, MAME's hiscore.dat and a local overrides file.
+
+HISCORE_DAT_PATH may hold more than one path, separated by os.pathsep (":" on Linux, ";" on Windows).
+when the same alias is defined in more than one file, the entry in the file listed last wins (overrides go last),
+and it replaces the whole earlier entry: its other aliases (names, crc32s) resolve to the override too,
+so a game gets the same rows however it is named. within the same file the 1st entry wins, like in the MAME plugin.
+every entry keeps the path and line of the file it was read from.
+refresh() reparses only the files that were changed since the last call.
+
+usage:
+  hiscore_dat.py lookup ALIAS   # e.g. "nes,Super Mario Bros. (W) [!]" or "1942", prints the rows and their source
+  hiscore_dat.py stats
+  hiscore_dat.py build-index [DAT_PATH]   # write the .idx file read by the MAME plugin next to the dat
+"""
+
+import sys
+import os
+import re
+import logging
+import threading
+
+from state2hi import HISCORE_DAT_PATH
+from hiscore_cache import get_file_signature
+from hiscore_decode import DECODE_DIRECTIVE
+
+HISCORE_DAT_PATHS = [ path for path in HISCORE_DAT_PATH.split(os.pathsep) if path ]
+
+CRC32_ALIAS_RE = re.compile(r'^crc32=([0-9a-fA-F]{1,8})$')
+
+
+def normalize_alias(alias):
+	""" crc32 aliases are compared by value, the MAME plugin does not zero-pad them """
+	if not "," in alias:
+		return alias
+	system, name = alias.split(",", 1)
+	match = CRC32_ALIAS_RE.match(name)
+	if match:
+		return system + ",crc32=" + ("%x" % int(match.group(1), 16))
+	return alias
+
+
+class DatEntry(object):
+
+	def __init__(self, source, line_number):
+		self.source = source  # path of the dat file
+		self.line_number = line_number
+		self.aliases = []
+		self.rows = []
+		self.rows_offset = None  # byte range of the rows in the dat file
+		self.rows_end = None
+		self.decoders = []  # the ";%decode" directives (see hiscore_decode.py)
+		# line numbers of the aliases, rows and decoders, in the same order
+		self.alias_lines = []
+		self.row_lines = []
+		self.decoder_lines = []
+
+	def __repr__(self):
+		return "<DatEntry " + self.source + ":" + str(self.line_number) + " " + (self.aliases[0] if self.aliases else "") + ">"
+
+
+def parse_dat_file(path, messages=None):
+	"""
+	returns a list of DatEntry, in file order.
+	the lines skipped while parsing (orphaned rows, unrecognized lines, aliases without rows) are appended to messages
+	as ( level, path, line number, message ), if passed
+	"""
+	def report(level, line_number, message):
+		if messages is not None:
+			messages.append(( level, path, line_number, message ))
+
+	entries = []
+	entry = None
+	offset = 0
+	with open(path, 'rb') as hiscore_file:
+		for line_number, raw_line in enumerate(hiscore_file, 1):
+			line_offset = offset
+			offset += len(raw_line)
+			line = raw_line.decode('utf-8', 'replace').strip()
+			if line.startswith(";") and not line.startswith(DECODE_DIRECTIVE):
+				# comment lines are skipped, they do not end the rows of an entry
+				continue
+			if line.startswith(DECODE_DIRECTIVE):
+				if entry is None:
+					report("error", line_number, "orphaned decode line, no game alias before it")
+				else:
+					entry.decoders.append(line[len(DECODE_DIRECTIVE):].strip())
+					entry.decoder_lines.append(line_number)
+				continue
+			# same as the plugin: drop everything after a ';'
+			line = line.split(";", 1)[0].strip()
+			if line == "":
+				if entry is not None and entry.rows:
+					entry = None
+				continue
+			if line.startswith("@"):
+				if entry is None:
+					report("error", line_number, "orphaned row, no game alias before it")
+					continue
+				entry.rows.append(line)
+				entry.row_lines.append(line_number)
+				if entry.rows_offset is None:
+					entry.rows_offset = line_offset
+				entry.rows_end = offset
+			elif line.endswith(":"):
+				if entry is None or entry.rows:
+					entry = DatEntry(path, line_number)
+					entries.append(entry)
+				entry.aliases.append(line[:-1])
+				entry.alias_lines.append(line_number)
+			else:
+				report("error", line_number, "unrecognized line: " + line)
+	for entry in entries:
+		if not entry.rows:
+			report("warning", entry.line_number, "game alias without rows")
+	return [ entry for entry in entries if entry.rows ]
+
+
+class HiscoreDat(object):
+
+	"""Usage:
+	dat = HiscoreDat([ "console_hiscore.dat", "hiscore.dat", "local.dat" ])  # later files take precedence
+	entry = dat.find_entry([ "nes", "famicom" ], "Super Mario Bros. (W) [!]")  # a DatEntry or None
+	rows = dat.get_rows([ "nes", "famicom" ], "crc32=d445f698")
+	dat.refresh()  # reparse the changed files only
+	"""
+
+	def __init__(self, paths=None):
+		self.paths = list(paths if paths is not None else HISCORE_DAT_PATHS)
+		self._files = {}  # path -> ( signature, { normalized alias -> DatEntry } )
+		self._index = {}
+		self._lock = threading.Lock()
+		self.refresh()
+
+
+	def signature(self):
+		""" a json-friendly value changing whenever any of the dat files is changed """
+		return [ [ path, self._files[path][0] if path in self._files else None ] for path in self.paths ]
+
+
+	def refresh(self):
+		""" reparse the changed dat files and rebuild the merged index, returns True if anything changed """
+		with self._lock:
+			changed = False
+			for path in self.paths:
+				signature = get_file_signature(path)
+				if path in self._files and self._files[path][0] == signature:
+					continue
+				changed = True
+				aliases = {}
+				if signature is None:
+					logging.warning("dat file not found: " + path)
+				else:
+					for entry in parse_dat_file(path):
+						for alias in entry.aliases:
+							aliases.setdefault(normalize_alias(alias), entry)
+					logging.debug("dat file parsed: " + path + " (" + str(len(aliases)) + " aliases)")
+				self._files[path] = ( signature, aliases )
+			if changed:
+				index = {}
+				for path in self.paths:
+					aliases = self._files[path][1]
+					# entry of an earlier file -> the entry overriding it
+					overrides = {}
+					for key, entry in aliases.items():
+						if key in index and not id(index[key]) in overrides:
+							overrides[id(index[key])] = entry
+					if overrides:
+						for key, entry in list(index.items()):
+							if id(entry) in overrides:
+								index[key] = overrides[id(entry)]
+					index.update(aliases)
+				self._index = index
+			return changed
+
+
+	def get(self, alias):
+		""" lookup a full alias, e.g. "nes,Super Mario Bros. (W) [!]" or "1942" """
+		return self._index.get(normalize_alias(alias))
+
+
+	def find_entry(self, candidate_systems, game_name):
+		""" returns the DatEntry for the 1st matching system, or None """
+		for system in candidate_systems:
+			entry = self._index.get(normalize_alias(system + "," + game_name))
+			if entry is not None:
+				return entry
+		return None
+
+
+	def get_rows(self, candidate_systems, game_name):
+		entry = self.find_entry(candidate_systems, game_name)
+		if entry is None:
+			return []
+		return list(entry.rows)
+
+
+	def entries(self):
+		""" all the distinct entries of the merged index """
+		seen = set()
+		for entry in self._index.values():
+			if id(entry) in seen:
+				continue
+			seen.add(id(entry))
+			yield entry
+
+
+	def aliases(self):
+		return self._index.keys()
+
+
+	def items(self):
+		""" ( normalized alias, DatEntry ) for all the aliases of the merged index """
+		return self._index.items()
+# end of HiscoreDat
+
+
+_default_dat = None
+
+def get_default_dat():
+	""" the shared index over HISCORE_DAT_PATH, refreshed on every call """
+	global _default_dat
+	if _default_dat is None:
+		_default_dat = HiscoreDat()
+	else:
+		_default_dat.refresh()
+	return _default_dat
+
+
+def build_file_lookup(hiscore_dat, entry_filter=None):
+	"""
+	index the entries to match the .hi files, returns a tuple:
+	  ( system, game name ) -> DatEntry, game name -> DatEntry (for the flat dirs), set of the known systems
+	"""
+	by_alias = {}
+	by_name = {}
+	systems = set()
+	# the aliases of the merged index, so the names of an overridden entry match its override
+	for alias, entry in hiscore_dat.items():
+		if entry_filter is not None and not entry_filter(entry):
+			continue
+		if "," in alias:
+			system, name = alias.split(",", 1)
+			systems.add(system)
+			by_alias.setdefault(( system, name ), entry)
+		else:
+			name = alias  # arcade romname
+		by_name.setdefault(name, entry)
+	return by_alias, by_name, systems
+
+
+def walk_hiscore_files(hi_dirs, file_lookup):
+	"""
+	yields ( hi dir, system, game name, path, DatEntry or None ) for every .hi file,
+	in the hi/<system>/<game>.hi layout or flat (e.g. savefile_directory, system is None then)
+	"""
+	by_alias, by_name, systems = file_lookup
+	for hi_dir in hi_dirs:
+		for root, dirs, files in os.walk(hi_dir):
+			system = os.path.basename(root)
+			if not system in systems:
+				system = None
+			for filename in files:
+				if not filename.endswith(".hi"):
+					continue
+				name = filename[:-3]
+				if system is not None:
+					entry = by_alias.get(( system, name ))
+				else:
+					entry = by_name.get(name)
+				yield hi_dir, system, name, os.path.join(root, filename), entry
+
+
+LUA_INDEX_MAGIC = ";console_hiscore.idx v2"
+LUA_INDEX_EMPTY_BUCKET = 0xffffffff
+
+
+def lua_index_hash(key):
+	""" same hash computed by the MAME plugin """
+	h = 0
+	for b in key.encode('utf-8'):
+		h = (h * 31 + b) & 0xffffffff
+	return h
+
+
+def build_lua_index(dat_path, index_path=None):
+	"""
+	compile a dat file in a hash index for the MAME plugin, so it can seek straight to the rows of the running game.
+	layout (text):
+	  ;console_hiscore.idx v2 <dat size> <dat mtime (integer secs)> <bucket count>
+	  a table of <bucket count> "%08x" lines, the offset of each bucket in the index file (ffffffff if empty)
+	  the buckets: "<alias>\t<rows offset in the dat>\t<rows length>" lines, each bucket ends with an empty line
+	the plugin falls back to scanning the dat if its size or mtime do not match, or if the game is not in the index.
+	returns the index path
+	"""
+	if index_path is None:
+		index_path = os.path.splitext(dat_path)[0] + ".idx"
+	keys = {}
+	for entry in parse_dat_file(dat_path):
+		for alias in entry.aliases:
+			# the 1st entry wins, like in the plugin
+			keys.setdefault(normalize_alias(alias), entry)
+	bucket_count = 64
+	while bucket_count < len(keys):
+		bucket_count *= 2
+	buckets = [ [] for i in range(bucket_count) ]
+	for key in sorted(keys):
+		entry = keys[key]
+		buckets[lua_index_hash(key) % bucket_count].append("%s\t%d\t%d\n" % (key, entry.rows_offset, entry.rows_end - entry.rows_offset))
+
+	header = "%s %d %d %d\n" % (LUA_INDEX_MAGIC, os.path.getsize(dat_path), int(os.path.getmtime(dat_path)), bucket_count)
+	offset = len(header.encode('utf-8')) + bucket_count * 9
+	table = []
+	bucket_data = []
+	for bucket in buckets:
+		if not bucket:
+			table.append("%08x\n" % LUA_INDEX_EMPTY_BUCKET)
+			continue
+		table.append("%08x\n" % offset)
+		data = "".join(bucket) + "\n"
+		bucket_data.append(data)
+		offset += len(data.encode('utf-8'))
+
+	tmp_path = index_path + ".tmp"
+	with open(tmp_path, 'w', encoding='utf-8', newline='\n') as index_file:
+		index_file.write(header)
+		index_file.writelines(table)
+		index_file.writelines(bucket_data)
+	os.replace(tmp_path, index_path)
+	logging.info("written " + index_path + " (" + str(len(keys)) + " aliases)")
+	return index_path
+
+
+def lookup_lua_index(index_path, dat_path, key):
+	""" the same lookup done by the MAME plugin, returns the rows (list) or None """
+	with open(index_path, 'rb') as index_file:
+		header = index_file.readline().decode('utf-8').split()
+		if len(header) != 5 or " ".join(header[0:2]) != LUA_INDEX_MAGIC or int(header[2]) != os.path.getsize(dat_path) or int(header[3]) != int(os.path.getmtime(dat_path)):
+			return None
+		bucket_count = int(header[4])
+		table_offset = index_file.tell()
+		index_file.seek(table_offset + (lua_index_hash(key) % bucket_count) * 9)
+		bucket_offset = int(index_file.read(8), 16)
+		if bucket_offset == LUA_INDEX_EMPTY_BUCKET:
+			return None
+		index_file.seek(bucket_offset)
+		for line in index_file:
+			line = line.decode('utf-8').rstrip("\n")
+			if line == "":
+				return None
+			line_key, rows_offset, rows_length = line.rsplit("\t", 2)
+			if line_key == key:
+				with open(dat_path, 'rb') as hiscore_file:
+					hiscore_file.seek(int(rows_offset))
+					rows = hiscore_file.read(int(rows_length)).decode('utf-8', 'replace').splitlines()
+				rows = [ row.split(";", 1)[0].strip() for row in rows ]
+				return [ row for row in rows if row.startswith("@") ]
+	return None
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] not in [ "lookup", "stats", "build-index" ] or (sys.argv[1] == "lookup" and len(sys.argv) < 3):
+		print("usage: hiscore_dat.py lookup ALIAS")
+		print("       hiscore_dat.py stats")
+		print("       hiscore_dat.py build-index [DAT_PATH]")
+		sys.exit(1)
+	if sys.argv[1] == "build-index":
+		logging.getLogger().setLevel(logging.INFO)
+		build_lua_index(sys.argv[2] if len(sys.argv) >= 3 else HISCORE_DAT_PATHS[0])
+		sys.exit(0)
+	dat = get_default_dat()
+	if sys.argv[1] == "lookup":
+		entry = dat.get(sys.argv[2])
+		if entry is None:
+			print("not found")
+			sys.exit(1)
+		print("; " + entry.source + ":" + str(entry.line_number))
+		for alias in entry.aliases:
+			print(alias + ":")
+		for row in entry.rows:
+			print(row)
+	else:
+		for path in dat.paths:
+			entries = set(id(entry) for entry in dat._files[path][1].values())
+			overridden = sum(1 for alias, entry in dat._files[path][1].items() if dat.get(alias) is not entry)
+			print("%s: %d entries, %d aliases (%d overridden)" % (path, len(entries), len(dat._files[path][1]), overridden))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+score table decoders for the .hi files, described by ";%decode" lines stored in the dat right after the rows of an entry:
+
+  nes,smb:
+  @:maincpu,program,7d7,6,0,0,ff
+  ;%decode count=1 score=digits:0:6
+
+the .hi image is the concatenation of all the regions of the entry, a directive holds space-separated key=value tokens:
+  count=N              entries in the table (default 1)
+  stride=N             bytes between two entries (default: the score length)
+  score=TYPE:OFFSET:LENGTH[:STRIDE]   the score field of the 1st entry, STRIDE overrides the table stride (for split tables)
+  name=TYPE:OFFSET:LENGTH[:STRIDE]    optional name field
+  charset=HEX:CHARS    for name=charset: the char of byte HEX, then of the following bytes ("_" is a space)
+  scale=N              the displayed score is the stored one multiplied by N (e.g. a fixed trailing 0)
+  order=desc|asc       desc (default) when higher is better, asc for times
+  table=NAME           a label when an entry has more than one table (e.g. difficulty levels)
+
+score types: bcd, bcdle (packed BCD, big/little endian), be, le (binary), digits (one decimal digit per byte), ascii (text)
+name types: ascii, charset
+
+usage:
+  hiscore_decode.py ALIAS HI_FILE   # e.g. hiscore_decode.py "nes,smb" "hi/nes/Super Mario Bros. (W) [!].hi"
+"""
+
+import sys
+
+from state2hi import parse_hiscore_row
+
+DECODE_DIRECTIVE = ";%decode"
+
+SCORE_TYPES = [ "bcd", "bcdle", "be", "le", "digits", "ascii" ]
+NAME_TYPES = [ "ascii", "charset" ]
+
+# packed BCD byte -> value, None for invalid nibbles
+BCD_VALUES = [ (b >> 4) * 10 + (b & 0xf) if (b >> 4) <= 9 and (b & 0xf) <= 9 else None for b in range(256) ]
+
+
+def get_image_length(rows):
+	""" size of the .hi image: the sum of the region lengths """
+	return sum(parse_hiscore_row(row)[3] for row in rows if not row.startswith("@delay"))
+
+
+def parse_field(value, default_stride):
+	""" returns a tuple: type, offset, length, stride """
+	parts = value.split(":")
+	if len(parts) < 3 or len(parts) > 4:
+		raise ValueError("malformed field: " + value)
+	try:
+		offset, length = int(parts[1]), int(parts[2])
+		stride = int(parts[3]) if len(parts) == 4 else default_stride
+	except ValueError:
+		raise ValueError("malformed field: " + value)
+	if length <= 0:
+		raise ValueError("zero length field: " + value)
+	return parts[0], offset, length, stride
+
+
+def decode_score(score_type, data):
+	""" returns the stored value, None if data is not a valid score """
+	if score_type == "be":
+		return int.from_bytes(data, 'big')
+	if score_type == "le":
+		return int.from_bytes(data, 'little')
+	if score_type in [ "bcd", "bcdle" ]:
+		if score_type == "bcdle":
+			data = data[::-1]
+		value = 0
+		for b in data:
+			digits = BCD_VALUES[b]
+			if digits is None:
+				return None
+			value = value * 100 + digits
+		return value
+	if score_type == "digits":
+		value = 0
+		for b in data:
+			if b > 9:
+				return None
+			value = value * 10 + b
+		return value
+	# ascii
+	text = data.decode('ascii', 'replace').strip(" \0")
+	if not text.isdigit():
+		return None if text else 0
+	return int(text)
+
+
+def encode_score(score_type, value, length):
+	""" the inverse of decode_score, raises ValueError if value does not fit in length bytes """
+	if score_type in [ "be", "le" ]:
+		try:
+			return value.to_bytes(length, 'big' if score_type == "be" else 'little')
+		except OverflowError:
+			raise ValueError("score " + str(value) + " does not fit in " + str(length) + " bytes")
+	digits = { "bcd": length * 2, "bcdle": length * 2, "digits": length, "ascii": length }[score_type]
+	text = "%0*d" % (digits, value)
+	if len(text) > digits:
+		raise ValueError("score " + str(value) + " does not fit in " + str(digits) + " digits")
+	if score_type == "bcd":
+		return bytes.fromhex(text)
+	if score_type == "bcdle":
+		return bytes.fromhex(text)[::-1]
+	if score_type == "digits":
+		return bytes(int(c) for c in text)
+	return ("%*d" % (length, value)).encode('ascii')
+
+
+class ScoreTable(object):
+
+	"""Usage:
+	table = ScoreTable("count=5 stride=8 score=bcd:0:3 name=charset:3:3 charset=0a:ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+	table.decode(hi_image)  # list of ( score, name ), in table order (None for the invalid entries)
+	table.encode([ ( 12300, "ABC" ), ... ], base_image)  # a new image with the entries written over base_image
+	table.sort_key(score)  # key to sort the best scores first
+	"""
+
+	def __init__(self, directive):
+		self.directive = directive
+		tokens = {}
+		for token in directive.split():
+			if not "=" in token:
+				raise ValueError("malformed token: " + token)
+			key, value = token.split("=", 1)
+			tokens[key] = value
+		unknown = set(tokens) - set([ "count", "stride", "score", "name", "charset", "scale", "order", "table" ])
+		if unknown:
+			raise ValueError("unknown keys: " + ", ".join(sorted(unknown)))
+		if not "score" in tokens:
+			raise ValueError("missing score field")
+		try:
+			self.count = int(tokens.get("count", "1"))
+			self.scale = int(tokens.get("scale", "1"))
+			stride = int(tokens["stride"]) if "stride" in tokens else None
+		except ValueError:
+			raise ValueError("malformed number in: " + directive)
+		self.order = tokens.get("order", "desc")
+		if not self.order in [ "desc", "asc" ]:
+			raise ValueError("unknown order: " + self.order)
+		self.name = tokens.get("table", "")
+
+		score_field = parse_field(tokens["score"], stride)
+		if stride is None:
+			stride = score_field[2]  # back-to-back scores
+		self.score_field = score_field[0:3] + ( score_field[3] if score_field[3] is not None else stride, )
+		if not self.score_field[0] in SCORE_TYPES:
+			raise ValueError("unknown score type: " + self.score_field[0])
+		self.name_field = None
+		if "name" in tokens:
+			self.name_field = parse_field(tokens["name"], stride)
+			if not self.name_field[0] in NAME_TYPES:
+				raise ValueError("unknown name type: " + self.name_field[0])
+
+		# byte -> char tables for the names
+		self.chars = None
+		self.char_bytes = None
+		if self.name_field is not None and self.name_field[0] == "charset":
+			if not "charset" in tokens or not ":" in tokens["charset"]:
+				raise ValueError("name=charset needs a charset=HEX:CHARS")
+			first_byte, chars = tokens["charset"].split(":", 1)
+			first_byte = int(first_byte, 16)
+			chars = chars.replace("_", " ")
+			if first_byte + len(chars) > 256:
+				raise ValueError("charset too long")
+			self.chars = [ "?" ] * 256
+			self.char_bytes = {}
+			for i, c in enumerate(chars):
+				self.chars[first_byte + i] = c
+				self.char_bytes.setdefault(c, first_byte + i)
+		# the image must be at least this long
+		self.size = max(offset + (self.count - 1) * stride + length for field_type, offset, length, stride in [ self.score_field ] + ([ self.name_field ] if self.name_field else []))
+
+	def __repr__(self):
+		return "<ScoreTable " + self.directive + ">"
+
+	def _field_slices(self, field):
+		field_type, offset, length, stride = field
+		return [ ( offset + i * stride, offset + i * stride + length ) for i in range(self.count) ]
+
+	def decode(self, image):
+		""" returns a list of ( score, name ), score is None for the invalid entries """
+		if len(image) < self.size:
+			raise ValueError("image too short: " + str(len(image)) + " bytes, " + str(self.size) + " needed")
+		score_type = self.score_field[0]
+		scores = []
+		for start, end in self._field_slices(self.score_field):
+			value = decode_score(score_type, image[start:end])
+			scores.append(value * self.scale if value is not None else None)
+		names = [ "" ] * self.count
+		if self.name_field is not None:
+			for i, ( start, end ) in enumerate(self._field_slices(self.name_field)):
+				data = image[start:end]
+				if self.chars is not None:
+					names[i] = "".join(self.chars[b] for b in data).rstrip()
+				else:
+					names[i] = data.decode('ascii', 'replace').strip(" \0")
+		return list(zip(scores, names))
+
+	def encode(self, entries, base_image):
+		""" returns a copy of base_image with the ( score, name ) entries written in table order, extra entries are ignored """
+		image = bytearray(base_image)
+		if len(image) < self.size:
+			raise ValueError("image too short: " + str(len(image)) + " bytes, " + str(self.size) + " needed")
+		score_type = self.score_field[0]
+		score_slices = self._field_slices(self.score_field)
+		name_slices = self._field_slices(self.name_field) if self.name_field is not None else None
+		for i, ( score, name ) in enumerate(entries[0:self.count]):
+			start, end = score_slices[i]
+			if score % self.scale:
+				raise ValueError("score " + str(score) + " is not a multiple of " + str(self.scale))
+			image[start:end] = encode_score(score_type, score // self.scale, end - start)
+			if name_slices is None:
+				continue
+			start, end = name_slices[i]
+			name = name[0:end - start].ljust(end - start)
+			if self.char_bytes is not None:
+				if not all(c in self.char_bytes for c in name):
+					raise ValueError("name not in the charset: '" + name + "'")
+				image[start:end] = bytes(self.char_bytes[c] for c in name)
+			else:
+				image[start:end] = name.encode('ascii', 'replace')
+		return bytes(image)
+
+	def sort_key(self, score):
+		return -score if self.order == "desc" else score
+# end of ScoreTable
+
+
+def get_score_tables(entry):
+	""" the ScoreTable list of a DatEntry (see hiscore_dat.py), malformed directives raise ValueError """
+	return [ ScoreTable(directive) for directive in entry.decoders ]
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print("usage: hiscore_decode.py ALIAS HI_FILE")
+		sys.exit(1)
+	from hiscore_dat import get_default_dat
+	entry = get_default_dat().get(sys.argv[1])
+	if entry is None:
+		print("not found: " + sys.argv[1])
+		sys.exit(1)
+	if not entry.decoders:
+		print("no " + DECODE_DIRECTIVE + " line for " + sys.argv[1])
+		sys.exit(1)
+	with open(sys.argv[2], 'rb') as hiscore_file:
+		image = hiscore_file.read()
+	if len(image) != get_image_length(entry.rows):
+		print("warning: size mismatch, expected " + str(get_image_length(entry.rows)) + " bytes, found " + str(len(image)))
+	for table in get_score_tables(entry):
+		if table.name:
+			print("[" + table.name + "]")
+		for rank, ( score, name ) in enumerate(table.decode(image), 1):
+			print("%2d. %10s  %s" % (rank, score if score is not None else "invalid", name))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+best-of leaderboards over the .hi files collected from many machines, decoded with the ";%decode" lines of the dat (see hiscore_decode.py).
+
+every HI_DIR is the hiscore directory of a machine, either with the hi/<system>/<game>.hi layout
+or flat (e.g. Retroarch's savefile_directory, the system is then guessed from the game name).
+the dat is indexed once, the files are read with a thread pool and decoded in batches of the same game,
+so a single compiled decoder is reused for all the copies of a game.
+
+usage:
+  hiscore_leaderboard.py [--json] [--top N] [--write-merged OUT_DIR] HI_DIR [HI_DIR ...]
+
+with --write-merged the merged tables are written back in OUT_DIR/<system>/<game>.hi, ready to be injected:
+every merged image starts from the one holding the best score, so the bytes not covered by the decoder are consistent.
+--top N only limits the printed entries, the merged files always hold the whole tables.
+"""
+
+import sys
+import os
+import json
+import time
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from hiscore_dat import get_default_dat, build_file_lookup, walk_hiscore_files
+from hiscore_decode import get_score_tables, get_image_length
+
+READ_WORKERS = 16
+
+
+class GameBatch(object):
+
+	""" all the .hi files of the same dat entry, with its compiled score tables """
+
+	def __init__(self, entry, tables):
+		self.entry = entry
+		self.tables = tables
+		self.image_length = get_image_length(entry.rows)
+		self.files = []  # list of ( machine dir, system, game name, path )
+		self.images = []  # list of ( file index, image bytes )
+		self.skipped = 0
+
+	def decode(self):
+		""" returns a list (one for each table) of lists of ( score, name, file index ) """
+		results = [ [] for table in self.tables ]
+		for file_index, image in self.images:
+			if len(image) != self.image_length:
+				# truncated or written with another version of the entry
+				self.skipped += 1
+				continue
+			for table_index, table in enumerate(self.tables):
+				for score, name in table.decode(image):
+					if score is not None:
+						results[table_index].append(( score, name, file_index ))
+		return results
+
+
+def find_hiscore_files(hi_dirs, file_lookup):
+	""" match the .hi files with the dat, returns a dict: id(DatEntry) -> GameBatch, and the number of unmatched files """
+	batches = {}
+	unmatched = 0
+	failed = set()  # id(DatEntry) with malformed decode lines
+	for hi_dir, system, name, path, entry in walk_hiscore_files(hi_dirs, file_lookup):
+		if entry is None or id(entry) in failed:
+			unmatched += 1
+			continue
+		batch = batches.get(id(entry))
+		if batch is None:
+			try:
+				tables = get_score_tables(entry)
+			except ValueError as e:
+				logging.error(entry.aliases[0] + ": " + str(e))
+				failed.add(id(entry))
+				unmatched += 1
+				continue
+			batch = batches[id(entry)] = GameBatch(entry, tables)
+		batch.files.append(( hi_dir, system, name, path ))
+	return batches, unmatched
+
+
+def read_file(path):
+	try:
+		with open(path, 'rb') as hiscore_file:
+			return hiscore_file.read()
+	except OSError as e:
+		logging.warning("unable to read " + path + ": " + str(e))
+		return None
+
+
+def read_batches(batches, workers=READ_WORKERS):
+	""" read all the files with a thread pool, in batch order """
+	jobs = [ ( batch, file_index, path ) for batch in batches.values() for file_index, ( hi_dir, system, name, path ) in enumerate(batch.files) ]
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for ( batch, file_index, path ), image in zip(jobs, executor.map(read_file, [ path for batch, file_index, path in jobs ], chunksize=64)):
+			if image is not None:
+				batch.images.append(( file_index, image ))
+
+
+def merge_table(table, rows):
+	""" best-of merge of the ( score, name, file index ) rows: sorted, same score and name counted once, cut to the table size """
+	seen = set()
+	merged = []
+	for score, name, file_index in sorted(rows, key=lambda row: ( table.sort_key(row[0]), row[2] )):
+		if ( score, name ) in seen:
+			continue
+		seen.add(( score, name ))
+		merged.append(( score, name, file_index ))
+	return merged[0:table.count]
+
+
+def build_leaderboards(hi_dirs, workers=READ_WORKERS):
+	"""
+	returns a tuple: list of ( GameBatch, list of merged tables ), stats dict
+	every merged table is a list of ( score, name, file index ) with the best first, as many as the table holds
+	"""
+	started = time.perf_counter()
+	file_lookup = build_file_lookup(get_default_dat(), lambda entry: entry.decoders)
+	batches, unmatched = find_hiscore_files(hi_dirs, file_lookup)
+	read_batches(batches, workers)
+	leaderboards = []
+	for batch in sorted(batches.values(), key=lambda batch: batch.entry.aliases[0]):
+		try:
+			results = batch.decode()
+		except ValueError as e:
+			logging.error(batch.entry.aliases[0] + ": " + str(e))
+			continue
+		leaderboards.append(( batch, [ merge_table(table, rows) for table, rows in zip(batch.tables, results) ] ))
+	stats = {
+		"files": sum(len(batch.files) for batch in batches.values()),
+		"games": len(batches),
+		"unmatched": unmatched,
+		"skipped": sum(batch.skipped for batch in batches.values()),
+		"secs": time.perf_counter() - started,
+	}
+	return leaderboards, stats
+
+
+def write_merged(out_dir, batch, merged_tables):
+	""" write the merged image in OUT_DIR/<system>/<game>.hi, returns the written path or None """
+	if not merged_tables or not any(merged_tables):
+		return None
+	images = dict(batch.images)
+	# start from the image holding the best score of the 1st table with some entries
+	image = images[next(merged for merged in merged_tables if merged)[0][2]]
+	for table, merged in zip(batch.tables, merged_tables):
+		image = table.encode([ ( score, name ) for score, name, file_index in merged ], image)
+	# the most common file name among the machines
+	system, name = Counter(( system, name ) for hi_dir, system, name, path in batch.files).most_common(1)[0][0]
+	if system is None:
+		system = batch.entry.aliases[0].split(",", 1)[0] if "," in batch.entry.aliases[0] else ""
+	out_path = os.path.join(out_dir, system, name + ".hi")
+	os.makedirs(os.path.dirname(out_path), exist_ok=True)
+	tmp_path = out_path + ".tmp"
+	with open(tmp_path, 'wb') as hiscore_file:
+		hiscore_file.write(image)
+	os.replace(tmp_path, out_path)
+	return out_path
+
+
+if __name__ == '__main__':
+	logging.getLogger().setLevel(logging.INFO)
+	args = sys.argv[1:]
+	as_json = "--json" in args
+	top = None
+	out_dir = None
+	hi_dirs = []
+	i = 0
+	while i < len(args):
+		if args[i] == "--top" and i + 1 < len(args):
+			top = int(args[i + 1])
+			i += 1
+		elif args[i] == "--write-merged" and i + 1 < len(args):
+			out_dir = args[i + 1]
+			i += 1
+		elif args[i] != "--json":
+			hi_dirs.append(args[i])
+		i += 1
+	if not hi_dirs:
+		print("usage: hiscore_leaderboard.py [--json] [--top N] [--write-merged OUT_DIR] HI_DIR [HI_DIR ...]")
+		sys.exit(1)
+
+	leaderboards, stats = build_leaderboards(hi_dirs)
+
+	if as_json:
+		output = []
+		for batch, merged_tables in leaderboards:
+			for table, merged in zip(batch.tables, merged_tables):
+				output.append({
+					"game": batch.entry.aliases[0],
+					"table": table.name,
+					"entries": [ { "score": score, "name": name, "machine": batch.files[file_index][0] } for score, name, file_index in merged[0:top] ],
+				})
+		print(json.dumps(output, indent=1))
+	else:
+		for batch, merged_tables in leaderboards:
+			for table, merged in zip(batch.tables, merged_tables):
+				print(batch.entry.aliases[0] + (" [" + table.name + "]" if table.name else "") + ":")
+				# --top only cuts the output, the merged files always hold the whole tables
+				for rank, ( score, name, file_index ) in enumerate(merged[0:top], 1):
+					print("  %2d. %10d  %-10s %s" % (rank, score, name, batch.files[file_index][0]))
+
+	if out_dir:
+		for batch, merged_tables in leaderboards:
+			try:
+				out_path = write_merged(out_dir, batch, merged_tables)
+			except ValueError as e:
+				logging.error(batch.entry.aliases[0] + ": " + str(e))
+				continue
+			if out_path:
+				logging.info("written merged file " + out_path)
+
+	logging.info("%d files, %d games decoded in %.2fs (%d files without a decoder, %d with a size mismatch)" % (stats["files"], stats["games"], stats["secs"], stats["unmatched"], stats["skipped"]))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+linter for console_hiscore.dat (optionally merged with MAME's hiscore.dat), meant to be run after every edit.
+
+checks:
+  - malformed rows (field count, hex values, zero length) and orphaned "@" rows not preceded by a game alias
+  - sentinel and prefill values wider than a byte (the plugins compare them with a single byte read)
+  - address spaces other than "program" in console entries (unsupported by the companion)
+  - overlapping or duplicated regions in the same entry
+  - regions outside of the RAM of the system
+  - the same alias used by more than one entry of a file (only the 1st one is ever matched),
+    the aliases of a later file overriding an earlier one are only reported as info
+  - malformed ";%decode" lines, or decoded fields beyond the .hi image
+
+usage:
+  hiscore_lint.py [DAT_PATH ...]   # default: the HISCORE_DAT_PATH list, plus MAME_HISCORE_DAT_PATH if set
+exit status is 1 if any error was found.
+"""
+
+import sys
+import os
+import re
+import logging
+
+from hiscore_dat import HISCORE_DAT_PATHS, normalize_alias, parse_dat_file
+from hiscore_decode import ScoreTable
+
+MAME_HISCORE_DAT_PATH = os.getenv("MAME_HISCORE_DAT_PATH")
+
+# program space RAM ranges for each system, as ( start, end ) with end excluded
+RAM_BOUNDS = {}
+for systems, bounds in [
+	( [ "nes", "famicom", "nespal", "fds" ], [ ( 0x0000, 0x0800 ), ( 0x6000, 0x8000 ) ] ),
+	( [ "snes", "snespal" ], [ ( 0x0000, 0x20000 ), ( 0x7e0000, 0x800000 ) ] ),
+	( [ "genesis", "megadriv", "megadrij", "segacd", "32x" ], [ ( 0x0000, 0x10000 ), ( 0xff0000, 0x1000000 ) ] ),
+	( [ "sms", "smsj", "smspal", "gamegear", "gamegeaj" ], [ ( 0xc000, 0x10000 ) ] ),
+	( [ "gameboy", "gbcolor", "supergb" ], [ ( 0xa000, 0xe000 ), ( 0xff80, 0xffff ) ] ),
+	( [ "pce", "tg16", "sgx" ], [ ( 0x0000, 0x2000 ), ( 0x1f0000, 0x1f8000 ) ] ),
+]:
+	for system in systems:
+		RAM_BOUNDS[system] = bounds
+
+HEX_RE = re.compile(r'^[0-9a-fA-F]+$')
+
+
+def check_row(entry, line_number, row, systems, messages):
+	""" returns ( cputag, space, start, end ) of the region, or None when the row is malformed """
+	def report(level, message):
+		messages.append(( level, entry.source, line_number, message ))
+
+	if row.startswith("@delay="):
+		return None
+	fields = row[1:].split(",")
+	if len(fields) < 6 or len(fields) > 7:
+		report("error", "expected 6 or 7 fields, found " + str(len(fields)))
+		return None
+	cputag, space = fields[0], fields[1]
+	values = []
+	for field_name, field in zip([ "address", "length", "start byte", "end byte", "prefill" ], fields[2:]):
+		field = field.strip()
+		if field_name == "prefill" and field == "":
+			continue
+		if not HEX_RE.match(field):
+			report("error", "malformed hex " + field_name + ": '" + field + "'")
+			return None
+		value = int(field, 16)
+		if field_name in [ "start byte", "end byte", "prefill" ] and value > 0xff:
+			report("error", field_name + " " + field + " is wider than a byte")
+		values.append(value)
+	address, length = values[0], values[1]
+	if length == 0:
+		report("error", "zero length region")
+		return None
+
+	ram_bounds = [ bounds for system in systems if system in RAM_BOUNDS for bounds in RAM_BOUNDS[system] ]
+	if ram_bounds:
+		if space != "program":
+			report("error", "unsupported address space for a console: " + space)
+		elif not any(start <= address and address + length <= end for start, end in ram_bounds):
+			report("warning", "region %x-%x is outside of the RAM" % (address, address + length - 1))
+	return ( cputag, space, address, address + length )
+
+
+def check_entry(entry, messages):
+	systems = set(alias.split(",", 1)[0] for alias in entry.aliases if "," in alias)
+	regions = []
+	for line_number, row in zip(entry.row_lines, entry.rows):
+		region = check_row(entry, line_number, row, systems, messages)
+		if region is not None:
+			regions.append(( region, line_number ))
+
+	# interval sweep: sorted by start, a region overlaps if it starts before the furthest end seen so far
+	regions.sort()
+	previous = None
+	for region, line_number in regions:
+		cputag, space, start, end = region
+		if previous is not None and previous[0][0:2] == ( cputag, space ):
+			if previous[0] == region:
+				messages.append(( "error", entry.source, line_number, "duplicated region (also at line " + str(previous[1]) + ")" ))
+			elif start < previous[0][3]:
+				messages.append(( "error", entry.source, line_number, "region %x-%x overlaps the one at line %d" % (start, end - 1, previous[1]) ))
+		if previous is None or previous[0][0:2] != ( cputag, space ) or end > previous[0][3]:
+			previous = ( region, line_number )
+
+	image_length = sum(end - start for ( cputag, space, start, end ), line_number in regions)
+	for line_number, directive in zip(entry.decoder_lines, entry.decoders):
+		try:
+			table = ScoreTable(directive)
+		except ValueError as e:
+			messages.append(( "error", entry.source, line_number, "malformed decode line: " + str(e) ))
+			continue
+		if table.size > image_length:
+			messages.append(( "error", entry.source, line_number, "decoded fields need %d bytes, the .hi image is %d" % (table.size, image_length) ))
+
+
+def lint(dat_paths):
+	""" returns a list of ( level, path, line number, message ) """
+	messages = []
+	aliases_seen = {}  # normalized alias -> ( DatEntry, line number )
+	for path in dat_paths:
+		for entry in parse_dat_file(path, messages):
+			check_entry(entry, messages)
+			for line_number, alias in zip(entry.alias_lines, entry.aliases):
+				key = normalize_alias(alias)
+				if key in aliases_seen:
+					other_entry, other_line_number = aliases_seen[key]
+					if other_entry is entry:
+						messages.append(( "warning", path, line_number, "alias '" + alias + "' repeated in the same entry (line " + str(other_line_number) + ")" ))
+					elif other_entry.source == path:
+						messages.append(( "error", path, line_number, "alias '" + alias + "' already used at line " + str(other_line_number) ))
+					else:
+						# a later dat file in HISCORE_DAT_PATH is an intentional override
+						messages.append(( "info", path, line_number, "alias '" + alias + "' overrides " + other_entry.source + ":" + str(other_line_number) ))
+						aliases_seen[key] = ( entry, line_number )
+				else:
+					aliases_seen[key] = ( entry, line_number )
+	return messages
+
+
+if __name__ == '__main__':
+	dat_paths = sys.argv[1:]
+	if not dat_paths:
+		dat_paths = list(HISCORE_DAT_PATHS)
+		if MAME_HISCORE_DAT_PATH and not MAME_HISCORE_DAT_PATH in dat_paths:
+			dat_paths.append(MAME_HISCORE_DAT_PATH)
+	messages = lint(dat_paths)
+	messages.sort(key=lambda message: ( message[1], message[2] ))
+	for level, path, line_number, message in messages:
+		print(path + ":" + str(line_number) + ": " + level + ": " + message)
+	errors = sum(1 for message in messages if message[0] == "error")
+	warnings = sum(1 for message in messages if message[0] == "warning")
+	logging.info(str(errors) + " errors, " + str(warnings) + " warnings")
+	sys.exit(1 if errors else 0)
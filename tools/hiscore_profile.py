@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+opt-in profiling hooks for state2hi.py and the retroarch companion.
+
+set HISCORE_PROFILE to a comma-separated list of:
+  timers       per-phase timers (decompress, header dispatch, byteswap, dat lookup, region extraction, network round trips, file I/O)
+  cprofile     a .pstats file for every section (a converted file or a poll cycle), read it with: python -m pstats FILE
+  tracemalloc  a .tracemalloc.txt report for every section with the peak and the top allocations
+  all          all of the above
+the reports are written in HISCORE_PROFILE_DIR (default: the current dir).
+
+when HISCORE_PROFILE is not set, timed() returns the undecorated function and instrument() does nothing, so there is no overhead.
+
+Usage:
+  @timed("decompress")
+  def unpack_statedata(statedata): ...
+
+  with phase("file_write"): ...
+  with section("poll"): ...   # a report for each section
+  instrument(retroarch, [ "read_core_ram" ], "network_")   # time the methods of an instance
+"""
+
+import os
+import time
+import logging
+import threading
+import contextlib
+
+HISCORE_PROFILE = os.getenv("HISCORE_PROFILE", "")
+HISCORE_PROFILE_DIR = os.getenv("HISCORE_PROFILE_DIR", ".")
+
+PROFILE_MODES = set(mode.strip() for mode in HISCORE_PROFILE.lower().split(",") if mode.strip())
+if "all" in PROFILE_MODES or "1" in PROFILE_MODES:
+	PROFILE_MODES.update([ "timers", "cprofile", "tracemalloc" ])
+ENABLED = bool(PROFILE_MODES)
+TIMERS = "timers" in PROFILE_MODES
+CPROFILE = "cprofile" in PROFILE_MODES
+TRACEMALLOC = "tracemalloc" in PROFILE_MODES
+
+# stop writing the per-section reports after this many (e.g. a long companion session)
+MAX_SECTION_REPORTS = 200
+TRACEMALLOC_TOP = 10
+
+_lock = threading.Lock()
+_timers = {}  # phase -> [ count, total secs, max secs ]
+_section_counts = {}  # section name -> reports written
+_null_context = contextlib.nullcontext()
+
+if TRACEMALLOC:
+	import tracemalloc
+	tracemalloc.start()
+
+
+def add_time(name, secs):
+	with _lock:
+		timer = _timers.setdefault(name, [ 0, 0.0, 0.0 ])
+		timer[0] += 1
+		timer[1] += secs
+		timer[2] = max(timer[2], secs)
+
+
+@contextlib.contextmanager
+def _phase(name):
+	started = time.perf_counter()
+	try:
+		yield
+	finally:
+		add_time(name, time.perf_counter() - started)
+
+
+def phase(name):
+	""" context manager timing a block """
+	if not TIMERS:
+		return _null_context
+	return _phase(name)
+
+
+def timed(name):
+	""" decorator timing every call of a function, the function is returned as-is when the timers are disabled """
+	def decorator(function):
+		if not TIMERS:
+			return function
+		def wrapper(*args, **kwargs):
+			started = time.perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				add_time(name, time.perf_counter() - started)
+		wrapper.__name__ = function.__name__
+		wrapper.__doc__ = function.__doc__
+		return wrapper
+	return decorator
+
+
+def instrument(obj, method_names, prefix=""):
+	""" replace the passed methods of an instance with timed ones """
+	if not TIMERS:
+		return
+	for method_name in method_names:
+		setattr(obj, method_name, timed(prefix + method_name)(getattr(obj, method_name)))
+
+
+def get_timers():
+	""" returns a dict: phase -> ( count, total secs, max secs ) """
+	with _lock:
+		return { name: tuple(timer) for name, timer in _timers.items() }
+
+
+def format_timers(timers, previous=None):
+	""" one line per phase, previous is a get_timers() result to report only the difference """
+	lines = []
+	for name in sorted(timers):
+		count, total, max_secs = timers[name]
+		if previous and name in previous:
+			count -= previous[name][0]
+			total -= previous[name][1]
+		if count == 0:
+			continue
+		lines.append("  %-30s %6d calls %10.2fms total %8.2fms avg" % (name, count, total * 1000, total * 1000 / count))
+	return lines
+
+
+@contextlib.contextmanager
+def _section(name):
+	with _lock:
+		number = _section_counts.get(name, 0) + 1
+		_section_counts[name] = number
+	if number > MAX_SECTION_REPORTS:
+		if number == MAX_SECTION_REPORTS + 1:
+			logging.info("profile: max reports reached for " + name + ", only the timers are collected from now on")
+		yield
+		return
+	label = "%s-%04d" % (name, number)
+	timers_before = get_timers() if TIMERS else None
+	profiler = None
+	if CPROFILE:
+		import cProfile
+		profiler = cProfile.Profile()
+	if TRACEMALLOC:
+		tracemalloc.reset_peak()
+		snapshot_before = tracemalloc.take_snapshot()
+	started = time.perf_counter()
+	if profiler is not None:
+		profiler.enable()
+	try:
+		yield
+	finally:
+		if profiler is not None:
+			profiler.disable()
+		elapsed = time.perf_counter() - started
+		lines = [ "profile " + label + ": %.2fms" % (elapsed * 1000) ]
+		if TIMERS:
+			lines += format_timers(get_timers(), timers_before)
+		if TRACEMALLOC:
+			# measured before writing the other reports
+			current, peak = tracemalloc.get_traced_memory()
+			top_stats = tracemalloc.take_snapshot().filter_traces([ tracemalloc.Filter(False, tracemalloc.__file__) ]).compare_to(snapshot_before, "lineno")
+			report_path = os.path.join(HISCORE_PROFILE_DIR, label + ".tracemalloc.txt")
+			with open(report_path, "w") as report_file:
+				report_file.write("peak: %d bytes, current: %d bytes\n" % (peak, current))
+				for stat in top_stats[0:TRACEMALLOC_TOP]:
+					report_file.write(str(stat) + "\n")
+			lines.append("  peak allocation %.1fKB, report written in %s" % (peak / 1024.0, report_path))
+		if profiler is not None:
+			pstats_path = os.path.join(HISCORE_PROFILE_DIR, label + ".pstats")
+			profiler.dump_stats(pstats_path)
+			lines.append("  cProfile stats written in " + pstats_path)
+		logging.info("\n".join(lines))
+
+
+def section(name):
+	""" context manager writing the reports of a unit of work (a converted file, a poll cycle) """
+	if not ENABLED:
+		return _null_context
+	return _section(name)
+
+
+def report():
+	""" log the totals of all the timers """
+	if not TIMERS:
+		return
+	lines = format_timers(get_timers())
+	if lines:
+		logging.info("\n".join([ "profile totals:" ] + lines))
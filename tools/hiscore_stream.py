@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+live export of the hiscore regions read by the retroarch companion, for external tools (leaderboards, overlays...).
+
+the companion publishes its region snapshots on a local Unix socket (set HISCORE_STREAM_PATH), so any number of
+consumers can subscribe without sending more commands to Retroarch.
+a frame is sent only when the data changes, new consumers receive the last frame as soon as they connect.
+consumers that do not keep up are disconnected instead of blocking the companion.
+
+frame format (little endian):
+  header: magic "HISC", version (u8), kind (u8), payload length (u32)
+  SNAPSHOT payload: sequence (u32), unix time (f64), system id, content name, crc32 (each as u16 length + utf-8),
+    region count (u16), then for each region: address (u32), length (u32), the region bytes
+  UNLOADED payload: sequence (u32), unix time (f64)
+consumers must skip the frames with an unknown kind, and reconnect on a version they do not support.
+
+usage:
+  hiscore_stream.py listen [SOCKET_PATH]   # print the frames (default: HISCORE_STREAM_PATH)
+"""
+
+import sys
+import os
+import stat
+import time
+import socket
+import struct
+import logging
+import selectors
+import threading
+
+HISCORE_STREAM_PATH = os.getenv("HISCORE_STREAM_PATH")
+
+FRAME_MAGIC = b"HISC"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sBBI")
+FRAME_SNAPSHOT = 1
+FRAME_UNLOADED = 2
+
+# max bytes queued for a single consumer, slower consumers are dropped
+MAX_CONSUMER_BACKLOG = 256 * 1024
+MAX_CONSUMERS = 32
+
+
+def pack_string(value):
+	data = value.encode('utf-8')
+	return struct.pack("<H", len(data)) + data
+
+
+def unpack_string(payload, offset):
+	length, = struct.unpack_from("<H", payload, offset)
+	offset += 2
+	return payload[offset:offset + length].decode('utf-8', 'replace'), offset + length
+
+
+def make_frame(kind, payload):
+	return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, kind, len(payload)) + payload
+
+
+def pack_snapshot(system_id, content_name, crc32, regions, region_snapshots):
+	""" the SNAPSHOT payload without the sequence and time, regions is a list of [ address, length, ... ] """
+	parts = [ pack_string(system_id), pack_string(content_name), pack_string(crc32), struct.pack("<H", len(regions)) ]
+	for region, data in zip(regions, region_snapshots):
+		parts.append(struct.pack("<II", region[0], len(data)))
+		parts.append(data)
+	return b"".join(parts)
+
+
+def parse_frame(kind, payload):
+	""" returns a dict with the decoded fields """
+	sequence, frame_time = struct.unpack_from("<Id", payload, 0)
+	frame = { "kind": kind, "sequence": sequence, "time": frame_time }
+	if kind != FRAME_SNAPSHOT:
+		return frame
+	offset = 12
+	frame["system_id"], offset = unpack_string(payload, offset)
+	frame["content_name"], offset = unpack_string(payload, offset)
+	frame["crc32"], offset = unpack_string(payload, offset)
+	region_count, = struct.unpack_from("<H", payload, offset)
+	offset += 2
+	frame["regions"] = []
+	for i in range(region_count):
+		address, length = struct.unpack_from("<II", payload, offset)
+		offset += 8
+		frame["regions"].append(( address, payload[offset:offset + length] ))
+		offset += length
+	return frame
+
+
+def read_frames(sock):
+	""" consumer side: yields ( kind, payload ) for every frame received from the socket """
+	buf = b""
+	while True:
+		data = sock.recv(65536)
+		if not data:
+			return
+		buf += data
+		while len(buf) >= FRAME_HEADER.size:
+			magic, version, kind, length = FRAME_HEADER.unpack_from(buf)
+			if magic != FRAME_MAGIC or version != FRAME_VERSION:
+				raise ValueError("unsupported stream version: " + str(magic) + " " + str(version))
+			if len(buf) < FRAME_HEADER.size + length:
+				break
+			yield kind, buf[FRAME_HEADER.size:FRAME_HEADER.size + length]
+			buf = buf[FRAME_HEADER.size + length:]
+
+
+class SnapshotPublisher(threading.Thread):
+
+	"""Usage:
+	publisher = SnapshotPublisher("/tmp/hiscore.sock")
+	publisher.start()
+	publisher.publish_snapshot("nes", "Super Mario Bros. (W) [!]", "d445f698", regions, region_snapshots)  # never blocks
+	publisher.publish_unloaded()
+	publisher.close()
+
+	the frames are only queued by the callers, the socket I/O is done in this thread.
+	"""
+
+	def __init__(self, path=HISCORE_STREAM_PATH):
+		threading.Thread.__init__(self, name="stream", daemon=True)
+		self.path = path
+		if os.path.lexists(self.path):
+			if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+				raise ValueError("not a socket, refusing to replace: " + self.path)
+			# only a stale socket from a previous run is replaced, not the one of a running companion
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(self.path)
+			except ConnectionRefusedError:
+				os.unlink(self.path)
+			else:
+				raise ValueError("socket already in use by another process: " + self.path)
+			finally:
+				probe.close()
+		self.sequence = 0
+		self.dropped = 0
+		self._lock = threading.Lock()
+		self._consumers = {}  # socket -> bytearray of pending data
+		self._last_data = None  # last published payload, without sequence and time
+		self._last_frame = None
+		self._closing = False
+		self._selector = selectors.DefaultSelector()
+		# a socket pair to wake up the select() when new data is queued
+		self._wakeup_recv, self._wakeup_send = socket.socketpair()
+		self._wakeup_recv.setblocking(False)
+		self._wakeup_send.setblocking(False)
+
+		self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self._server.bind(self.path)
+		self._server.listen(MAX_CONSUMERS)
+		self._server.setblocking(False)
+		self._selector.register(self._server, selectors.EVENT_READ)
+		self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+		logging.info("streaming the hiscore regions on " + self.path)
+
+	def publish_snapshot(self, system_id, content_name, crc32, regions, region_snapshots):
+		""" queue a SNAPSHOT frame for all the consumers, if the data was changed since the last one """
+		self._publish(FRAME_SNAPSHOT, pack_snapshot(system_id, content_name, crc32, regions, region_snapshots))
+
+	def publish_unloaded(self):
+		self._publish(FRAME_UNLOADED, b"")
+
+	def _publish(self, kind, data):
+		with self._lock:
+			if ( kind, data ) == self._last_data:
+				return
+			self._last_data = ( kind, data )
+			self.sequence += 1
+			self._last_frame = make_frame(kind, struct.pack("<Id", self.sequence, time.time()) + data)
+			for sock, pending in self._consumers.items():
+				pending += self._last_frame
+		self._wakeup()
+
+	def _wakeup(self):
+		try:
+			self._wakeup_send.send(b"\0")
+		except BlockingIOError:
+			pass  # already awake
+
+	def _drop(self, sock, reason):
+		logging.info("stream consumer dropped: " + reason)
+		self.dropped += 1
+		self._selector.unregister(sock)
+		del self._consumers[sock]
+		sock.close()
+
+	def run(self):
+		while not self._closing:
+			for key, events in self._selector.select(timeout=1):
+				sock = key.fileobj
+				if sock is self._server:
+					self._accept()
+				elif sock is self._wakeup_recv:
+					try:
+						while self._wakeup_recv.recv(4096):
+							pass
+					except BlockingIOError:
+						pass
+				elif events & selectors.EVENT_READ:
+					# consumers are not expected to send anything, a read only detects the disconnections
+					try:
+						data = sock.recv(4096)
+					except OSError:
+						data = b""
+					if not data:
+						with self._lock:
+							self._drop(sock, "disconnected")
+			self._flush()
+		# end while
+		with self._lock:
+			for sock in list(self._consumers):
+				self._drop(sock, "shutdown")
+
+	def _accept(self):
+		try:
+			sock, addr = self._server.accept()
+		except BlockingIOError:
+			return
+		with self._lock:
+			if len(self._consumers) >= MAX_CONSUMERS:
+				sock.close()
+				logging.warning("too many stream consumers, connection refused")
+				return
+			sock.setblocking(False)
+			# the last frame is sent right away, so the new consumer does not wait for the next change
+			self._consumers[sock] = bytearray(self._last_frame or b"")
+			self._selector.register(sock, selectors.EVENT_READ)
+		logging.info("stream consumer connected")
+
+	def _flush(self):
+		""" send the pending data with non-blocking writes, drop the consumers lagging behind """
+		with self._lock:
+			for sock, pending in list(self._consumers.items()):
+				if not pending:
+					continue
+				try:
+					sent = sock.send(pending)
+					del pending[:sent]
+				except BlockingIOError:
+					pass
+				except OSError as e:
+					self._drop(sock, str(e))
+					continue
+				if len(pending) > MAX_CONSUMER_BACKLOG:
+					self._drop(sock, "too slow (" + str(len(pending)) + " bytes pending)")
+				elif pending:
+					self._selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+				else:
+					self._selector.modify(sock, selectors.EVENT_READ)
+
+	def close(self):
+		self._closing = True
+		self._wakeup()
+		if self.is_alive():
+			self.join(timeout=2)
+		self._selector.close()
+		self._server.close()
+		self._wakeup_recv.close()
+		self._wakeup_send.close()
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+# end of SnapshotPublisher
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] != "listen" or (len(sys.argv) < 3 and not HISCORE_STREAM_PATH):
+		print("usage: hiscore_stream.py listen [SOCKET_PATH]")
+		sys.exit(1)
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.connect(sys.argv[2] if len(sys.argv) >= 3 else HISCORE_STREAM_PATH)
+	try:
+		for kind, payload in read_frames(sock):
+			if kind not in [ FRAME_SNAPSHOT, FRAME_UNLOADED ]:
+				continue
+			frame = parse_frame(kind, payload)
+			if kind == FRAME_UNLOADED:
+				print("#%d content unloaded" % frame["sequence"])
+				continue
+			print("#%d %s,%s crc32=%s" % (frame["sequence"], frame["system_id"], frame["content_name"], frame["crc32"]))
+			for address, data in frame["regions"]:
+				print("  %x: %s" % (address, data.hex()))
+	except KeyboardInterrupt:
+		pass
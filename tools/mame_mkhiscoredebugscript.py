@@ -1,109 +1,155 @@
 #!/usr/bin/python
 
-import sys
+# generate MAME debugger scripts dumping the .hi files of the games in the dat files listed in HISCORE_DAT_PATH
+# usage: mame_mkhiscoredebugscript.py [-o OUT_DIR] GAME_NAME [GAME_NAME ...]
+#        mame_mkhiscoredebugscript.py [-o OUT_DIR] all
+# GAME_NAME is an alias as found in the dat, e.g. "1942" or "nes,smb"
+# then: mame -debug -debugscript 1942.mamedebug 1942
 
-REQ_GAME_NAME=sys.argv[1]
-
-OUTFILE_PATH=REQ_GAME_NAME + ".mamedebug"
-
-HISCORE_PATH="/home/andy/.mame/dats/hiscore.dat"
-
-hiscore_file = open(HISCORE_PATH)
-
-hiscore_rows_to_process = []
-
-while(True):
-	line = hiscore_file.readline()
-	
-	if not line:
-		# EOF
-		break 
-	elif line.strip() == "":
-		# line was empty
-		continue
-		     
-	line = line.strip()
-	if line.startswith(";"):
-		continue
-	if line.endswith(":"):
-		# check if game matches
-		line_gamename = line.split(':')[0]
-		if not line_gamename == REQ_GAME_NAME:
+import sys
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from hiscore_dat import get_default_dat
+from state2hi import parse_hiscore_row
+
+# debugger commands for each address space: ( watchpoint, save, fill, byte accessor in the expressions )
+SPACE_COMMANDS = {
+	"program": ( "wp", "save", "fill", "b@" ),
+	"data": ( "wpd", "saved", "filld", "db@" ),
+	"io": ( "wpi", "savei", "filli", "ib@" ),
+}
+
+
+def get_script_name(alias):
+	""" the .hi file name used by the MAME plugin: the software name for softlists, the romname for arcade games """
+	name = alias.split(",", 1)[-1]
+	return name.replace("/", "_").replace("\\", "_")
+
+
+def make_debugscript(script_name, rows):
+	"""
+	returns a tuple: the debugger script (str), the single debugger command (str)
+	every region is saved in its own -partNN.hi file once both its sentinel bytes are in place (same check as the plugin)
+	"""
+	prefill_commands = []  # list of ( cputag, command )
+	watch_commands = []
+	single_debugger_command = ""
+	row_counter = 0
+	for row in rows:
+		if row.startswith("@delay"):
 			continue
-		# else reads the hiscore rows
-		while(True):
-			line = hiscore_file.readline()
-			if line.strip() == "":
-				# end of codes
-				break
-			if not line.startswith("@"):
-				# comments?
+		if len(row.split(",")) < 6:
+			raise ValueError("malformed row: " + row)
+		cputag, addresspace, address, length, start_byte, end_byte, prefill = parse_hiscore_row(row)
+		cputag = cputag.lstrip(":")
+		if not addresspace in SPACE_COMMANDS:
+			raise ValueError("unsupported address space: " + addresspace)
+		watch_command, save_command, fill_command, accessor = SPACE_COMMANDS[addresspace]
+		row_counter += 1
+		part_filename = script_name + ("-part%.2d" % row_counter) + ".hi"
+		end_address = address + length - 1
+
+		if prefill is not None:
+			# the plugin fills the region at start, so the sentinels are only matched after the game wrote its table
+			prefill_commands.append(( cputag, fill_command + " %x,%x,%x" % (address, length, prefill) ))
+
+		condition = "(%s%x==%x && %s%x==%x)" % (accessor, address, start_byte, accessor, end_address, end_byte)
+		save = save_command + " %s,%x,%x" % (part_filename, address, length)
+		watch_commands.append(( cputag, watch_command + " %x,%x,w,%s,{%s; g}" % (address, length, condition, save) ))
+		single_debugger_command += save + "; "
+	# end for
+
+	script_lines = []
+	current_cputag = None
+	for cputag, command in prefill_commands + watch_commands:
+		# the commands apply to the focused cpu
+		if cputag != current_cputag:
+			script_lines.append("focus " + cputag)
+			current_cputag = cputag
+		script_lines.append(command)
+	script_lines.append("g")
+	return "\n".join(script_lines) + "\n", single_debugger_command + "g"
+
+
+def write_debugscript(out_dir, script_name, rows):
+	""" returns a tuple: the written path, the single debugger command, the number of parts """
+	script, single_debugger_command = make_debugscript(script_name, rows)
+	out_path = os.path.join(out_dir, script_name + ".mamedebug")
+	with open(out_path, "w") as outfile:
+		outfile.write(script)
+	return out_path, single_debugger_command, len([ row for row in rows if not row.startswith("@delay") ])
+
+
+def is_crc32_alias(alias):
+	return alias.split(",", 1)[-1].startswith("crc32=")
+
+
+def find_entries(hiscore_dat, game_names):
+	""" returns a list of ( script name, DatEntry ), "all" returns every entry in the same order of the dat files """
+	if game_names == [ "all" ]:
+		entries = sorted(hiscore_dat.entries(), key=lambda entry: ( hiscore_dat.paths.index(entry.source), entry.line_number ))
+		requested = [ ( None, entry ) for entry in entries ]
+	else:
+		requested = []
+		for game_name in game_names:
+			entry = hiscore_dat.get(game_name)
+			if entry is None:
+				logging.error("nothing found for: " + game_name)
 				continue
-			# else
-			hiscore_rows_to_process.append(line.strip())
-		# end while
-	# end if
-# end while
-
-if len(hiscore_rows_to_process)==0:
-	print("nothing found!")
-	sys.exit(1)
-
-# else
-
-outfile = open(OUTFILE_PATH, "w")
-
-#conditions = []
-# sample output: "wp ffe108,cc,w,(maincpu.b@FFE108==00 && maincpu.b@FFFE1D3==41),{save thunderl.hi,ffe108,cc; g}"
-single_debugger_command = ""
-
-print("written output file: ")
-
-row_counter = 0
-for row in hiscore_rows_to_process:
-	splitted_row = row.split(",")
-	cputag = splitted_row[0].split(":")[1]
-	addresspace = splitted_row[1]
-	if not addresspace=="program":
-		print("unsupported: " + addresspace)
+			requested.append(( game_name, entry ))
+
+	found = []
+	script_names = set()
+	for game_name, entry in requested:
+		if game_name is None or is_crc32_alias(game_name):
+			# name the script after the 1st alias that is not a crc32
+			game_name = ([ alias for alias in entry.aliases if not is_crc32_alias(alias) ] + entry.aliases)[0]
+		script_name = get_script_name(game_name)
+		if script_name in script_names:
+			# same software name in more systems
+			script_name = game_name.replace(",", "_").replace("/", "_").replace("\\", "_")
+		script_names.add(script_name)
+		found.append(( script_name, entry ))
+	return found
+
+
+if __name__ == '__main__':
+	logging.getLogger().setLevel(logging.INFO)
+	args = sys.argv[1:]
+	out_dir = "."
+	if len(args) >= 2 and args[0] == "-o":
+		out_dir = args[1]
+		args = args[2:]
+	if len(args) == 0:
+		print("usage: mame_mkhiscoredebugscript.py [-o OUT_DIR] GAME_NAME [GAME_NAME ...]")
+		print("       mame_mkhiscoredebugscript.py [-o OUT_DIR] all")
 		sys.exit(1)
-	address = splitted_row[2]
-	length = splitted_row[3]
-	start_byte = splitted_row[4]
-	end_byte = splitted_row[5]
-	if len(splitted_row)==7:
-		print("unsupported: prefill")
+	if not os.path.isdir(out_dir):
+		os.makedirs(out_dir)
+
+	# a single pass over the dat files, then all the scripts are written in parallel
+	entries = find_entries(get_default_dat(), args)
+	if len(entries)==0:
+		print("nothing found!")
 		sys.exit(1)
-		#prefill = splitted_row[6]
-	
-	output_line = "wp " + address + "," + length + ",rw,"
-	
-	#2FIX: adds the conditions: start conditon
-	#output_line += "(" + cputag + ".w@" + address + "==" + start_byte
-	
-	#2FIX: end condition
-	#end_address = str(format(int(address, 16) + int(length, 16) - 1, "x"))
-	#output_line += " && " + cputag + ".w@" + end_address + "==" + end_byte + ")"
-	output_line += "1"
-	
-	# output file
-	row_counter += 1
-	output_line += ",{save " + REQ_GAME_NAME + ("-part%.2d" % row_counter) + ".hi," + address + "," + length + "; g}"
-	single_debugger_command += "save " + REQ_GAME_NAME + ("-part%.2d" % row_counter) + ".hi," + address + "," + length + "; "
-	
-	print(output_line)
-	outfile.write(output_line+"\n")
-# end for
-
-outfile.write("g\n")
-
-print("")
-single_debugger_command += "g"
-print("single debugger command: " + single_debugger_command)
-print("")
-
-print("tip: use with: mame139 -v -debug -debugscript " + REQ_GAME_NAME + ".mamedebug "  + REQ_GAME_NAME)
-if len(hiscore_rows_to_process)>1:
-	print("then: cat " + REQ_GAME_NAME + "-part*.hi > " + REQ_GAME_NAME + ".hi")
-	
-	
+
+	results = []
+	with ThreadPoolExecutor() as executor:
+		futures = [ ( script_name, executor.submit(write_debugscript, out_dir, script_name, entry.rows) ) for script_name, entry in entries ]
+		for script_name, future in futures:
+			try:
+				results.append(( script_name, ) + future.result())
+			except ValueError as e:
+				logging.error(script_name + ": " + str(e))
+
+	for script_name, out_path, single_debugger_command, parts in results:
+		print("written output file: " + out_path)
+		if len(results) == 1:
+			print("single debugger command: " + single_debugger_command)
+			print("tip: use with: mame -v -debug -debugscript " + out_path + " " + script_name)
+			if parts > 1:
+				print("then: cat " + script_name + "-part*.hi > " + script_name + ".hi")
+	if len(results) > 1:
+		logging.info(str(len(results)) + " scripts written in " + out_dir)
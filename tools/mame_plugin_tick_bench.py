@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+replay of hiscore region traces through a model of the MAME plugin change detection, old vs new.
+
+  old: on every frame the bytes of all the regions are summed with a read_u8 call each
+  new: every CHECK_INTERVAL frames the regions are read with a single read_range call each and compared as strings
+
+the per-frame cost is reported as memory API calls and time, along with the detected score changes
+(a sum misses the changes keeping the same sum, e.g. swapped name letters).
+
+usage:
+  mame_plugin_tick_bench.py [--game ALIAS] [--frames N]   # synthetic trace for a dat entry (default: the one with the biggest regions)
+  mame_plugin_tick_bench.py --trace SESSION.trace          # regions read by the companion in a trace recorded with HISCORE_TRACE_PATH
+"""
+
+import sys
+import time
+import random
+
+from hiscore_dat import get_default_dat
+from state2hi import parse_hiscore_row
+
+FPS = 60
+CHECK_INTERVAL = 30  # same default of the plugin
+SYNTHETIC_FRAMES = FPS * 60 * 5
+SCORE_CHANGE_EVERY = FPS * 20  # frames
+RANDOM_SEED = 0x38
+
+
+class MemorySpace(object):
+	""" a model of the MAME address space, counting the API calls """
+
+	def __init__(self, size):
+		self.ram = bytearray(size)
+		self.calls = 0
+
+	def read_u8(self, address):
+		self.calls += 1
+		return self.ram[address]
+
+	def read_range(self, first, last, width):
+		self.calls += 1
+		return bytes(self.ram[first:last+1])
+
+
+class OldChangeDetector(object):
+
+	def __init__(self, mem, regions):
+		self.mem = mem
+		self.regions = regions
+		self.default_checksum = self.current_checksum = self.check_scores()
+
+	def check_scores(self):
+		r = 0
+		for address, size in self.regions:
+			for i in range(size):
+				r += self.mem.read_u8(address + i)
+		return r
+
+	def tick(self):
+		""" returns True when a save would be triggered """
+		return self.check_and_save()
+
+	def check_and_save(self):
+		""" also called on stop (reset() in the plugin) """
+		checksum = self.check_scores()
+		if checksum != self.current_checksum and checksum != self.default_checksum:
+			self.current_checksum = checksum
+			return True
+		return False
+
+
+class NewChangeDetector(OldChangeDetector):
+
+	def __init__(self, mem, regions, check_interval=CHECK_INTERVAL):
+		self.check_interval = check_interval
+		self.frames_since_check = 0
+		OldChangeDetector.__init__(self, mem, regions)
+
+	def check_scores(self):
+		return b"".join(self.mem.read_range(address, address + size - 1, 8) for address, size in self.regions)
+
+	def tick(self):
+		self.frames_since_check += 1
+		if self.frames_since_check < self.check_interval:
+			return False
+		self.frames_since_check = 0
+		return self.check_and_save()
+
+
+def get_entry_regions(alias=None):
+	""" returns a list of ( address, size ) """
+	hiscore_dat = get_default_dat()
+	if alias:
+		entry = hiscore_dat.get(alias)
+		if entry is None:
+			print("nothing found for: " + alias)
+			sys.exit(1)
+	else:
+		entries = list(hiscore_dat.entries())
+		if len(entries)==0:
+			print("no entries found in: " + ", ".join(hiscore_dat.paths) + " (check HISCORE_DAT_PATH)")
+			sys.exit(1)
+		entry = max(entries, key=lambda entry: sum(parse_hiscore_row(row)[3] for row in entry.rows if not row.startswith("@delay")))
+	print("regions of " + entry.aliases[0] + " (" + entry.source + ":" + str(entry.line_number) + ")")
+	regions = []
+	for row in entry.rows:
+		if row.startswith("@delay"):
+			continue
+		cputag, addresspace, address, length, start_byte, end_byte, prefill = parse_hiscore_row(row)
+		regions.append(( address, length ))
+	return regions
+
+
+def make_synthetic_trace(regions, frames=SYNTHETIC_FRAMES):
+	"""
+	returns a tuple: memory size, list of ( frame, address, new bytes ) writes, number of frames
+	scores change every SCORE_CHANGE_EVERY frames, every other change only swaps two bytes (same sum)
+	"""
+	rng = random.Random(RANDOM_SEED)
+	contents = { address: bytearray(rng.randbytes(size)) for address, size in regions }
+	writes = [ ( 0, address, bytes(data) ) for address, data in contents.items() ]
+	change = 0
+	for frame in range(SCORE_CHANGE_EVERY, frames, SCORE_CHANGE_EVERY):
+		address, size = regions[change % len(regions)]
+		data = contents[address]
+		if change % 2 and size >= 2:
+			# e.g. a name entered with swapped letters
+			i = rng.randrange(size - 1)
+			if data[i] == data[i+1]:
+				data[i] ^= 1
+				data[i+1] ^= 1
+			else:
+				data[i], data[i+1] = data[i+1], data[i]
+		else:
+			data[rng.randrange(size)] ^= 0xff
+		writes.append(( frame, address, bytes(data) ))
+		change += 1
+	return max(address + size for address, size in regions), writes, frames
+
+
+def read_trace_regions(trace_path):
+	""" returns a tuple: memory size, list of ( frame, address, bytes ) writes, number of frames """
+	from retroarch_trace import read_trace, KIND_REPLY
+	writes = []
+	last_frame = 0
+	memory_size = 0
+	for secs, kind, payload in read_trace(trace_path):
+		if kind != KIND_REPLY or not payload.startswith(b"READ_CORE_RAM "):
+			continue
+		fields = payload.split()
+		if len(fields) < 3 or fields[2] == b"-1":
+			continue
+		address = int(fields[1], 16)
+		data = bytes(int(value, 16) for value in fields[2:])
+		last_frame = int(secs * FPS)
+		writes.append(( last_frame, address, data ))
+		memory_size = max(memory_size, address + len(data))
+	return memory_size, writes, last_frame + 1
+
+
+def replay(detector_class, memory_size, regions, writes, frames):
+	"""
+	returns a tuple: memory API calls per frame, usecs per frame, saves triggered, max frames between a change and its save,
+	number of changes never saved (not even on stop)
+	"""
+	mem = MemorySpace(memory_size)
+	pending = list(writes)
+	# the initial contents are the defaults
+	while pending and pending[0][0] == 0:
+		frame, address, data = pending.pop(0)
+		mem.ram[address:address+len(data)] = data
+	detector = detector_class(mem, regions)
+	mem.calls = 0
+	saves = 0
+	max_latency = 0
+	unsaved_changes = []
+	started = time.perf_counter()
+	for frame in range(frames):
+		while pending and pending[0][0] <= frame:
+			frame_written, address, data = pending.pop(0)
+			if bytes(mem.ram[address:address+len(data)]) != data:
+				unsaved_changes.append(frame_written)
+				mem.ram[address:address+len(data)] = data
+		if detector.tick():
+			saves += 1
+			if unsaved_changes:
+				max_latency = max(max_latency, frame - unsaved_changes[0])
+			unsaved_changes = []
+	elapsed = time.perf_counter() - started
+	calls = mem.calls
+	if detector.check_and_save():
+		saves += 1
+		unsaved_changes = []
+	return calls / frames, elapsed * 1000000 / frames, saves, max_latency, len(unsaved_changes)
+
+
+if __name__ == '__main__':
+	if "--trace" in sys.argv:
+		memory_size, writes, frames = read_trace_regions(sys.argv[sys.argv.index("--trace") + 1])
+		regions = sorted(set(( address, len(data) ) for frame, address, data in writes))
+	else:
+		regions = get_entry_regions(sys.argv[sys.argv.index("--game") + 1] if "--game" in sys.argv else None)
+		frames = int(sys.argv[sys.argv.index("--frames") + 1]) if "--frames" in sys.argv else SYNTHETIC_FRAMES
+		memory_size, writes, frames = make_synthetic_trace(regions, frames)
+	changes = sum(1 for frame, address, data in writes if frame > 0)
+	print("%d frames, %d regions (%d bytes), %d writes" % (frames, len(regions), sum(size for address, size in regions), changes))
+
+	print("%-6s %12s %12s %6s %14s %14s" % ("", "calls/frame", "usecs/frame", "saves", "max latency", "never saved"))
+	for name, detector_class in [ ( "old", OldChangeDetector ), ( "new", NewChangeDetector ) ]:
+		calls, usecs, saves, max_latency, unsaved_changes = replay(detector_class, memory_size, regions, writes, frames)
+		print("%-6s %12.2f %12.2f %6d %8d frames %14d" % (name, calls, usecs, saves, max_latency, unsaved_changes))
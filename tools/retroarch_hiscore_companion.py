@@ -3,222 +3,925 @@
 
 # MEMO: RetroArch >= 1.8.5 is required
 # usage: enable `network_cmd_enable` in retroarch, set HISCORE_PATH and HISCORE_DAT_PATH in state2hi.py or the environ
+#
+# the companion runs as a small pipeline:
+#  - the network stage (a thread) owns the Retroarch connection: it polls the status and the hiscore regions and runs the queued commands
+#  - the logic stage (main thread) consumes the region snapshots from a bounded queue: game switches, hiscore injection, change detection
+#  - the disk stage (a single worker) resolves the games and reads/writes the .hi files
+# the region snapshots can also be streamed to external tools on a Unix socket (HISCORE_STREAM_PATH, see hiscore_stream.py)
+# in-flight saves are drained on exit (Ctrl+C or SIGTERM)
 
 import sys
 import os
 import logging
 import time
+import queue
+import signal
+import random
+import threading
 from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# opt-in phase timers and cProfile/tracemalloc reports for each poll cycle, set HISCORE_PROFILE (see hiscore_profile.py)
+import hiscore_profile
+from hiscore_profile import timed
 
 
 HISCORE_PATH_USE_SUBDIRS=False
 
 logging.getLogger().setLevel(logging.DEBUG)
 
-from retroarchpythonapi import RetroArchPythonApi
-while True:
+# sleep between polls to avoid sending too many read/write commands
+POLL_INTERVAL = 5
+INJECT_POLL_INTERVAL = 0.5  # faster polls while waiting for the sentinel bytes to inject a .hi file
+PROBE_TIMEOUT = 1  # secs
+NETWORK_TIMEOUT = 2  # secs, all the other round trips (e.g. READ_CORE_RAM) fail instead of blocking if Retroarch quits mid-poll
+# delay between reconnection attempts: doubles at every failure up to the max, with random jitter
+RECONNECT_MIN_DELAY = 0.1
+RECONNECT_MAX_DELAY = 1
+SNAPSHOT_QUEUE_SIZE = 4
+STATS_REPORT_INTERVAL = 60  # secs
+
+# path where .hi files will be loaded and saved, set in main()
+HISCORE_PATH = None
+
+# optional single-file store used in place of the .hi files (see hi_store.py)
+HISCORE_STORE_PATH = os.getenv("HISCORE_STORE_PATH")
+hiscore_store = None
+
+# optional Unix socket where the region snapshots are streamed to external tools (see hiscore_stream.py)
+HISCORE_STREAM_PATH = os.getenv("HISCORE_STREAM_PATH")
+
+
+def get_candidate_systems(reported_system_id):
+	""" detect the system from the core name """
+	candidate_systems = []
+	if reported_system_id in [ "Nestopia", "nes" ]:
+		candidate_systems = [ "nes", "famicom", "fds", "nespal" ]
+	elif reported_system_id == "super_nes":
+		candidate_systems = [ "snes", "snespal" ]
+	elif reported_system_id == "game_boy":
+		candidate_systems = [ "gameboy", "gbcolor", "supergb" ]
+	elif reported_system_id == "mega_drive":
+		candidate_systems = [ "genesis", "megadrij", "megadriv", "sms", "smsj", "smspal", "gamegear", "gamegeaj", "segacd" ]
+	elif reported_system_id == "pc_engine":
+		candidate_systems = [ "pce", "tg16", "sgx" ]
+	# TODO: more systems  http://www.progettoemma.net/mess/sysset.php
+	return candidate_systems
+
+
+@timed("file_read")
+def read_hiscore_file(hiscore_file_path, candidate_systems=None, content_name=""):
+	""" returns the .hi file contents, or None if it does not exist yet """
+	if candidate_systems is None:
+		candidate_systems = []
+	if hiscore_store is not None:
+		return hiscore_store.get_any(candidate_systems, content_name)
 	try:
-		retroarch = RetroArchPythonApi()
-		break
+		hiscore_file = open(hiscore_file_path, 'rb')
+		hiscore_file_data = hiscore_file.read()
+		logging.info("read hiscore file: " + hiscore_file_path + " len: " + str(len(hiscore_file_data)))
+		hiscore_file.close()
+		return hiscore_file_data
 	except:
-		logging.error("connection error, will retry in 2s...")
-		time.sleep(2)
-# end while
-
-# path where .hi files will be loaded and saved
-HISCORE_PATH = str(retroarch.get_config_param('savefile_directory'), 'utf-8')  # store hiscores in savefile_directory by default
-#HISCORE_PATH = os.path.expanduser("~/.mame/hi")
-if("HISCORE_PATH" in os.environ):
-	HISCORE_PATH = os.environ['HISCORE_PATH']
-
-hiscore_inited_in_ram = False
-prev_content_name = None
-hiscore_rows_to_process = []
-hiscore_file_bytesio = BytesIO()
-hiscore_file_path = ""
-
-
-while True: 
-	# wait for some content to be loaded
-	while not (retroarch.is_alive() and retroarch.has_content()):
-		hiscore_inited_in_ram = False
-		prev_content_name = None
-		time.sleep(5)
-	# end while
-	
-	curr_content_name = str(retroarch.get_content_name(), 'utf-8')
-	if not curr_content_name:
-		hiscore_inited_in_ram = False
-		prev_content_name = None
-		time.sleep(5)
-		continue
-	# end if
-	
-	# detect game change
-	if curr_content_name != prev_content_name:
-		prev_content_name = curr_content_name
-		
-		hiscore_inited_in_ram = False
-		
-		# detect the system from the core name
-		reported_system_id = str(retroarch.get_system_id(), 'utf-8')
+		return None
+
+
+@timed("file_write")
+def write_hiscore_file(hiscore_file_path, data, candidate_systems=None, content_name=""):
+	""" (over-)write the .hi file, returns True if it was created """
+	if candidate_systems is None:
 		candidate_systems = []
-		logging.debug("reported_system_id: " + reported_system_id)
-		if reported_system_id in [ "Nestopia", "nes" ]:
-			candidate_systems = [ "nes", "famicom", "fds", "nespal" ]
-		elif reported_system_id == "super_nes":
-			candidate_systems = [ "snes", "snespal" ]
-		elif reported_system_id == "game_boy":
-			candidate_systems = [ "gameboy", "gbcolor", "supergb" ]
-		elif reported_system_id == "mega_drive":
-			candidate_systems = [ "genesis", "megadrij", "megadriv", "sms", "smsj", "smspal", "gamegear", "gamegeaj", "segacd" ]
-		elif reported_system_id == "pc_engine":
-			candidate_systems = [ "pce", "tg16", "sgx" ]
-		# TODO: more systems  http://www.progettoemma.net/mess/sysset.php
-		
-		logging.debug("game was changed, looking hiscore data for " + curr_content_name + "...")
-
-		from state2hi import get_hiscore_rows_from_game
-		# TODO: remove deps
-		hiscore_rows_to_process = get_hiscore_rows_from_game(candidate_systems, curr_content_name)
-		if len(hiscore_rows_to_process)==0:
-			logging.error("nothing found in hiscore.dat for current game")
-			continue
-		else:
-			logging.debug("found hiscore patches")
+	if hiscore_store is not None:
+		system = hiscore_store.find_system(candidate_systems, content_name)
+		if system is None and not candidate_systems:
+			raise ValueError("unknown system, can not be written in the store: " + content_name)
+		return hiscore_store.put(system or candidate_systems[0], content_name, data)
+	#if HISCORE_PATH_USE_SUBDIRS and not os.path.exists(HISCORE_PATH + "/" + system):
+	#	os.mkdir(HISCORE_PATH + "/" + system)
+	created = not os.path.isfile(hiscore_file_path)
+	hiscore_file = open(hiscore_file_path, 'wb') # write+binary mode
+	hiscore_file.write(data)
+	hiscore_file.close()
+	return created
+
+
+def backup_hiscore_file(hiscore_file_path, data, content_name=""):
+	""" keep a copy of a .hi file that can not be loaded, before it is overwritten. returns the backup path """
+	if hiscore_store is not None:
+		# a loose file next to the store
+		hiscore_file_path = os.path.join(os.path.dirname(os.path.abspath(HISCORE_STORE_PATH)), content_name + ".hi")
+	backup_path = hiscore_file_path + ".bak"
+	backup_number = 1
+	while os.path.exists(backup_path):
+		# never replace an older backup
+		backup_number += 1
+		backup_path = hiscore_file_path + ".bak" + str(backup_number)
+	with open(backup_path, 'wb') as backup_file:
+		backup_file.write(data)
+	return backup_path
+
+
+@timed("dat_lookup")
+def resolve_game(reported_system_id, content_name, content_crc32):
+	""" slow path: lookup the game in the dat file and read its .hi file, returns a new hiscore cache entry, raises ValueError for unsupported rows """
+	candidate_systems = get_candidate_systems(reported_system_id)
 	
-		# try to read the .hi hiscore file
-		hiscore_file_data = None
-		#system = candidate_systems[0] # TODO: guess current system from ???
-		#if HISCORE_PATH_USE_SUBDIRS:
-		#	hiscore_file_path = HISCORE_PATH + "/" + system + "/" + curr_content_name + ".hi"
-		#else:
-		#	hiscore_file_path = HISCORE_PATH + "/" + curr_content_name + ".hi"
-		hiscore_file_path = HISCORE_PATH + "/" + curr_content_name + ".hi"
-		
-		try:
-			hiscore_file = open(hiscore_file_path, 'rb')
-			hiscore_file_data = hiscore_file.read()
-			logging.info("read hiscore file: " + hiscore_file_path + " len: " + str(len(hiscore_file_data)))
-			hiscore_file.close()
-			hiscore_file_bytesio = BytesIO(hiscore_file_data)  # keep a copy in memory
-		except:
-			logging.info("hiscore file not found, will be created...")
-			#logging.exception("")
-		
-		# DELETE
-		# if reported_system_id == "mega_drive":  # TODO: test core==genplusgx
-			# # need to byteswap hiscore_file_bytesio
-			# hiscore_file_bytesio_swapped_buf = hiscore_file_bytesio.getbuffer()
-			# hiscore_file_bytesio_len = hiscore_file_bytesio_swapped_buf.nbytes
-			# hiscore_file_bytesio = BytesIO(b"\x00" * hiscore_file_bytesio_len)  # zero fill init
-			# hiscore_file_bytesio_buf = hiscore_file_bytesio.getbuffer()
-			# for i in range(0, hiscore_file_bytesio_len-1, 2):
-				# hiscore_file_bytesio_buf[i] = hiscore_file_bytesio_swapped_buf[i+1]
-				# hiscore_file_bytesio_buf[i+1] = hiscore_file_bytesio_swapped_buf[i]
-			# #hiscore_file_bytesio.flush()
-			# hiscore_file_bytesio.seek(0)  # rewind
-		#end if reported_system_id == "mega_drive"
-	# end if game was changed
+	from state2hi import get_hiscore_rows_from_game, parse_hiscore_row
+	# TODO: remove deps
+	rows = get_hiscore_rows_from_game(candidate_systems, content_name)
+	if len(rows)==0 and content_crc32:
+		rows = get_hiscore_rows_from_game(candidate_systems, "crc32=" + content_crc32)
+	
+	# address translation for the current core
+	address_offset = 0
+	byteswap = False
+	if reported_system_id == "mega_drive":  # TODO: test core==genplusgx
+		address_offset = 0xff0000
+		byteswap = True
 	
-	curr_hiscore_in_ram_bytesio = BytesIO()  # read from live memory to here
-	for row in hiscore_rows_to_process:
-		logging.debug("processing: " + row)
-		splitted_row = row.split(",")
-		cputag = splitted_row[0].split(":")[1]
-		addresspace = splitted_row[1]
+	regions = []
+	for row in rows:
+		cputag, addresspace, address, length, start_byte, end_byte, prefill = parse_hiscore_row(row)
 		if not addresspace=="program":
-			logging.error("unsupported: " + addresspace)
-			sys.exit(1)
-		address = int(splitted_row[2], base=16)
-		length = int(splitted_row[3], base=16)
-		start_byte = int(splitted_row[4], base=16)
-		end_byte = int(splitted_row[5], base=16)
-		
+			raise ValueError("unsupported address space: " + addresspace)
 		# fix genesis address
-		if reported_system_id == "mega_drive" and address > 0xff0000:
-			address -= 0xff0000
-		
-		response_bytes = retroarch.read_core_ram(address, length)
-		#logging.debug(len(response_bytes))
-		#logging.debug(int(response_bytes[0], base=16))
-		#logging.debug(start_byte)
-		if response_bytes == [b'-1']:
-			logging.error("invalid address found in hiscore datfile (skipped): " + str(hex(address)))
-			break
-		
-		if response_bytes and len(response_bytes)>1 and reported_system_id == "mega_drive":  # TODO: test core==genplusgx
-			# need to byteswap response_bytes
-			response_bytes_swapped = list()
-			for i in range(0, len(response_bytes)-1, 2):
-				response_bytes_swapped.append(response_bytes[i+1])
-				response_bytes_swapped.append(response_bytes[i])
-			response_bytes = response_bytes_swapped
-			if ( len(response_bytes) % 2 ):
-				logging.warning("odd sizes prolly wont work well with this core due to swapping")
-				response_bytes.append(b'00')  # try to fix
-		#end if
-			
-		# 1st loop: check start_byte and end_byte, if the match the code and an hiscore file was read, init the memory
-		if hiscore_file_bytesio.getbuffer().nbytes > 0 and hiscore_inited_in_ram == False and response_bytes and int(response_bytes[0], base=16) == start_byte and int(response_bytes[-1], base=16) == end_byte:
-			logging.info("start_byte and end_byte matches, writing into core memory...")
-			# write data from hiscore_file_bytesio buffer
-			buf = hiscore_file_bytesio.read(length)
-			hiscore_file_bytesio.seek(0)  # rewind
-			
-			if reported_system_id == "mega_drive":  # TODO: test core==genplusgx
-				# need to byteswap buf before writing into memory
-				buf_swapped = buf   # TODO: faster method using bytearray() + append
-				buf = bytes()
-				for i in range(0, len(buf_swapped)-1, 2):
-					buf += bytes([ buf_swapped[i+1] ])
-					buf += bytes([ buf_swapped[i] ])
-				#if ( len(buf) % 2 ):
-				#	logging.warning("odd sizes prolly wont work well with this core due to swapping")
-				#	buf += bytes( b'00' )  # try to fix
-			# end if
-
-			if retroarch.write_core_ram(address, buf) == True:
-				# successfull memory write
-				buf = hiscore_file_bytesio.read(length)  # reload
-				curr_hiscore_in_ram_bytesio.seek(0)  # rewind
-				curr_hiscore_in_ram_bytesio.write(buf)
-				if row == hiscore_rows_to_process[-1]:
-					# TODO: check if all the rows were written
-					hiscore_inited_in_ram = True
-					retroarch.show_msg("Hiscore loaded")
-		
-		elif response_bytes:
-			# not the first loop
-			# append read bytes to curr_hiscore_in_ram_bytesio
-			for b in response_bytes:
-				curr_hiscore_in_ram_bytesio.write(bytes([ int(b, base=16) ] ))
-	# end for rows
+		if address_offset and address > address_offset:
+			address -= address_offset
+		regions.append([ address, length, start_byte, end_byte, prefill ])
+	
+	#system = candidate_systems[0] # TODO: guess current system from ???
+	#if HISCORE_PATH_USE_SUBDIRS:
+	#	hiscore_file_path = HISCORE_PATH + "/" + system + "/" + content_name + ".hi"
+	#else:
+	#	hiscore_file_path = HISCORE_PATH + "/" + content_name + ".hi"
+	hiscore_file_path = HISCORE_PATH + "/" + content_name + ".hi"
+	if hiscore_store is not None:
+		hiscore_file_path = HISCORE_STORE_PATH
 	
-	# check if hiscore data is changed
-	curr_hiscore_in_ram_bytesio.flush()
-	curr_hiscore_in_ram_bytesio.seek(0)  # rewind
-	#print(curr_hiscore_in_ram_bytesio.getvalue())
-	#print(hiscore_file_bytesio.getvalue())
-	curr_hiscore_in_ram_bytesio_value = curr_hiscore_in_ram_bytesio.getvalue()
-	if len(curr_hiscore_in_ram_bytesio_value) > 0 and bool(any(c != 0 for c in curr_hiscore_in_ram_bytesio_value)) and curr_hiscore_in_ram_bytesio_value != hiscore_file_bytesio.getvalue():
-		# (over-)write to the hiscore file
-		#if HISCORE_PATH_USE_SUBDIRS and not os.path.exists(HISCORE_PATH + "/" + system):
-		#	os.mkdir(HISCORE_PATH + "/" + system)
-		if not os.path.isfile(hiscore_file_path):
+	return {
+		"content_name": content_name,
+		"candidate_systems": candidate_systems,
+		"rows": rows,
+		"regions": regions,
+		"address_offset": address_offset,
+		"byteswap": byteswap,
+		"hiscore_file_path": hiscore_file_path,
+		"hiscore_file_data": read_hiscore_file(hiscore_file_path, candidate_systems, content_name) if rows else None
+	}
+
+
+class HiscoreInitState(object):
+
+	"""
+	per-region state machine used to inject a saved .hi file into the core memory.
+	every region maps to its own slice of the .hi file (offsets are the cumulative region lengths),
+	the writes are sent only when all the regions passed their start_byte/end_byte checks, then confirmed by reading them back.
+	"""
+
+	WAITING = 0  # start_byte/end_byte not matched yet
+	PASSED = 1  # sentinel bytes matched, write pending
+	WRITTEN = 2  # write sent, waiting for the read-back
+	CONFIRMED = 3  # read-back matches the .hi file
+
+	def __init__(self, regions, hiscore_file_data):
+		self.regions = regions
+		self.file_offsets = []
+		offset = 0
+		for address, length, start_byte, end_byte, prefill in regions:
+			self.file_offsets.append(offset)
+			offset += length
+		self.total_length = offset
+		self.hiscore_file_data = hiscore_file_data
+		if hiscore_file_data and len(hiscore_file_data) != self.total_length:
+			logging.warning("hiscore file size mismatch (expected " + str(self.total_length) + " bytes, found " + str(len(hiscore_file_data)) + "), will not be loaded")
+			self.hiscore_file_data = None
+		self.states = [ self.WAITING ] * len(regions)
+		self.polls = 0
+
+	def get_region_file_data(self, region_index):
+		offset = self.file_offsets[region_index]
+		return self.hiscore_file_data[offset:offset + self.regions[region_index][1]]
+
+	def update_sentinels(self, region_snapshots):
+		""" mark the regions whose start_byte and end_byte matches in the current memory snapshot """
+		self.polls += 1
+		for region_index, snapshot in enumerate(region_snapshots):
+			if self.states[region_index] != self.WAITING or not snapshot:
+				continue
+			address, length, start_byte, end_byte, prefill = self.regions[region_index]
+			if snapshot[0] == start_byte and snapshot[-1] == end_byte:
+				self.states[region_index] = self.PASSED
+
+	def sentinels_passed(self):
+		return all(state != self.WAITING for state in self.states)
+
+	def is_done(self):
+		return all(state == self.CONFIRMED for state in self.states)
+
+	def pending_writes(self):
+		""" returns a list of ( region_index, address, bytes to write ) """
+		if not self.sentinels_passed():
+			return []
+		return [ (region_index, self.regions[region_index][0], self.get_region_file_data(region_index)) for region_index, state in enumerate(self.states) if state == self.PASSED ]
+
+	def mark_written(self, region_index):
+		self.states[region_index] = self.WRITTEN
+
+	def confirm(self, region_index, snapshot):
+		""" check the read-back of a written region, failed ones will be written again at the next poll """
+		if snapshot == self.get_region_file_data(region_index):
+			self.states[region_index] = self.CONFIRMED
+		else:
+			logging.warning("hiscore region " + str(region_index) + " read-back mismatch, will retry")
+			self.states[region_index] = self.PASSED
+
+	def confirm_all(self):
+		self.states = [ self.CONFIRMED ] * len(self.regions)
+# end of HiscoreInitState
+
+
+# max gap/size used when merging close regions into a single READ_CORE_RAM command
+READ_COALESCE_MAX_GAP = 16
+READ_COALESCE_MAX_LENGTH = 1024  # replies are limited to 4096 chars
+
+
+def read_regions(retroarch, regions, byteswap, region_indexes=None):
+	"""
+	read the passed regions from live memory, merging close ones in a single command.
+	returns a tuple: list of bytes (or None for unread/invalid regions) with the same len of regions, True if all the reads were unsupported
+	"""
+	snapshots = [ None ] * len(regions)
+	if region_indexes is None:
+		region_indexes = range(len(regions))
+
+	# group the regions into spans
+	spans = []  # [ span_address, span_end, [ region_indexes ] ]
+	for region_index in sorted(region_indexes, key=lambda i: regions[i][0]):
+		address, length = regions[region_index][0], regions[region_index][1]
+		if spans:
+			span = spans[-1]
+			if address - span[1] <= READ_COALESCE_MAX_GAP and max(span[1], address + length) - span[0] <= READ_COALESCE_MAX_LENGTH and not (byteswap and (address - span[0]) % 2):
+				span[1] = max(span[1], address + length)
+				span[2].append(region_index)
+				continue
+		spans.append([ address, address + length, [ region_index ] ])
+
+	unsupported_replies = 0
+	for span_address, span_end, span_region_indexes in spans:
+		response_bytes = retroarch.read_core_ram(span_address, span_end - span_address, check_content=False)
+		if response_bytes == [b'-1'] or response_bytes == "":
+			# "" is returned by old Retroarch versions
+			unsupported_replies += 1
+			logging.error("invalid address found in hiscore datfile (skipped): " + str(hex(span_address)))
+			continue
+		if not response_bytes:
+			continue
+		span_data = bytes([ int(b, base=16) for b in response_bytes ])
+		if byteswap:
+			from state2hi import byteswap16
+			if ( len(span_data) % 2 ):
+				logging.warning("odd sizes prolly wont work well with this core due to swapping")
+				span_data += b'\x00'  # try to fix
+			span_data = byteswap16(span_data)
+		for region_index in span_region_indexes:
+			offset = regions[region_index][0] - span_address
+			snapshots[region_index] = span_data[offset:offset + regions[region_index][1]]
+	return snapshots, len(spans) > 0 and unsupported_replies == len(spans)
+
+
+# savestate fallback mode: "0" = never (default), "auto" = used when all the reads fail, "1" = always
+# MEMO: this overwrites the savestate in the currently selected slot, hiscores can only be saved (not loaded) this way.
+#       "auto" is opt-in since bad addresses in the dat fail the same way as a core without READ_CORE_RAM
+USE_SAVESTATES = os.getenv("HISCORE_USE_SAVESTATES", "0")
+SAVESTATE_POLL_INTERVAL = int(os.getenv("HISCORE_SAVESTATE_INTERVAL", "30"))
+SAVESTATE_TIMEOUT = 5
+
+
+def region_snapshots_unavailable(read_core_ram_unsupported):
+	""" True if the core does not support READ_CORE_RAM (old Retroarch ver. or no memory map exposed) """
+	if USE_SAVESTATES == "1":
+		return True
+	if USE_SAVESTATES == "auto" and read_core_ram_unsupported:
+		logging.warning("all the READ_CORE_RAM replies failed (core without memory map, or bad addresses in the dat), switching to savestates")
+		return True
+	return False
+
+
+def open_savestate_watcher(connection):
+	savestate_path = os.getenv("HISCORE_SAVESTATE_PATH")
+	if not savestate_path:
+		savestate_path = str(connection.get_config_param('savestate_directory'), 'utf-8')
+	if not savestate_path:
+		logging.error("savestate_directory unknown, set HISCORE_SAVESTATE_PATH")
+		return None
+	from savestate_watcher import SavestateWatcher
+	logging.warning("using the savestate fallback mode (hiscores will be saved but not loaded)")
+	return SavestateWatcher(savestate_path)
+
+
+def read_regions_from_savestate(retroarch, savestate_watcher, content_name, hiscore_rows_to_process):
+	"""
+	savestate fallback for cores without READ_CORE_RAM support: dump a new savestate and decode only the hiscore regions
+	returns a list of bytes (or None) like read_regions
+	"""
+	savestate_watcher.arm()
+	if not retroarch.save_state():
+		return [ None ] * len(hiscore_rows_to_process)
+	savestate_path = savestate_watcher.wait(content_name, timeout=SAVESTATE_TIMEOUT)
+	if not savestate_path:
+		logging.warning("savestate not found in " + savestate_watcher.directory)
+		return [ None ] * len(hiscore_rows_to_process)
+	with open(savestate_path, 'rb') as savestate_file:
+		statedata = savestate_file.read()
+	from state2hi import get_hiscore_regions_from_statedata
+	regions_data, candidate_systems, emulator = get_hiscore_regions_from_statedata(statedata, hiscore_rows_to_process)
+	if not regions_data:
+		logging.error("unsupported savestate format: " + savestate_path)
+		return [ None ] * len(hiscore_rows_to_process)
+	logging.debug("read hiscore regions from savestate: " + savestate_path + " (" + emulator + ")")
+	return regions_data
+
+
+class ConnectionManager(object):
+
+	"""
+	tracks the Retroarch connection: a single GET_STATUS as liveness+status probe, reconnections with exponential backoff plus jitter.
+	the config params are cached across reconnects and refreshed only when the Retroarch version changes (e.g. after an update).
+	"""
+
+	def __init__(self, retroarch):
+		self.retroarch = retroarch
+		self.version = None
+		self.connected = False
+		self.connected_time = None  # time.monotonic() of the last (re-)connection
+		self.failures = 0  # consecutive failed probes
+		self.on_version_change = None  # optional callback, run after a reconnection to a different version
+		self._config_params = {}
+		if retroarch.version:
+			# probed at the 1st access, or already checked by the caller (e.g. a replay)
+			self._set_connected(retroarch.version)
+
+	def _set_connected(self, version):
+		if version != self.version:
+			changed = self.version is not None
+			if changed:
+				logging.info("Retroarch version changed to " + str(version, 'utf-8') + ", refreshing the config params")
+			self._config_params = {}
+			self.version = version
+			if changed and self.on_version_change is not None:
+				self.on_version_change()
+		self.connected = True
+		self.connected_time = time.monotonic()
+		self.failures = 0
+
+	def _connect(self):
+		version = self.retroarch.probe_version(PROBE_TIMEOUT)
+		if not version:
+			self.failures += 1
+			return False
+		logging.info("connected to Retroarch " + str(version, 'utf-8'))
+		self._set_connected(version)
+		return True
+
+	def retry_delay(self):
+		""" secs to wait before the next attempt, the jitter avoids probing in lockstep with Retroarch's own startup """
+		delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** max(0, self.failures - 1))
+		return delay * random.uniform(0.5, 1.0)
+
+	def wait_connected(self):
+		""" blocks until Retroarch replies (used at startup) """
+		started = time.monotonic()
+		while not self._connect():
+			if self.failures == 1:
+				logging.error("connection error: make sure Retroarch is running and has network commands enabled, will keep retrying...")
+			time.sleep(self.retry_delay())
+		logging.info("connection established in %.2fs" % (time.monotonic() - started))
+
+	def probe(self):
+		""" returns the status info (see RetroArchPythonApi.get_status_info), or None if Retroarch is not responding """
+		if not self.connected and not self._connect():
+			return None
+		status_info = self.retroarch.get_status_info(PROBE_TIMEOUT)
+		if status_info is None:
+			logging.warning("Retroarch is not responding, reconnecting...")
+			self.connected = False
+			self.failures += 1
+		return status_info
+
+	def get_config_param(self, param_name):
+		if not param_name in self._config_params:
+			self._config_params[param_name] = self.retroarch.get_config_param(param_name)
+		return self._config_params[param_name]
+# end of ConnectionManager
+
+
+class StageStats(object):
+
+	""" per-stage latency counters, shared by all the pipeline stages """
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._stats = {}  # stage -> [ count, total secs, max secs ]
+		self._last_report_time = time.monotonic()
+
+	def add(self, stage, secs):
+		with self._lock:
+			stat = self._stats.setdefault(stage, [ 0, 0.0, 0.0 ])
+			stat[0] += 1
+			stat[1] += secs
+			stat[2] = max(stat[2], secs)
+
+	def report(self, force=False):
+		""" log the stats every STATS_REPORT_INTERVAL secs """
+		if not force and time.monotonic() - self._last_report_time < STATS_REPORT_INTERVAL:
+			return
+		self._last_report_time = time.monotonic()
+		with self._lock:
+			for stage, (count, total, max_secs) in sorted(self._stats.items()):
+				logging.info("stage %s: %d runs, avg %.1fms, max %.1fms" % (stage, count, total * 1000 / count, max_secs * 1000))
+
+
+class NetworkStage(threading.Thread):
+
+	"""
+	owns the Retroarch connection: polls the status and the regions of the current game (the target set by the logic stage)
+	and publishes the snapshots in a bounded queue. commands from the other stages are run in order between the polls.
+	"""
+
+	def __init__(self, connection, snapshot_queue, stats, poll_interval=POLL_INTERVAL, lockstep=False):
+		threading.Thread.__init__(self, name="network", daemon=True)
+		self.connection = connection
+		self.retroarch = connection.retroarch
+		self.snapshot_queue = snapshot_queue
+		self.stats = stats
+		self.poll_interval = poll_interval
+		self.lockstep = lockstep  # wait for the logic stage to process each snapshot before polling again (used for replays)
+		self._commands = queue.Queue()
+		self._stop_event = threading.Event()
+		self._processed_event = threading.Event()
+		self._awaiting_processed = False
+		self._poll_now = False
+		self._inject_polling = False
+		self._target = None  # ( content_name, regions, byteswap, rows )
+		self.savestate_watcher = None
+
+	def call(self, function, *args):
+		""" queue a command, returns a Future with its result """
+		future = Future()
+		self._commands.put(( function, args, future ))
+		return future
+
+	def set_target(self, content_name, regions, byteswap, rows):
+		""" regions to read for the current game, a new poll is done asap """
+		self.call(self._set_target, ( content_name, regions, byteswap, rows ))
+
+	def _set_target(self, target):
+		self._target = target
+		self._poll_now = True
+		self._inject_polling = False
+		if self.savestate_watcher is not None:
+			# the new core may support READ_CORE_RAM
+			self.savestate_watcher.close()
+			self.savestate_watcher = None
+
+	def set_inject_polling(self, enabled):
+		""" poll faster until the .hi file of the target is injected (called via call()) """
+		self._inject_polling = enabled
+
+	def read_target_regions(self, region_indexes=None):
+		""" read the target regions now (called via call()) """
+		content_name, regions, byteswap, rows = self._target
+		region_snapshots, unsupported = read_regions(self.retroarch, regions, byteswap, region_indexes)
+		return region_snapshots
+
+	def stop(self):
+		self._stop_event.set()
+		self.call(lambda: None)  # wake up
+
+	def snapshot_processed(self):
+		""" called by the logic stage after each snapshot """
+		self._processed_event.set()
+
+	def run(self):
+		next_poll_time = 0
+		while not self._stop_event.is_set():
+			timeout = max(0, next_poll_time - time.monotonic())
+			if self._awaiting_processed:
+				timeout = min(timeout, 0.01)
+			try:
+				function, args, future = self._commands.get(timeout=timeout)
+			except queue.Empty:
+				function = None
+			if function is not None:
+				started = time.perf_counter()
+				try:
+					future.set_result(function(*args))
+				except EOFError as e:
+					# end of a replayed trace (see retroarch_trace.py)
+					future.set_exception(e)
+					logging.info("end of the replayed trace, network stage stopped")
+					self.publish({ "content_name": None, "time": time.monotonic() })  # wake up the logic stage
+					break
+				except Exception as e:
+					logging.exception("network command failed")
+					future.set_exception(e)
+				self.stats.add("network_command", time.perf_counter() - started)
+				if not self._poll_now:
+					continue
+			if self._awaiting_processed:
+				if not self._processed_event.is_set():
+					continue
+				self._processed_event.clear()
+				self._awaiting_processed = False
+			elif not self._poll_now and time.monotonic() < next_poll_time:
+				continue
+
+			self._poll_now = False
+			started = time.perf_counter()
+			try:
+				with hiscore_profile.section("poll"):
+					snapshot = self.poll()
+			except EOFError:
+				# end of a replayed trace (see retroarch_trace.py)
+				logging.info("end of the replayed trace, network stage stopped")
+				self.publish({ "content_name": None, "time": time.monotonic() })  # wake up the logic stage
+				break
+			except Exception:
+				logging.exception("poll failed")
+				snapshot = { "content_name": None, "time": time.monotonic() }
+			self.stats.add("network_poll", time.perf_counter() - started)
+			self.publish(snapshot)
+			self._awaiting_processed = self.lockstep
+			if self.savestate_watcher is not None:
+				next_poll_time = time.monotonic() + SAVESTATE_POLL_INTERVAL
+			elif not self.connection.connected:
+				next_poll_time = time.monotonic() + min(self.poll_interval, self.connection.retry_delay())
+			elif self._inject_polling:
+				next_poll_time = time.monotonic() + min(self.poll_interval, INJECT_POLL_INTERVAL)
+			else:
+				next_poll_time = time.monotonic() + self.poll_interval
+		# end while
+		if self.savestate_watcher is not None:
+			self.savestate_watcher.close()
+
+	def publish(self, snapshot):
+		""" put a snapshot in the queue, dropping the oldest one when the logic stage is lagging """
+		while True:
+			try:
+				self.snapshot_queue.put_nowait(snapshot)
+				return
+			except queue.Full:
+				try:
+					self.snapshot_queue.get_nowait()
+					logging.warning("logic stage is lagging, snapshot dropped")
+				except queue.Empty:
+					pass
+
+	def poll(self):
+		""" returns a snapshot dict: content_name (None if no content is running), system_id, crc32, regions (None if not read) """
+		retroarch = self.retroarch
+		snapshot = { "content_name": None, "regions": None, "time": time.monotonic() }
+
+		# wait for some content to be loaded
+		status_info = self.connection.probe()
+		if status_info is None or status_info["status"] in [ b"", b"CONTENTLESS" ] or not status_info["content_name"]:
+			self._inject_polling = False
+			return snapshot
+
+		snapshot["content_name"] = str(status_info["content_name"], 'utf-8')
+		snapshot["system_id"] = str(status_info["system_id"], 'utf-8')
+		snapshot["crc32"] = str(status_info["crc32"], 'utf-8')
+
+		if self._target is None or self._target[0] != snapshot["content_name"] or not self._target[1]:
+			# game was changed, the logic stage needs to resolve it first
+			self._inject_polling = False
+			return snapshot
+
+		content_name, regions, byteswap, rows = self._target
+		if self.savestate_watcher is None:
+			# read all the regions from live memory
+			snapshot["regions"], unsupported = read_regions(retroarch, regions, byteswap)
+			if region_snapshots_unavailable(unsupported):
+				self.savestate_watcher = open_savestate_watcher(self.connection)
+		if self.savestate_watcher is not None:
+			snapshot["regions"] = read_regions_from_savestate(retroarch, self.savestate_watcher, content_name, rows)
+			snapshot["from_savestate"] = True
+		snapshot["time"] = time.monotonic()
+		return snapshot
+# end of NetworkStage
+
+
+class LogicStage(object):
+
+	""" consumes the snapshots from the network stage: game switches, hiscore injection and change detection """
+
+	def __init__(self, network, disk, stats, hiscore_cache, publisher=None):
+		self.network = network
+		self.disk = disk
+		self.stats = stats
+		self.hiscore_cache = hiscore_cache
+		self.publisher = publisher
+		self._injected_connected_time = None
+		self._failed_write_key = None  # content_key of the last failed .hi write, set by the disk stage
+		self.reset()
+
+	def reset(self):
+		self.content_name = None
+		self.content_key = None  # ( system_id, content_name, crc32 )
+		self.hiscore_entry = None
+		self.hiscore_init_state = None
+		self.hiscore_inited_in_ram = False
+		self.hiscore_file_bytesio = BytesIO()
+
+	def process(self, snapshot):
+		started = time.perf_counter()
+		self.stats.add("queue_wait", time.monotonic() - snapshot["time"])
+		if snapshot["content_name"] is None:
+			if self.content_name is not None:
+				logging.debug("content was unloaded")
+				if self.publisher is not None:
+					self.publisher.publish_unloaded()
+			self.reset()
+		elif snapshot["content_name"] != self.content_name:
+			self.switch_game(snapshot)
+		elif snapshot["regions"] is not None and self.hiscore_init_state is not None:
+			self.process_regions(snapshot["regions"], snapshot.get("from_savestate", False))
+		self.stats.add("logic", time.perf_counter() - started)
+		self.network.snapshot_processed()
+
+	def switch_game(self, snapshot):
+		self.reset()
+		self.content_name = snapshot["content_name"]
+		self.content_key = ( snapshot["system_id"], snapshot["content_name"], snapshot["crc32"] )
+		logging.debug("reported_system_id: " + snapshot["system_id"])
+		logging.debug("game was changed, looking hiscore data for " + self.content_name + "...")
+
+		hiscore_entry = self.hiscore_cache.get(*self.content_key)
+		if hiscore_entry is None:
+			try:
+				hiscore_entry = self.submit_disk("disk_resolve", self.resolve_and_cache, self.content_key).result()
+			except Exception as e:
+				logging.error("unable to resolve the current game: " + str(e))
+				return
+		else:
+			logging.debug("game found in the hiscore cache")
+			# a single stat in the disk stage (after the pending writes), the .hi file may have been changed by the other tools
+			try:
+				self.submit_disk("disk_check", self.hiscore_cache.check_hiscore_file, *self.content_key).result()
+			except Exception as e:
+				logging.error("unable to check the hiscore file: " + str(e))
+		if self.hiscore_cache.dirty:
+			# persisted only when some entry was added or changed, not at every .hi write
+			self.submit_disk("disk_cache", self.hiscore_cache.save)
+		self.hiscore_entry = hiscore_entry
+
+		if len(hiscore_entry["rows"])==0:
+			logging.error("nothing found in hiscore.dat for current game")
+			return
+		else:
+			logging.debug("found hiscore patches")
+
+		if hiscore_entry.get("hiscore_file_stale"):
+			# .hi file was changed outside the companion, reload it
+			try:
+				self.submit_disk("disk_read", self.reload_hiscore, self.content_key, hiscore_entry).result()
+			except Exception as e:
+				logging.error("unable to reload the hiscore file: " + str(e))
+				return
+
+		if hiscore_entry["hiscore_file_data"] is not None:
+			self.hiscore_file_bytesio = BytesIO(hiscore_entry["hiscore_file_data"])  # keep a copy in memory
+		else:
+			logging.info("hiscore file not found, will be created...")
+		self.hiscore_init_state = HiscoreInitState(hiscore_entry["regions"], hiscore_entry["hiscore_file_data"])
+		if hiscore_entry["hiscore_file_data"] and not self.hiscore_init_state.hiscore_file_data:
+			# rejected by the size check, the table in memory would be saved over it
+			try:
+				self.submit_disk("disk_backup", self.backup_hiscore, self.content_key, hiscore_entry).result()
+			except Exception as e:
+				logging.error("unable to backup the hiscore file, it will not be overwritten: " + str(e))
+				self.hiscore_init_state = None
+				return
+		self.network.set_target(self.content_name, hiscore_entry["regions"], hiscore_entry["byteswap"], hiscore_entry["rows"])
+		if self.hiscore_init_state.hiscore_file_data:
+			self.network.call(self.network.set_inject_polling, True)
+
+	def process_regions(self, region_snapshots, from_savestate):
+		hiscore_entry = self.hiscore_entry
+		hiscore_init_state = self.hiscore_init_state
+		hiscore_init_state.update_sentinels(region_snapshots)
+		if self._failed_write_key is not None and self._failed_write_key == self.content_key:
+			# the last save failed, write again at this poll
+			self._failed_write_key = None
+			self.hiscore_file_bytesio = BytesIO()
+
+		if not hiscore_init_state.is_done() and hiscore_init_state.sentinels_passed():
+			if not hiscore_init_state.hiscore_file_data or from_savestate:
+				# nothing to inject, just start monitoring
+				hiscore_init_state.confirm_all()
+				if from_savestate and hiscore_entry["hiscore_file_data"] is not None:
+					logging.warning("hiscore file can not be loaded from a savestate, will not be overwritten")
+			else:
+				logging.info("start_byte and end_byte matches, writing into core memory...")
+				# batch all the pending writes
+				pending_writes = []
+				for region_index, address, buf in hiscore_init_state.pending_writes():
+					if hiscore_entry["byteswap"]:
+						# need to byteswap buf before writing into memory
+						from state2hi import byteswap16
+						buf = byteswap16(buf)
+					pending_writes.append(( region_index, self.network.call(self.network.retroarch.write_core_ram, address, buf, False) ))
+				# then confirm them with a single read-back
+				written_indexes = []
+				for region_index, future in pending_writes:
+					if future.result() == True:
+						hiscore_init_state.mark_written(region_index)
+						written_indexes.append(region_index)
+				readback_snapshots = self.network.call(self.network.read_target_regions, written_indexes).result()
+				for region_index in written_indexes:
+					hiscore_init_state.confirm(region_index, readback_snapshots[region_index])
+					region_snapshots[region_index] = readback_snapshots[region_index]
+				if hiscore_init_state.is_done():
+					self.hiscore_inited_in_ram = True
+					logging.info("hiscore injected after " + str(hiscore_init_state.polls) + " poll(s)")
+					self.network.call(self.network.set_inject_polling, False)
+					self.network.call(self.network.retroarch.show_msg, "Hiscore loaded")
+					self.injected()
+		# end if
+
+		# check if hiscore data is changed
+		if hiscore_init_state.is_done() and not None in region_snapshots:
+			curr_hiscore_in_ram_bytesio_value = b"".join(region_snapshots)
+		else:
+			# still waiting for the game to init its memory
+			curr_hiscore_in_ram_bytesio_value = b""
+		if len(curr_hiscore_in_ram_bytesio_value) > 0 and self.publisher is not None:
+			# sent only if changed
+			self.publisher.publish_snapshot(self.content_key[0], self.content_key[1], self.content_key[2], hiscore_entry["regions"], region_snapshots)
+		if from_savestate and not self.hiscore_inited_in_ram and hiscore_entry["hiscore_file_data"] is not None:
+			# the memory holds the default table, saving it would replace the existing (not injected) .hi file
+			logging.debug("existing hiscore file not injected, nothing to save")
+		elif len(curr_hiscore_in_ram_bytesio_value) > 0 and bool(any(c != 0 for c in curr_hiscore_in_ram_bytesio_value)) and curr_hiscore_in_ram_bytesio_value != self.hiscore_file_bytesio.getvalue():
+			# (over-)write to the hiscore file in the disk stage
+			self.hiscore_file_bytesio = BytesIO(curr_hiscore_in_ram_bytesio_value)  # keep the reference in memory
+			self.hiscore_cache.update_hiscore_data(*self.content_key, curr_hiscore_in_ram_bytesio_value, written=False)
+			self.submit_disk("disk_write", self.save_hiscore, self.content_key, hiscore_entry["hiscore_file_path"], curr_hiscore_in_ram_bytesio_value, hiscore_entry["candidate_systems"])
+		else:
+			logging.debug("hiscore data unchanged in memory, nothing to save")
+		# end if
+
+	def injected(self):
+		""" measure the time from the (re-)connection to Retroarch to the 1st injection """
+		connected_time = self.network.connection.connected_time
+		if connected_time is None or connected_time == self._injected_connected_time:
+			return
+		self._injected_connected_time = connected_time
+		secs = time.monotonic() - connected_time
+		self.stats.add("first_injection", secs)
+		logging.info("first hiscore injected %.2fs after connecting to Retroarch" % secs)
+
+	def save_hiscore(self, content_key, hiscore_file_path, data, candidate_systems):
+		""" runs in the disk stage """
+		if write_hiscore_file(hiscore_file_path, data, candidate_systems, content_key[1]):
 			# show msg only at the 1st save
-			retroarch.show_msg("Hiscore file created")
-		hiscore_file = open(hiscore_file_path, 'wb') # write+binary mode
-		hiscore_file.write(curr_hiscore_in_ram_bytesio_value)
-		hiscore_file.close()
-		hiscore_file_bytesio = curr_hiscore_in_ram_bytesio  # keep the reference in memory
+			self.network.call(self.network.retroarch.show_msg, "Hiscore file created")
 		logging.info("written hiscore file " + hiscore_file_path)
 		#NO? retroarch.show_msg("Hiscore saved")  # too many alerts?
+		self.hiscore_cache.update_hiscore_data(*content_key, data)
+
+	def backup_hiscore(self, content_key, hiscore_entry):
+		""" runs in the disk stage """
+		backup_path = backup_hiscore_file(hiscore_entry["hiscore_file_path"], hiscore_entry["hiscore_file_data"], content_key[1])
+		logging.warning("hiscore file that can not be loaded was saved as " + backup_path + ", it will be overwritten with the scores in memory")
+		self.hiscore_cache.update_hiscore_data(*content_key, None, written=False)
+
+	def resolve_and_cache(self, content_key):
+		""" runs in the disk stage, the only one using the store (the cache reads the signature of the new entry) """
+		hiscore_entry = resolve_game(*content_key)
+		self.hiscore_cache.put(*content_key, hiscore_entry, save=False)
+		return hiscore_entry
+
+	def reload_hiscore(self, content_key, hiscore_entry):
+		""" runs in the disk stage """
+		hiscore_file_data = read_hiscore_file(hiscore_entry["hiscore_file_path"], hiscore_entry["candidate_systems"], content_key[1])
+		self.hiscore_cache.update_hiscore_data(*content_key, hiscore_file_data)
+
+	def submit_disk(self, stage, function, *args):
+		""" run a job in the disk stage, returns its Future. failures are logged even if nobody waits for the result """
+		future = self.disk.submit(self.disk_stage_job, stage, function, *args)
+		content_key = self.content_key
+		def on_done(future):
+			if future.cancelled() or future.exception() is None:
+				return
+			logging.error("disk stage job " + stage + " failed: " + str(future.exception()))
+			if stage == "disk_write":
+				self._failed_write_key = content_key
+		future.add_done_callback(on_done)
+		return future
+
+	def disk_stage_job(self, stage, function, *args):
+		""" wrapper for the jobs submitted to the disk stage, measures their latency """
+		started = time.perf_counter()
+		try:
+			return function(*args)
+		finally:
+			self.stats.add(stage, time.perf_counter() - started)
+# end of LogicStage
+
+
+def prewarm_dat():
+	""" runs in the disk stage while connecting: parse the dat files, so the 1st game switch is only a lookup """
+	from hiscore_dat import get_default_dat
+	get_default_dat()
+
+
+def update_hiscore_path(connection):
+	global HISCORE_PATH
+	if("HISCORE_PATH" in os.environ):
+		HISCORE_PATH = os.environ['HISCORE_PATH']
 	else:
-		logging.debug("hiscore data unchanged in memory, nothing to save")
-	# end if
-	
-	# sleep to avoid sending too many read/write commands
-	time.sleep(5)
-# end while retroarch is running
+		HISCORE_PATH = str(connection.get_config_param('savefile_directory'), 'utf-8')  # store hiscores in savefile_directory by default
+	#HISCORE_PATH = os.path.expanduser("~/.mame/hi")
+
+
+def main(retroarch=None, poll_interval=POLL_INTERVAL, lockstep=False):
+	global hiscore_store
+
+	# the slow parts of the startup are overlapped with the connection to Retroarch
+	disk = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk")
+	disk.submit(prewarm_dat)
+
+	if HISCORE_STORE_PATH:
+		from hi_store import HiStore
+		hiscore_store = HiStore(HISCORE_STORE_PATH)
+
+	if retroarch is None:
+		from retroarchpythonapi import RetroArchPythonApi
+		# HISCORE_TRACE_PATH records the network session, to be replayed with retroarch_trace.py
+		retroarch = RetroArchPythonApi(trace_path=os.getenv("HISCORE_TRACE_PATH"), check_connection=False, network_sleep_time=0, timeout=NETWORK_TIMEOUT)
+	# time every network round trip
+	hiscore_profile.instrument(retroarch, [ "probe_version", "get_status_info", "get_config_param", "read_core_ram", "write_core_ram", "show_msg", "save_state" ], "network_")
+	connection = ConnectionManager(retroarch)
+	if not connection.connected:
+		connection.wait_connected()
+	update_hiscore_path(connection)
+
+	from state2hi import HISCORE_DAT_PATH
+	from hiscore_cache import HiscoreResolutionCache
+	hiscore_cache = HiscoreResolutionCache(dat_path=HISCORE_DAT_PATH, hiscore_path=HISCORE_PATH, store_path=HISCORE_STORE_PATH, store=hiscore_store)
+
+	def on_version_change():
+		""" runs in the network stage, the savefile_directory may have been changed too """
+		hiscore_path = HISCORE_PATH
+		update_hiscore_path(connection)
+		if HISCORE_PATH != hiscore_path:
+			logging.info("hiscore path changed to " + HISCORE_PATH)
+			hiscore_cache.set_hiscore_path(HISCORE_PATH)
+	connection.on_version_change = on_version_change
+
+	stats = StageStats()
+	snapshot_queue = queue.Queue(maxsize=SNAPSHOT_QUEUE_SIZE)
+	network = NetworkStage(connection, snapshot_queue, stats, poll_interval, lockstep)
+	publisher = None
+	if HISCORE_STREAM_PATH:
+		from hiscore_stream import SnapshotPublisher
+		publisher = SnapshotPublisher(HISCORE_STREAM_PATH)
+		publisher.start()
+	logic = LogicStage(network, disk, stats, hiscore_cache, publisher)
+
+	# turn SIGTERM into a clean shutdown
+	def on_sigterm(signum, frame):
+		raise KeyboardInterrupt()
+	signal.signal(signal.SIGTERM, on_sigterm)
+
+	network.start()
+	try:
+		while network.is_alive():
+			try:
+				snapshot = snapshot_queue.get(timeout=1)
+			except queue.Empty:
+				continue
+			logic.process(snapshot)
+			stats.report()
+		# end while
+	except KeyboardInterrupt:
+		logging.info("shutting down...")
+	finally:
+		network.stop()
+		network.join(timeout=SAVESTATE_TIMEOUT + 2)
+		# drain the in-flight saves
+		disk.shutdown(wait=True)
+		hiscore_cache.save()
+		if publisher is not None:
+			publisher.close()
+		if hiscore_store is not None:
+			hiscore_store.close()
+		if hasattr(retroarch, "close_trace"):
+			retroarch.close_trace()
+		stats.report(force=True)
+		hiscore_profile.report()
+
 
+if __name__ == '__main__':
+	main()
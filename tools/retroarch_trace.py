@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+record and replay of the network sessions between RetroArchPythonApi and Retroarch.
+
+record: run the companion with HISCORE_TRACE_PATH=session.trace (or pass trace_path= to RetroArchPythonApi),
+every command and reply is written with its timestamp (gzip-compressed if the path ends with .gz).
+
+replay: feed a trace back into the companion, in place of a running Retroarch:
+  retroarch_trace.py replay session.trace [--fast]   # --fast = as fast as possible, otherwise at the recorded speed
+  retroarch_trace.py info session.trace
+the .hi files are written in a temp dir unless HISCORE_PATH is set.
+"""
+
+import sys
+import os
+import time
+import gzip
+import socket
+import struct
+import logging
+import threading
+
+TRACE_MAGIC = b"RATRACE1"
+TRACE_RECORD = struct.Struct("<dcI")  # secs since the start, kind, payload len
+
+KIND_SEND = b'S'
+KIND_REPLY = b'R'
+KIND_TIMEOUT = b'T'
+
+# max events skipped when looking for a matching command after the replayed session diverged
+REPLAY_RESYNC_WINDOW = 64
+
+
+def open_trace(path, mode):
+	if path.endswith(".gz"):
+		return gzip.open(path, mode)
+	return open(path, mode)
+
+
+class TraceWriter(object):
+
+	def __init__(self, path):
+		self._file = open_trace(path, 'wb')
+		self._file.write(TRACE_MAGIC)
+		self._start_time = time.monotonic()
+		self._lock = threading.Lock()
+
+	def _write(self, kind, payload):
+		with self._lock:
+			if self._file is None:
+				return
+			self._file.write(TRACE_RECORD.pack(time.monotonic() - self._start_time, kind, len(payload)) + payload)
+
+	def write_send(self, cmd):
+		self._write(KIND_SEND, cmd)
+
+	def write_reply(self, reply):
+		self._write(KIND_REPLY, reply)
+
+	def write_timeout(self):
+		self._write(KIND_TIMEOUT, b"")
+
+	def close(self):
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+
+def read_trace(path):
+	""" returns a list of ( secs, kind, payload ) """
+	events = []
+	with open_trace(path, 'rb') as trace_file:
+		data = trace_file.read()
+	if not data.startswith(TRACE_MAGIC):
+		raise ValueError("not a Retroarch trace: " + path)
+	pos = len(TRACE_MAGIC)
+	while pos + TRACE_RECORD.size <= len(data):
+		secs, kind, payload_len = TRACE_RECORD.unpack_from(data, pos)
+		pos += TRACE_RECORD.size
+		events.append(( secs, kind, data[pos:pos+payload_len] ))
+		pos += payload_len
+	return events
+
+
+class ReplaySocket(object):
+
+	"""
+	socket-like object replaying a trace, to be passed to RetroArchPythonApi(sock=...).
+	commands are matched in order with the recorded ones, on divergence the replay resyncs on the next equal command.
+	"""
+
+	def __init__(self, events, realtime=True):
+		self.events = events
+		self.realtime = realtime
+		self.finished = threading.Event()
+		self.sent = 0
+		self.diverged = 0
+		self._cursor = 0
+		self._start_wall_time = None
+		self._start_trace_time = events[0][0] if events else 0
+
+	def settimeout(self, timeout):
+		pass
+
+	def close(self):
+		pass
+
+	def _wait_until(self, trace_time):
+		""" keep the recorded pace """
+		if not self.realtime:
+			return
+		if self._start_wall_time is None:
+			self._start_wall_time = time.monotonic()
+		delay = (trace_time - self._start_trace_time) - (time.monotonic() - self._start_wall_time)
+		if delay > 0:
+			time.sleep(delay)
+
+	def _end_of_trace(self):
+		self.finished.set()
+		raise EOFError("end of the trace")
+
+	def sendto(self, data, addr):
+		self.sent += 1
+		# find the next recorded command
+		cursor = self._cursor
+		while cursor < len(self.events) and self.events[cursor][1] != KIND_SEND:
+			cursor += 1
+		if cursor >= len(self.events):
+			self._end_of_trace()
+		if self.events[cursor][2] != data:
+			self.diverged += 1
+			for i in range(cursor, min(cursor + REPLAY_RESYNC_WINDOW, len(self.events))):
+				if self.events[i][1] == KIND_SEND and self.events[i][2] == data:
+					cursor = i
+					break
+			else:
+				logging.debug("replay diverged: sent " + str(data[:40]) + ", recorded " + str(self.events[cursor][2][:40]))
+		self._wait_until(self.events[cursor][0])
+		self._cursor = cursor + 1
+		return len(data)
+
+	def recvfrom(self, bufsize):
+		if self._cursor >= len(self.events):
+			self._end_of_trace()
+		secs, kind, payload = self.events[self._cursor]
+		if kind == KIND_SEND:
+			# no reply was recorded for the last command
+			raise socket.timeout("no recorded reply")
+		self._cursor += 1
+		self._wait_until(secs)
+		if kind == KIND_TIMEOUT:
+			raise socket.timeout("recorded timeout")
+		return payload[:bufsize], ( "127.0.0.1", 55355 )
+
+
+def print_trace_info(events):
+	commands = {}
+	for secs, kind, payload in events:
+		if kind == KIND_SEND:
+			command = payload.split()[0].decode('utf-8', 'replace') if payload.split() else ""
+			commands[command] = commands.get(command, 0) + 1
+	timeouts = sum(1 for secs, kind, payload in events if kind == KIND_TIMEOUT)
+	duration = events[-1][0] - events[0][0] if events else 0
+	print("events: %d, duration: %.1fs, timeouts: %d" % (len(events), duration, timeouts))
+	for command, count in sorted(commands.items()):
+		print("  %s: %d" % (command, count))
+
+
+def replay(trace_path, realtime=True):
+	""" run the companion against a recorded trace, returns the elapsed secs """
+	import tempfile
+	if not "HISCORE_PATH" in os.environ:
+		os.environ["HISCORE_PATH"] = tempfile.mkdtemp(prefix="hiscore_replay_")
+	if not "HISCORE_CACHE_PATH" in os.environ:
+		os.environ["HISCORE_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="hiscore_replay_"), "cache.json")
+	logging.info(".hi files will be written in " + os.environ["HISCORE_PATH"])
+
+	from retroarchpythonapi import RetroArchPythonApi
+	import retroarch_hiscore_companion
+
+	events = read_trace(trace_path)
+	replay_socket = ReplaySocket(events, realtime)
+	retroarch = RetroArchPythonApi(sock=replay_socket, check_connection=False, network_sleep_time=0)
+
+	# the version handshake is not replayed by the constructor
+	if events and events[0][2] == b'VERSION\n':
+		retroarch.probe_version()
+
+	# stop the companion at the end of the trace
+	def stop_at_end():
+		replay_socket.finished.wait()
+		import _thread
+		_thread.interrupt_main()
+	threading.Thread(target=stop_at_end, daemon=True).start()
+
+	# at the recorded speed the companion polls like it did while recording
+	poll_interval = retroarch_hiscore_companion.POLL_INTERVAL if realtime else 0
+	started = time.monotonic()
+	retroarch_hiscore_companion.main(retroarch, poll_interval=poll_interval, lockstep=True)
+	elapsed = time.monotonic() - started
+	logging.info("replayed %d commands in %.2fs (%d diverged)" % (replay_socket.sent, elapsed, replay_socket.diverged))
+	return elapsed
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3 or sys.argv[1] not in [ "replay", "info" ]:
+		print("usage: retroarch_trace.py replay TRACE_PATH [--fast]")
+		print("       retroarch_trace.py info TRACE_PATH")
+		sys.exit(1)
+	if sys.argv[1] == "info":
+		print_trace_info(read_trace(sys.argv[2]))
+	else:
+		replay(sys.argv[2], realtime=not "--fast" in sys.argv)
@@ -42,6 +42,12 @@ class RetroArchPythonApi(object):
     api.get_content_name()  # returns a string like "Super Mario Bros. (W) [!]"
     api.get_content_crc32_hash()  # returns a string like "d445f698"
     api.get_config_param('savefile_directory')  # read a config param (not all the params are supported!)
+    api.get_status_info()  # liveness+status with a single GET_STATUS, None if not responding
+    
+    api.version  # e.g. b"1.9.0", probed at the 1st access, None if not responding
+    
+    RetroArchPythonApi(trace_path="session.trace")  # record all the commands and replies (see retroarch_trace.py)
+    RetroArchPythonApi(timeout=2)  # raise socket.timeout instead of blocking when Retroarch stops replying
     
     # all the methods returns a true value on success, or thow exceptions on errors.
     """
@@ -50,9 +56,9 @@ class RetroArchPythonApi(object):
     _socket_ipaddr = "127.0.0.1"
     _socket_portnum = 55355
     _network_sleep_time = 0.1
-    _version = ""
+    _version = None
 
-    def __init__(self, ipaddr="127.0.0.1", portnum=55355, network_sleep_time=0.1, check_connection=True):
+    def __init__(self, ipaddr="127.0.0.1", portnum=55355, network_sleep_time=0.1, check_connection=True, trace_path=None, sock=None, timeout=None):
 
         # Logging
         self.logger = logging.getLogger('RetroArchPythonApi')
@@ -70,7 +76,10 @@ class RetroArchPythonApi(object):
         #self.pathes['configfile'] = configfile
         
         # UDP socket init
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)   # SOCK_DGRAM specifies that this is UDP
+        if sock is not None:
+            self._socket = sock  # e.g. a retroarch_trace.ReplaySocket
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)   # SOCK_DGRAM specifies that this is UDP
         #s.bind((ipaddr, portnum))
         #s.setblocking(0)  # set receive non-blocking.
 
@@ -81,6 +90,17 @@ class RetroArchPythonApi(object):
         self._socket_portnum = portnum
         self._network_sleep_time = network_sleep_time
         
+        # default timeout of every round trip (secs), None blocks until a reply is received
+        self.timeout = timeout
+        self._socket.settimeout(self.timeout)
+        
+        # optional recording of all the commands and replies (see retroarch_trace.py)
+        self._trace = None
+        if trace_path:
+            from retroarch_trace import TraceWriter
+            self._trace = TraceWriter(trace_path)
+            self.logger.info('Recording network trace into ' + trace_path)
+        
         if not check_connection:
             return
     
@@ -89,7 +109,7 @@ class RetroArchPythonApi(object):
         # temp. add socket timeout
         self._socket.settimeout(1)
         
-        self._version = self.get_version()
+        self._version = self.get_version() or None
         if not self._version:
             self.logger.error("Connection timeout: make sure Retroarch is running, has network commands enabled and is connectable.")
             #self.logger.warning("Connection timeout: make sure Retroarch is running, has network commands enabled and is connectable (will retry connecting until killed).")
@@ -98,34 +118,85 @@ class RetroArchPythonApi(object):
         #    self._version = self.get_version()
         #    time.sleep(2)
 
-        # remove socket timeout
-        self._socket.settimeout(None)
+        # restore the default timeout
+        self._socket.settimeout(self.timeout)
         
         self.logger.info('Retroarch connection ok')
         
-        retroarch_version_major = self._version.split(b'.')[0]
-        retroarch_version_minor = b".".join(self._version.split(b'.')[1:])
-        if int(retroarch_version_major) == 0 or (int(retroarch_version_major) == 1 and float(retroarch_version_minor) <= 8.4):
+        if self._is_old_version():
             self.logger.warning('current Retroarch ver. does not support GET_STATUS, SHOW_MSG and GET_CONFIG_PARAM commands. Please update to the lastest ver.')
 
 
+    @property
+    def version(self):
+        """ the Retroarch version (bytes), probed at the 1st access. None if Retroarch is not responding """
+        if self._version is None:
+            self.probe_version()
+        return self._version
+
+
+    def _is_old_version(self):
+        """ True for the versions not supporting GET_STATUS, SHOW_MSG, GET_CONFIG_PARAM and the core RAM commands (<= 1.8.4) """
+        version = self.version
+        if not version:
+            # unknown, the command will time out if Retroarch is not responding
+            return False
+        retroarch_version_major = version.split(b'.')[0]
+        retroarch_version_minor = b".".join(version.split(b'.')[1:])
+        return int(retroarch_version_major) == 0 or (int(retroarch_version_major) == 1 and float(retroarch_version_minor) <= 8.4)
+
+
+    def _send(self, cmd):
+        """ send a command to Retroarch """
+        if self._trace:
+            self._trace.write_send(cmd)
+        self._socket.sendto(cmd, (self._socket_ipaddr, self._socket_portnum))
+
+
+    def _recv(self, bufsize):
+        """ receive a reply from Retroarch """
+        try:
+            response_str, addr = self._socket.recvfrom(bufsize)
+        except socket.timeout:
+            if self._trace:
+                self._trace.write_timeout()
+            raise
+        if self._trace:
+            self._trace.write_reply(response_str)
+        return response_str
+
+
+    def close_trace(self):
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+
+    def _recv_reply(self, prefix, bufsize=4096):
+        """ receive the reply starting with prefix, late replies to previous (timed out) commands are dropped """
+        for i in range(8):
+            response_str = self._recv(bufsize) # MEMO: blocking until something is received
+            if response_str.startswith(prefix):
+                return response_str
+            self.logger.warning('Dropped unexpected reply: ' + str(response_str[:32]))
+        raise Exception("no reply to: " + str(prefix))
+
+
     def show_msg(self, msg):
         """ Shows a message via the OSD """
-        self._socket.sendto(b'SHOW_MSG ' + msg.encode('utf-8') + b'\n', (self._socket_ipaddr, self._socket_portnum))
+        self._send(b'SHOW_MSG ' + msg.encode('utf-8') + b'\n')
         return True
 
 
     def get_config_param(self, param_name):
         """ Read a param from the configuration (e.g. 'savefile_directory') """
         # ver. check to avoid freezing
-        retroarch_version_major = self._version.split(b'.')[0]
-        retroarch_version_minor = b".".join(self._version.split(b'.')[1:])
-        if int(retroarch_version_major) == 0 or (int(retroarch_version_major) == 1 and float(retroarch_version_minor) <= 8.4):
+        if self._is_old_version():
             self.logger.error('current Retroarch ver. does not support GET_CONFIG_PARAM commands. Please update to the lastest ver.')
             return b""
         # else
-        self._socket.sendto(b'GET_CONFIG_PARAM '  + param_name.encode('utf-8') + b'\n', (self._socket_ipaddr, self._socket_portnum))
-        response_str, addr = self._socket.recvfrom(4096) # buffer size is 4096 bytes - MEMO: blocking until something is received
+        self._send(b'GET_CONFIG_PARAM '  + param_name.encode('utf-8') + b'\n')
+        response_str = self._recv_reply(b'GET_CONFIG_PARAM ' + param_name.encode('utf-8'))
         param_value = response_str.split()[2]
         if param_value == "unsupported":
             raise Exception("unsupported param: " + param_name)
@@ -136,18 +207,39 @@ class RetroArchPythonApi(object):
     def get_status(self):
         """ Returns a string summarizing the current status (e.g. 'GET_STATUS PLAYING Nestopia,Super Mario Bros. (W) [!],crc32=3337ec46') """
         # ver. check to avoid freezing
-        retroarch_version_major = self._version.split(b'.')[0]
-        retroarch_version_minor = b".".join(self._version.split(b'.')[1:])
-        if int(retroarch_version_major) == 0 or (int(retroarch_version_major) == 1 and float(retroarch_version_minor) <= 8.4):
+        if self._is_old_version():
             self.logger.error('current Retroarch ver. does not support GET_STATUS command. Please update to the lastest ver.')
             return b""
         # else
 
-        self._socket.sendto(b'GET_STATUS\n', (self._socket_ipaddr, self._socket_portnum))
-        response_str, addr = self._socket.recvfrom(4096) # buffer size is 4096 bytes - MEMO: blocking until something is received
+        self._send(b'GET_STATUS\n')
+        response_str = self._recv_reply(b'GET_STATUS')
         return response_str.rstrip()
 
 
+    def get_status_info(self, timeout=1):
+        """ combined liveness+status probe, a single GET_STATUS round trip.
+        returns None if Retroarch is not responding, else a dict with (bytes) status, system_id, content_name, crc32 """
+        self._socket.settimeout(timeout)  # temp. add socket timeout
+        try:
+            status_str = self.get_status()
+        except OSError:
+            # timeout or connection refused
+            return None
+        finally:
+            self._socket.settimeout(self.timeout)  # restore the default timeout
+        splitted_status_str = status_str.split(b",")
+        status_fields = splitted_status_str[0].split(b" ")
+        status_info = { "status": b"", "system_id": b"", "content_name": b"", "crc32": b"" }
+        if len(status_fields) >= 2:
+            status_info["status"] = status_fields[1]
+            status_info["system_id"] = status_fields[-1]
+        if b"crc32=" in status_str:
+            status_info["crc32"] = status_str.split(b"crc32=")[1]
+            status_info["content_name"] = status_str.split(b",crc32=")[0].split(b",", maxsplit=1)[-1]
+        return status_info
+
+
     def has_content(self):
         """ returns True if the Retroarch has some content loaded (paused or not)"""
         status_str = self.get_status()
@@ -209,11 +301,31 @@ class RetroArchPythonApi(object):
         
     def get_version(self):
         """ returns current Retroarch version (as a string) """
-        self._socket.sendto(b'VERSION\n', (self._socket_ipaddr, self._socket_portnum))
-        response_str, addr = self._socket.recvfrom(16)
+        self._send(b'VERSION\n')
+        response_str = self._recv(16)
         return response_str.rstrip()
 
 
+    def probe_version(self, timeout=1):
+        """ VERSION with a timeout, returns the version (also stored for the ver. checks) or None if Retroarch is not responding """
+        self._socket.settimeout(timeout)  # temp. add socket timeout
+        try:
+            self._send(b'VERSION\n')
+            for i in range(8):
+                response_str = self._recv(16).rstrip()
+                if response_str[:1].isdigit():
+                    self._version = response_str
+                    return self._version
+                # late reply to a previous (timed out) command
+                self.logger.warning('Dropped unexpected reply: ' + str(response_str))
+            return None
+        except OSError:
+            # timeout or connection refused
+            return None
+        finally:
+            self._socket.settimeout(self.timeout)  # restore the default timeout
+
+
     def is_alive(self):
         """ returns True if Retroarch is running and connectable """
         self._socket.settimeout(1)  # temp. add socket timeout
@@ -224,7 +336,7 @@ class RetroArchPythonApi(object):
             # timeout
             return False
         finally:
-            self._socket.settimeout(None)  # remove socket timeout
+            self._socket.settimeout(self.timeout)  # restore the default timeout
 
 
     def quit(self):
@@ -240,7 +352,7 @@ class RetroArchPythonApi(object):
             self.toggle_pause()
             time.sleep(self._network_sleep_time)
 
-        self._socket.sendto(b'QUIT\n', (self._socket_ipaddr, self._socket_portnum))
+        self._send(b'QUIT\n')
         # if no socket error assume the command was successful
         self.logger.info('Rom Exited Successfull')
         return True
@@ -258,7 +370,7 @@ class RetroArchPythonApi(object):
 
         self.logger.info('Send: Toggle Pause')
 
-        self._socket.sendto(b'PAUSE_TOGGLE\n', (self._socket_ipaddr, self._socket_portnum))
+        self._send(b'PAUSE_TOGGLE\n')
         # if no socket error assume the command was successful
         
         time.sleep(self._network_sleep_time)
@@ -269,18 +381,17 @@ class RetroArchPythonApi(object):
             return 'unpaused'
 
             
-    def read_core_ram(self, address, length):
-        """ read from current core RAM at address length-bytes. Returs an array of bytes. """
+    def read_core_ram(self, address, length, check_content=True):
+        """ read from current core RAM at address length-bytes. Returs an array of bytes.
+        check_content=False skips the GET_STATUS round trip, when the caller already knows some content is loaded """
         
         # ver. check to avoid freezing
-        retroarch_version_major = self._version.split(b'.')[0]
-        retroarch_version_minor = b".".join(self._version.split(b'.')[1:])
-        if int(retroarch_version_major) == 0 or (int(retroarch_version_major) == 1 and float(retroarch_version_minor) <= 8.4):
+        if self._is_old_version():
             self.logger.error('current Retroarch ver. does not support READ_CORE_RAM command. Please update to the lastest ver.')
             return ""
         # else
         
-        if not self.has_content():
+        if check_content and not self.has_content():
             self.logger.error('No content loaded')
             return []
                 
@@ -288,12 +399,12 @@ class RetroArchPythonApi(object):
         
         cmd = b"READ_CORE_RAM " + ("%x" % address).encode() + b" " + ("%d" % length).encode() + b'\n'
 
-        self._socket.sendto(cmd, (self._socket_ipaddr, self._socket_portnum))
+        self._send(cmd)
         # if no socket error assume the command was successful
         
         time.sleep(self._network_sleep_time)
         
-        answer, addr = self._socket.recvfrom(4096) # buffer size is 4096 bytes - MEMO: blocking until something is received
+        answer = self._recv_reply(b"READ_CORE_RAM " + ("%x" % address).encode() + b" ") # replies are matched on the address
         # TODO: read by blocks
         
         if answer.startswith(b'READ_CORE_RAM'):
@@ -303,17 +414,15 @@ class RetroArchPythonApi(object):
             raise Exception("invalid answer: " + str(answer))
             
     
-    def write_core_ram(self, address, buf):
+    def write_core_ram(self, address, buf, check_content=True):
         """ write into current core RAM from address the array of bytes passed into buf. """
         
         # ver. check
-        retroarch_version_major = self._version.split(b'.')[0]
-        retroarch_version_minor = b".".join(self._version.split(b'.')[1:])
-        if int(retroarch_version_major) == 0 or (int(retroarch_version_major) == 1 and float(retroarch_version_minor) <= 8.4):
+        if self._is_old_version():
             self.logger.error('current Retroarch ver. does not support WRITE_CORE_RAM command. Please update to the lastest ver.')
             return False
             
-        if not self.has_content():
+        if check_content and not self.has_content():
             self.logger.error('No content loaded')
             return False
             
@@ -323,7 +432,7 @@ class RetroArchPythonApi(object):
         cmd += b"\n"
         self.logger.debug('Sending: ' + str(cmd))  # e.g. b"WRITE_CORE_RAM f E5 C4 09 F0 2A 00 00 31 00 01\n"
 
-        self._socket.sendto(cmd, (self._socket_ipaddr, self._socket_portnum))
+        self._send(cmd)
         # if no socket error assume the command was successful
         return True
 
@@ -336,7 +445,7 @@ class RetroArchPythonApi(object):
 
         self.logger.info('Send: Fullscreen Toggle')
         
-        self._socket.sendto(b'FULLSCREEN_TOGGLE\n', (self._socket_ipaddr, self._socket_portnum))
+        self._send(b'FULLSCREEN_TOGGLE\n')
         # if no socket error assume the command was successful
         
         time.sleep(self._network_sleep_time)
@@ -356,7 +465,7 @@ class RetroArchPythonApi(object):
             self.logger.error('No content loaded')
             return False
 
-        self._socket.sendto(b'LOAD_STATE\n', (self._socket_ipaddr, self._socket_portnum))
+        self._send(b'LOAD_STATE\n')
         # if no socket error assume the command was successful
         return True
         
@@ -370,7 +479,7 @@ class RetroArchPythonApi(object):
 
         self.logger.info('Send: Save State')
 
-        self._socket.sendto(b'SAVE_STATE\n', (self._socket_ipaddr, self._socket_portnum))
+        self._send(b'SAVE_STATE\n')
         # if no socket error assume the command was successful
         return True
 
@@ -387,7 +496,7 @@ class RetroArchPythonApi(object):
         if self.is_paused():
             self.toggle_pause()
 
-        self._socket.sendto(b'RESET\n', (self._socket_ipaddr, self._socket_portnum))
+        self._send(b'RESET\n')
         # if no socket error assume the command was successful
         return True
 
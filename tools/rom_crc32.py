@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+hash ROM collections and emit the crc32 aliases missing in console_hiscore.dat.
+
+the ROMs (also zipped) are matched by filename with the name aliases already in the dat (e.g. "nes,Super Mario Bros. (W) [!]:"),
+then a "<system>,crc32=<crc>:" alias line is emitted for every matched entry that does not have it yet,
+so the games are found also when the ROM file was renamed.
+
+usage:
+  rom_crc32.py [--mame] [--write] ROM_DIR [ROM_DIR ...]
+
+by default the crc32 is computed on the whole file, like Retroarch reports it (iNES header included).
+with --mame the iNES header is skipped and the crc32 is formatted like the MAME plugin does (images["cart"]:crc()).
+with --write the aliases are inserted in the dat (the 1st file in HISCORE_DAT_PATH) after the matched name, otherwise they are printed.
+"""
+
+import sys
+import os
+import zlib
+import zipfile
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from hiscore_dat import HISCORE_DAT_PATHS
+
+# the aliases are matched and written in the 1st dat file only (the upstream console_hiscore.dat)
+HISCORE_DAT_PATH = HISCORE_DAT_PATHS[0]
+
+HASH_CHUNK_SIZE = 1024 * 1024
+INES_HEADER_LEN = 16
+
+# ROM extension -> candidate systems in the dat
+EXTENSION_SYSTEMS = {
+	".nes": [ "nes", "famicom", "nespal" ],
+	".fds": [ "fds" ],
+	".sfc": [ "snes", "snespal" ],
+	".smc": [ "snes", "snespal" ],
+	".gb": [ "gameboy" ],
+	".gbc": [ "gbcolor", "gameboy" ],
+	".md": [ "genesis", "megadriv", "megadrij" ],
+	".gen": [ "genesis", "megadriv", "megadrij" ],
+	".smd": [ "genesis", "megadriv", "megadrij" ],
+	".bin": [ "genesis", "megadriv", "megadrij" ],
+	".32x": [ "32x" ],
+	".sms": [ "sms", "smsj", "smspal" ],
+	".gg": [ "gamegear", "gamegeaj" ],
+	".pce": [ "pce", "tg16", "sgx" ],
+}
+
+
+def crc32_stream(stream, skip_ines_header=False):
+	""" streaming crc32 of a file object """
+	crc = 0
+	first_chunk = True
+	while True:
+		chunk = stream.read(HASH_CHUNK_SIZE)
+		if not chunk:
+			break
+		if first_chunk and skip_ines_header and chunk[0:4] == b"NES\x1a":
+			chunk = chunk[INES_HEADER_LEN:]
+		first_chunk = False
+		crc = zlib.crc32(chunk, crc)
+	return crc
+
+
+def hash_rom_file(path, mame=False):
+	"""
+	returns a list of ( content name, extension, crc32 ), one for each ROM in the file (zip files may hold more than one)
+	runs in the worker processes
+	"""
+	results = []
+	try:
+		if path.lower().endswith(".zip"):
+			with zipfile.ZipFile(path) as zip_file:
+				for info in zip_file.infolist():
+					content_name, extension = os.path.splitext(os.path.basename(info.filename))
+					extension = extension.lower()
+					if info.is_dir() or not extension in EXTENSION_SYSTEMS:
+						continue
+					if not (mame and extension == ".nes"):
+						# no header to skip: the crc32 of the whole member is already in the zip directory
+						results.append(( content_name, extension, info.CRC ))
+						continue
+					with zip_file.open(info) as rom_file:
+						results.append(( content_name, extension, crc32_stream(rom_file, True) ))
+		else:
+			content_name, extension = os.path.splitext(os.path.basename(path))
+			extension = extension.lower()
+			with open(path, 'rb') as rom_file:
+				results.append(( content_name, extension, crc32_stream(rom_file, mame and extension == ".nes") ))
+	except (OSError, zipfile.BadZipFile) as e:
+		logging.warning("unable to read " + path + ": " + str(e))
+	return results
+
+
+def find_rom_files(rom_dirs):
+	for rom_dir in rom_dirs:
+		for root, dirs, files in os.walk(rom_dir):
+			for filename in files:
+				extension = os.path.splitext(filename)[1].lower()
+				if extension == ".zip" or extension in EXTENSION_SYSTEMS:
+					yield os.path.join(root, filename)
+
+
+def is_crc32_alias(alias):
+	""" only the explicit "system,crc32=<hex>" form, short hex game names (e.g. "snes,face") are names """
+	name = alias.split(",", 1)[-1]
+	if not name.startswith("crc32="):
+		return False
+	name = name[len("crc32="):]
+	# up to 8 digits, the MAME plugin format is not zero-padded
+	return 1 <= len(name) <= 8 and all(c in "0123456789abcdefABCDEF" for c in name)
+
+
+def read_dat_aliases(dat_path):
+	"""
+	returns a tuple:
+	  name alias ("system,name") -> entry index,
+	  list of entries: { "crc32s": set of ( system, crc32 int ), "last_alias_line": line index }
+	"""
+	names = {}
+	entries = []
+	entry = None
+	with open(dat_path) as hiscore_file:
+		for line_index, line in enumerate(hiscore_file):
+			line = line.strip()
+			if line == "" or line.startswith("@"):
+				entry = None
+				continue
+			if line.startswith(";") or not line.endswith(":"):
+				continue
+			if entry is None:
+				entry = { "crc32s": set(), "last_alias_line": line_index }
+				entries.append(entry)
+			entry["last_alias_line"] = line_index
+			alias = line[:-1]
+			if not "," in alias:
+				continue
+			system, name = alias.split(",", 1)
+			if is_crc32_alias(alias):
+				entry["crc32s"].add(( system, int(name[len("crc32="):], 16) ))
+			else:
+				names.setdefault(alias, len(entries) - 1)
+	return names, entries
+
+
+def format_crc32_alias(system, crc, mame=False):
+	if mame:
+		# same format used by the MAME plugin
+		return system + ",crc32=" + ("%x" % crc) + ":"
+	return system + ",crc32=" + ("%08x" % crc) + ":"
+
+
+def find_missing_aliases(rom_dirs, dat_path=HISCORE_DAT_PATH, mame=False, workers=None):
+	""" returns a dict: entry index -> list of ( matched name alias, new crc32 alias line ) """
+	names, entries = read_dat_aliases(dat_path)
+	missing = {}
+	rom_files = list(find_rom_files(rom_dirs))
+	logging.info("hashing " + str(len(rom_files)) + " files")
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		for results in executor.map(hash_rom_file, rom_files, [ mame ] * len(rom_files), chunksize=64):
+			for content_name, extension, crc in results:
+				for system in EXTENSION_SYSTEMS[extension]:
+					entry_index = names.get(system + "," + content_name)
+					if entry_index is None:
+						continue
+					if not ( system, crc ) in entries[entry_index]["crc32s"]:
+						entries[entry_index]["crc32s"].add(( system, crc ))
+						missing.setdefault(entry_index, []).append(( system + "," + content_name, format_crc32_alias(system, crc, mame) ))
+					break
+	return missing, entries
+
+
+def write_aliases(dat_path, missing, entries):
+	""" insert the new aliases in the dat, after the last alias of each entry """
+	with open(dat_path) as hiscore_file:
+		lines = hiscore_file.readlines()
+	insertions = {}
+	for entry_index, aliases in missing.items():
+		insertions[entries[entry_index]["last_alias_line"]] = [ alias_line + "\n" for name, alias_line in aliases ]
+	output_lines = []
+	for line_index, line in enumerate(lines):
+		output_lines.append(line)
+		output_lines.extend(insertions.get(line_index, []))
+	tmp_path = dat_path + ".tmp"
+	with open(tmp_path, 'w') as hiscore_file:
+		hiscore_file.writelines(output_lines)
+	os.replace(tmp_path, dat_path)
+
+
+if __name__ == '__main__':
+	logging.getLogger().setLevel(logging.INFO)
+	args = [ arg for arg in sys.argv[1:] if not arg.startswith("--") ]
+	if len(args) == 0:
+		print("usage: rom_crc32.py [--mame] [--write] ROM_DIR [ROM_DIR ...]")
+		sys.exit(1)
+	mame = "--mame" in sys.argv
+
+	missing, entries = find_missing_aliases(args, HISCORE_DAT_PATH, mame)
+	if "--write" in sys.argv:
+		if missing:
+			write_aliases(HISCORE_DAT_PATH, missing, entries)
+		logging.info(str(sum(len(aliases) for aliases in missing.values())) + " aliases added to " + HISCORE_DAT_PATH)
+	else:
+		for entry_index in sorted(missing):
+			for name, alias_line in missing[entry_index]:
+				print("; " + name)
+				print(alias_line)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+wait for new savestate files written by Retroarch.
+uses inotify on Linux (via ctypes, no extra deps), falls back to polling the file mtimes on other platforms.
+"""
+
+import os
+import re
+import sys
+import time
+import select
+import struct
+import logging
+
+# inotify consts from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+POLLING_SLEEP_TIME = 0.2
+
+
+def is_savestate_name(name, content_name):
+	""" True for the savestate slots of content_name: <content>.state (slot 0) and <content>.stateN, not the .png thumbnails or .state.auto """
+	return re.match(re.escape(content_name) + r"\.state[0-9]*$", name) is not None
+
+
+class SavestateWatcher(object):
+
+	"""Usage:
+	watcher = SavestateWatcher("~/.config/retroarch/states")
+	watcher.arm()  # before sending SAVE_STATE
+	retroarch.save_state()
+	path = watcher.wait("Super Mario Bros. (W) [!]", timeout=5)  # returns None on timeout
+	"""
+
+	def __init__(self, directory):
+		self.directory = os.path.expanduser(directory)
+		self._inotify_fd = None
+		self._mtimes = {}
+		if sys.platform.startswith("linux"):
+			try:
+				import ctypes
+				libc = ctypes.CDLL(None, use_errno=True)
+				fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+				if fd < 0:
+					raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+				if libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+					os.close(fd)
+					raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+				self._inotify_fd = fd
+			except (OSError, AttributeError):
+				logging.warning("inotify not available, will poll " + self.directory)
+		logging.debug("watching savestates in " + self.directory)
+
+
+	def close(self):
+		if self._inotify_fd is not None:
+			os.close(self._inotify_fd)
+			self._inotify_fd = None
+
+
+	def _scan_mtimes(self):
+		mtimes = {}
+		try:
+			for entry in os.scandir(self.directory):
+				if entry.is_file():
+					mtimes[entry.name] = entry.stat().st_mtime_ns
+		except OSError:
+			pass
+		return mtimes
+
+
+	def _read_events(self):
+		""" returns the names of the files written since the last call (inotify only) """
+		names = []
+		while True:
+			try:
+				buf = os.read(self._inotify_fd, 4096)
+			except BlockingIOError:
+				break
+			if not buf:
+				break
+			pos = 0
+			while pos + INOTIFY_EVENT_HEADER.size <= len(buf):
+				wd, mask, cookie, name_len = INOTIFY_EVENT_HEADER.unpack_from(buf, pos)
+				pos += INOTIFY_EVENT_HEADER.size
+				names.append(os.fsdecode(buf[pos:pos+name_len].rstrip(b"\x00")))
+				pos += name_len
+		return names
+
+
+	def arm(self):
+		""" forget the files written so far, call this before requesting a new savestate """
+		if self._inotify_fd is not None:
+			self._read_events()
+		else:
+			self._mtimes = self._scan_mtimes()
+
+
+	def wait(self, content_name, timeout=5):
+		""" wait for a savestate slot of content_name to be written, returns its full path or None on timeout """
+		deadline = time.monotonic() + timeout
+		while True:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				return None
+			if self._inotify_fd is not None:
+				readable, _, _ = select.select([ self._inotify_fd ], [], [], remaining)
+				if not readable:
+					return None
+				for name in self._read_events():
+					if is_savestate_name(name, content_name):
+						return os.path.join(self.directory, name)
+			else:
+				time.sleep(min(POLLING_SLEEP_TIME, remaining))
+				mtimes = self._scan_mtimes()
+				for name, mtime in mtimes.items():
+					if is_savestate_name(name, content_name) and self._mtimes.get(name) != mtime:
+						self._mtimes = mtimes
+						return os.path.join(self.directory, name)
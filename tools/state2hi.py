@@ -7,27 +7,55 @@ import sys
 import os
 import logging
 
+# opt-in phase timers and cProfile/tracemalloc reports, set HISCORE_PROFILE (see hiscore_profile.py)
+import hiscore_profile
+from hiscore_profile import timed
+
 DEBUG=os.getenv("STATE2HI_DEBUG")
 if DEBUG:
 	logging.getLogger().setLevel(logging.DEBUG)
 else:
 	logging.getLogger().setLevel(logging.INFO)
 	
+# more dat files can be listed, separated by os.pathsep (the last one takes precedence)
 HISCORE_DAT_PATH="/usr/share/games/mame/plugins/hiscore/console_hiscore.dat"
 if("HISCORE_DAT_PATH" in os.environ):
     HISCORE_DAT_PATH = os.environ['HISCORE_DAT_PATH']
 
-def get_raw_memory_from_statedata(statedata):
+# savestate bytes scanned to detect the emulator and the raw memory offset
+STATE_HEADER_SCAN_LEN = 0x20000
+
+
+def decompress_rzip(statedata, max_len=None):
 	"""
-	return a tuple: raw_memory (bytes buffer), candidate systems (list), emulator (str)
+	decompress a Retroarch RZIP savestate, chunk by chunk
+	when max_len is passed the decompression stops as soon as max_len bytes are available
+	"""
+	import zlib
+	# header: "#RZIPv" + version + "#", chunk size (uint32), total size (uint64), then a list of ( compressed chunk size (uint32), zlib data )
+	pos = 0x14
+	chunks = []
+	decompressed_len = 0
+	while pos + 4 <= len(statedata):
+		chunk_len = int.from_bytes(statedata[pos:pos+4], byteorder='little')
+		pos += 4
+		if chunk_len == 0:
+			break
+		chunk = zlib.decompress(statedata[pos:pos+chunk_len])
+		pos += chunk_len
+		chunks.append(chunk)
+		decompressed_len += len(chunk)
+		if max_len and decompressed_len >= max_len:
+			break
+	return b"".join(chunks)
+
+
+@timed("decompress")
+def unpack_statedata(statedata, max_len=None):
+	"""
+	strip the zip and RZIP compression from a savestate
+	when max_len is passed the result may be truncated after max_len bytes (partial decoding)
 	"""
-	
-	raw_memory = None
-	candidate_systems = []
-	emulator = None
-	
-	# switch on file header
-
 	# compressed savestate detection
 	if statedata.startswith(b'PK'):
 		# inmemory zip file extraction
@@ -39,22 +67,47 @@ def get_raw_memory_from_statedata(statedata):
 		if(len(input_zip_file.filelist)>1):
 			logging.warning("more than 1 file in the compressed archive, using the 1st only: ")
 		statefile = input_zip_file.open(input_zip_file.filelist[0])
-		statedata = statefile.read()
+		if max_len:
+			statedata = statefile.read(max_len)
+		else:
+			statedata = statefile.read()
 	# end if
 
 	# Retroarch RZIP savestates
 	if statedata[0:5] == b'#RZIP':
-		savegamedata_compressed = statedata[0x18:]  # skip 18 bytes header
-		import zlib
-		statedata = zlib.decompress(savegamedata_compressed)
+		statedata = decompress_rzip(statedata, max_len)
 	# end if
+	return statedata
+
+
+@timed("byteswap")
+def byteswap16(buf):
+	""" swap every pair of bytes (a trailing odd byte is left as it is) """
+	swapped = bytearray(buf)
+	even_len = len(swapped) - (len(swapped) % 2)
+	swapped[0:even_len:2] = buf[1:even_len:2]
+	swapped[1:even_len:2] = buf[0:even_len:2]
+	return swapped
+
+
+@timed("header_dispatch")
+def get_raw_memory_offset_from_statedata(statedata, partial=False):
+	"""
+	switch on the (uncompressed) savestate header
+	return a tuple: raw memory offset in statedata (int), candidate systems (list), emulator (str)
+	with partial=True statedata may be truncated: when the memory chunk is not found the offset is None, but the emulator is returned
+	"""
+	
+	raw_memory_offset = None
+	candidate_systems = []
+	emulator = None
 	
 	# Nestopia
 	# MEMO: savestates are swappable between retroarch and vanilla Nestopia (just rename *.state -> *.nst)
 	if statedata[0:3] == b'NST':
 		emulator = "nestopia"
 		candidate_systems = [ "nes", "famicom", "fds", "nespal" ]
-		raw_memory = statedata[0x38:]  # skip 56 bytes header
+		raw_memory_offset = 0x38  # skip 56 bytes header
 	# end of Nestopia
 
 	# FCEUmm  https://github.com/libretro/libretro-fceumm/blob/master/src/state.c
@@ -64,11 +117,12 @@ def get_raw_memory_from_statedata(statedata):
 		candidate_systems = [ "nes", "famicom", "fds", "nespal" ]
 		raw_memory_start_offset = statedata.find(b"RAM")
 		if raw_memory_start_offset == -1:
+			if partial:
+				return None, candidate_systems, emulator
 			logging.error("Invalid FCEU save state")
 			return None, None, None
 		# else
-		raw_memory_start_offset += 8
-		raw_memory = statedata[raw_memory_start_offset:]
+		raw_memory_offset = raw_memory_start_offset + 8
 	# end of FCEU
 
 	# TODO: FCEUx  https://github.com/TASVideos/fceux/blob/master/src/state.cpp
@@ -84,7 +138,7 @@ def get_raw_memory_from_statedata(statedata):
 		emulator = "gambatte"
 		candidate_systems = [ "gameboy", "gbcolor", "supergb" ]
 		# TODO: detect/exclude "gbcolor"?
-		raw_memory = statedata  # no header to skip?
+		raw_memory_offset = 0  # no header to skip?
 		# TODO: test with games different from tetris
 	# end of Gambatte
 
@@ -92,30 +146,30 @@ def get_raw_memory_from_statedata(statedata):
 	elif statedata.startswith(b'#!s9xsnp:0011'):
 		emulator = "snes9x"
 		candidate_systems = [ "snes", "snespal" ]
-		raw_memory = statedata[0x10B99:]  # system RAM starts after the "RAM:------:" string
+		raw_memory_offset = 0x10B99  # system RAM starts after the "RAM:------:" string
 
 	elif statedata.startswith(b'#!s9xsnp:0010'):
 		emulator = "snes9x2018"
 		candidate_systems = [ "snes", "snespal" ]
-		raw_memory = statedata[0x10B96:]  # system RAM starts after the "RAM:------:" string
+		raw_memory_offset = 0x10B96  # system RAM starts after the "RAM:------:" string
 
 	elif statedata.startswith(b'#!s9xsnp:0006'):
 		emulator = "snes9x2010"
 		candidate_systems = [ "snes", "snespal" ]
-		raw_memory = statedata[0x10B89:]  # system RAM starts after the "RAM:------:" string
+		raw_memory_offset = 0x10B89  # system RAM starts after the "RAM:------:" string
 
 	# Snes9x2002 / pocketsnes  https://github.com/libretro/snes9x2002/blob/master/src/snapshot.c
 	elif statedata.startswith(b'#!snes9x:0001'):
 		emulator = "snes9x2002"
 		candidate_systems = [ "snes", "snespal" ]
-		raw_memory = statedata[0x10C64:]  # system RAM starts after the "RAM:------:" string
+		raw_memory_offset = 0x10C64  # system RAM starts after the "RAM:------:" string
 	# end of Snes9x
 
 	# TODO: ZSNES https://github.com/ericpearson/zsnes/blob/cport/src/zstate.c
 	# elif statedata.startswith(b'#!snes9x:0001'):
 	# 	emulator = "zsnes"
 	# 	candidate_systems = [ "snes", "snespal" ]
-	# 	raw_memory = statedata[0x10C64:]
+	# 	raw_memory_offset = 0x10C64
 	# end of Snes9x
 
 	# bsnes  https://github.com/byuu/bsnes/blob/master/bsnes/sfc/system/serialization.cpp
@@ -126,10 +180,10 @@ def get_raw_memory_from_statedata(statedata):
 		candidate_systems = [ "snes", "snespal" ]
 		if statedata[0xC:0x17] == b'Performance':
 			# old ver.
-			raw_memory = statedata[0x21C:]
+			raw_memory_offset = 0x21C
 		elif statedata[0x8:0xA] == b'11':
 			# latest ver
-			raw_memory = statedata[0x284:]
+			raw_memory_offset = 0x284
 		# TODO: more versions
 		#print(statedata[0x8:0xA])
 	# end of bsnes
@@ -143,7 +197,7 @@ def get_raw_memory_from_statedata(statedata):
 		logging.warning("GENPLUS-GX support is still WIP")
 		emulator = "genplus"
 		candidate_systems = [ "genesis", "megadrij", "megadriv", "segacd", "sms", "smsj", "smspal", "gamegear", "gamegeaj" ]
-		raw_memory = statedata[16:]  # strip STATE_VERSION header
+		raw_memory_offset = 16  # strip STATE_VERSION header
 		
 		# TODO: detect sms+gamegear: check the io_regs binary string  https://www.smspower.org/Development/MemoryMap
 		# better detection?
@@ -156,7 +210,7 @@ def get_raw_memory_from_statedata(statedata):
 	elif statedata.startswith(b'Pico'):
 		emulator = "picodrive"
 		candidate_systems = [ "genesis", "megadrij", "megadriv", "segacd", "sms", "smsj", "smspal", "gamegear", "gamegeaj", "32x" ]
-		raw_memory = statedata[0x76:]
+		raw_memory_offset = 0x76
 		#TODO: detect sms+gamegear: check the address space?  https://www.smspower.org/Development/MemoryMap
 		
 	# Mednafen PC Engine
@@ -167,11 +221,12 @@ def get_raw_memory_from_statedata(statedata):
 		# ...
 		raw_memory_start_offset = statedata.find(b"BaseRAM")
 		if raw_memory_start_offset == -1:
+			if partial:
+				return None, candidate_systems, emulator
 			logging.error("Invalid mednafen pc engine save state")
 			return None, None, None
 		# else
-		raw_memory_start_offset += 0xE
-		raw_memory = statedata[raw_memory_start_offset:]
+		raw_memory_offset = raw_memory_start_offset + 0xE
 	# end of Mednafen PC Engine
 
 	# TODO: FBNeo
@@ -225,61 +280,117 @@ def get_raw_memory_from_statedata(statedata):
 		
 	# TODO: more cores
 	
+	if emulator == None or raw_memory_offset == None:
+		return None, None, None
+	else:
+		return raw_memory_offset, candidate_systems, emulator
+# end of get_raw_memory_offset_from_statedata
+
+
+def get_raw_memory_from_statedata(statedata):
+	"""
+	return a tuple: raw_memory (bytes buffer), candidate systems (list), emulator (str)
+	"""
+	statedata = unpack_statedata(statedata)
+	
+	raw_memory_offset, candidate_systems, emulator = get_raw_memory_offset_from_statedata(statedata)
+	if emulator == None:
+		return None, None, None
+	
+	raw_memory = statedata[raw_memory_offset:]
 	if "genesis" in candidate_systems:
 		# 16-bit swapping  https://stackoverflow.com/questions/36096292/efficient-way-to-swap-bytes-in-python
-		raw_memoryswapped = raw_memory
-		raw_memory = bytearray()
-		for i in range(0, len(raw_memoryswapped), 2):
-			raw_memory.append(raw_memoryswapped[i+1])
-			raw_memory.append(raw_memoryswapped[i])
+		raw_memory = byteswap16(raw_memory)
 
-	if emulator == None or raw_memory == None:
-		return None, None, None
-	else:
-		return raw_memory, candidate_systems, emulator
+	return raw_memory, candidate_systems, emulator
 # end of get_raw_memory_from_statedata
 
 
+@timed("dat_lookup")
 def get_hiscore_rows_from_game(candidate_systems, GAME_NAME):
-	hiscore_file = open(HISCORE_DAT_PATH)
-	rows = []
-	while(True):
-		line = hiscore_file.readline()
-		if not line:
-			# EOF
-			break 
-		elif line.strip() == "":
-			# line was empty
-			continue
-				 
-		line = line.strip()
-		if line.startswith(";"):
-			continue
-		if line.endswith(":"):
-			# check if game matches
-			line_gamename = line.split(':')[0]
-			for SYSTEM in candidate_systems:
-				if line_gamename == SYSTEM + "," + GAME_NAME:
-					# read the hiscore rows
-					while(True):
-						line = hiscore_file.readline()
-						if line.strip() == "":
-							# end of codes
-							break
-						if not line.startswith("@"):
-							# comments?
-							continue
-						# else
-						rows.append(line.strip())
-					# end while (hiscore rows)
-				# end if (game matches)
-			# end for candidate_systems
-		# end if line.endswith(":")
-	# end while hiscore_file lines
-	return rows
+	""" lookup the game in the merged index of the dat files listed in HISCORE_DAT_PATH (see hiscore_dat.py) """
+	from hiscore_dat import get_default_dat
+	hiscore_dat = get_default_dat()
+	entry = hiscore_dat.find_entry(candidate_systems, GAME_NAME)
+	if entry is None:
+		return []
+	logging.debug("hiscore rows read from " + entry.source + ":" + str(entry.line_number))
+	return list(entry.rows)
 # end of get_hiscore_rows_from_game
 
 
+def parse_hiscore_row(row):
+	"""
+	split a "@cputag,space,address,length,start,end[,prefill]" row from hiscore.dat
+	return a tuple: cputag (str), addresspace (str), address, length, start_byte, end_byte, prefill (int or None)
+	"""
+	splitted_row = row.split(",")
+	cputag = splitted_row[0].split(":")[-1]
+	addresspace = splitted_row[1]
+	address = int(splitted_row[2], base=16)
+	length = int(splitted_row[3], base=16)
+	start_byte = int(splitted_row[4], base=16)
+	end_byte = int(splitted_row[5], base=16)
+	prefill = None
+	if len(splitted_row) >= 7 and splitted_row[6].strip():
+		prefill = int(splitted_row[6], base=16)
+	return cputag, addresspace, address, length, start_byte, end_byte, prefill
+# end of parse_hiscore_row
+
+
+def translate_state_address(emulator, address):
+	""" map an address from hiscore.dat to an offset in the raw memory of the savestate """
+	# fix high genesis addresses
+	if emulator=="genplus":
+		if address > 0xff0000:
+			address -= 0xff0000
+	elif emulator=="gambatte":
+		address -= 0x7728
+	return address
+
+
+@timed("region_extraction")
+def get_hiscore_regions_from_statedata(statedata, hiscore_rows_to_process):
+	"""
+	partial decode path: decompress and byteswap only the parts of the savestate covered by the passed hiscore.dat rows
+	return a tuple: regions data (list of bytes, one for each row), candidate systems (list), emulator (str)
+	"""
+	header = unpack_statedata(statedata, STATE_HEADER_SCAN_LEN)
+	raw_memory_offset, candidate_systems, emulator = get_raw_memory_offset_from_statedata(header, partial=True)
+	if emulator != None and raw_memory_offset == None:
+		# the memory chunk is past the scanned header, decode the whole state
+		header = unpack_statedata(statedata)
+		raw_memory_offset, candidate_systems, emulator = get_raw_memory_offset_from_statedata(header)
+	if emulator == None:
+		return None, None, None
+	byteswap = "genesis" in candidate_systems
+	
+	regions = []
+	for row in hiscore_rows_to_process:
+		cputag, addresspace, address, length, start_byte, end_byte, prefill = parse_hiscore_row(row)
+		regions.append(( translate_state_address(emulator, address), length ))
+	
+	# decompress more only when the regions are past the scanned header
+	needed_len = raw_memory_offset + max([ address + length + 1 for address, length in regions ] + [ 0 ])
+	if len(header) >= needed_len:
+		statedata = header
+	else:
+		statedata = unpack_statedata(statedata, needed_len)
+	
+	regions_data = []
+	for address, length in regions:
+		if byteswap:
+			# swap the aligned words covering the region
+			aligned_start = address & ~1
+			aligned_end = (address + length + 1) & ~1
+			buf = byteswap16(statedata[raw_memory_offset + aligned_start:raw_memory_offset + aligned_end])
+			regions_data.append(bytes(buf[address - aligned_start:address - aligned_start + length]))
+		else:
+			regions_data.append(bytes(statedata[raw_memory_offset + address:raw_memory_offset + address + length]))
+	return regions_data, candidate_systems, emulator
+# end of get_hiscore_regions_from_statedata
+
+
 if __name__ == '__main__':
 	candidate_systems = []
 	EMU = ""
@@ -298,60 +409,72 @@ if __name__ == '__main__':
 	else:
 		GAME_NAME = os.path.splitext(os.path.basename(input_state_filepath))[0]  # extract the filename, strip the extension
 
-	statedata = open(input_state_filepath, 'rb').read()
+	# the whole conversion is profiled as a single section, the totals are reported also on errors
+	try:
+		with hiscore_profile.section("state2hi"):
+			statedata = open(input_state_filepath, 'rb').read()
 
-	raw_memory, candidate_systems, EMU = get_raw_memory_from_statedata(statedata)
+			raw_memory, candidate_systems, EMU = get_raw_memory_from_statedata(statedata)
 
-	if not EMU:
-		logging.error("emulator not supported")
-		sys.exit(1)
+			if not EMU:
+				logging.error("emulator not supported")
+				sys.exit(1)
 		
-	logging.info("detected system(s): " + str(candidate_systems))
-	logging.info("detected emulator: " + EMU)
-	logging.info("detected game: " + GAME_NAME)
-
-	if DEBUG:
-		#OUTFILE_PATH=GAME_NAME + ".mem"
-		OUTFILE_PATH=sys.argv[1] + ".mem"
-		outfile = open(OUTFILE_PATH, "wb")
-		outfile.write(raw_memory)
+			logging.info("detected system(s): " + str(candidate_systems))
+			logging.info("detected emulator: " + EMU)
+			logging.info("detected game: " + GAME_NAME)
+
+			if DEBUG:
+				#OUTFILE_PATH=GAME_NAME + ".mem"
+				OUTFILE_PATH=sys.argv[1] + ".mem"
+				outfile = open(OUTFILE_PATH, "wb")
+				outfile.write(raw_memory)
 	
-	hiscore_rows_to_process = get_hiscore_rows_from_game(candidate_systems, GAME_NAME)
-	if len(hiscore_rows_to_process)==0:
-		logging.error("nothing found in hiscore.dat for current game")
-		sys.exit(1)
-	# else
-
-	OUTPUT_PATH="./"
-	OUTFILE_PATH = OUTPUT_PATH + GAME_NAME +".hi"
-	#if SYSTEM == GAME_NAME:
-	#	# MAME hiscores
-	#	OUTFILE_PATH = OUTPUT_PATH + SYSTEM + ".hi"
-
-	outfile = open(OUTFILE_PATH, "wb")
-
-	logging.info(OUTFILE_PATH + " created")
-
-	for row in hiscore_rows_to_process:
-		splitted_row = row.split(",")
-		cputag = splitted_row[0].split(":")[1]
-		addresspace = splitted_row[1]
-		if not addresspace=="program":
-			logging.error("unsupported: " + addresspace)
-			sys.exit(1)
-		address = int(splitted_row[2], base=16)
-		length = int(splitted_row[3], base=16)
-		start_byte = int(splitted_row[4], base=16)
-		end_byte = int(splitted_row[5], base=16)
-
-		# fix high genesis addresses
-		if EMU=="genplus":
-			if address > 0xff0000:
-				address -= 0xff0000
-		elif EMU=="gambatte":
-			address -= 0x7728
-			
-		#print(address)
-		outfile.write(raw_memory[address:address+length])
-	# end for
-
+			hiscore_rows_to_process = get_hiscore_rows_from_game(candidate_systems, GAME_NAME)
+			if len(hiscore_rows_to_process)==0:
+				logging.error("nothing found in hiscore.dat for current game")
+				sys.exit(1)
+			# else
+
+			OUTPUT_PATH="./"
+			OUTFILE_PATH = OUTPUT_PATH + GAME_NAME +".hi"
+			#if SYSTEM == GAME_NAME:
+			#	# MAME hiscores
+			#	OUTFILE_PATH = OUTPUT_PATH + SYSTEM + ".hi"
+
+			from io import BytesIO
+			outfile = BytesIO()
+
+			with hiscore_profile.phase("region_extraction"):
+				for row in hiscore_rows_to_process:
+					cputag, addresspace, address, length, start_byte, end_byte, prefill = parse_hiscore_row(row)
+					if not addresspace=="program":
+						logging.error("unsupported: " + addresspace)
+						sys.exit(1)
+
+					address = translate_state_address(EMU, address)
+					#print(address)
+					outfile.write(raw_memory[address:address+length])
+				# end for
+
+			# optional single-file store used in place of the .hi files (see hi_store.py)
+			HISCORE_STORE_PATH = os.getenv("HISCORE_STORE_PATH")
+			if HISCORE_STORE_PATH:
+				from hi_store import HiStore
+				with hiscore_profile.phase("file_write"):
+					hiscore_store = HiStore(HISCORE_STORE_PATH)
+					if not candidate_systems:
+						logging.error("unknown system, can not be written in the store: " + GAME_NAME)
+						sys.exit(1)
+					# the system already used by the store, or the 1st candidate for a new entry
+					system = hiscore_store.find_system(candidate_systems, GAME_NAME) or candidate_systems[0]
+					hiscore_store.put(system, GAME_NAME, outfile.getvalue())
+					hiscore_store.close()
+				logging.info(system + "," + GAME_NAME + " written in " + HISCORE_STORE_PATH)
+			else:
+				with hiscore_profile.phase("file_write"):
+					with open(OUTFILE_PATH, "wb") as hiscore_file:
+						hiscore_file.write(outfile.getvalue())
+				logging.info(OUTFILE_PATH + " created")
+	finally:
+		hiscore_profile.report()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+synthetic savestate corpus and throughput benchmark for the state2hi.py parser.
+
+a savestate is generated for every supported header (optionally wrapped in RZIP and ZIP), with known bytes planted at the
+addresses of a hiscore.dat entry for the system. both the full decode (get_raw_memory_from_statedata) and the partial
+decode (get_hiscore_regions_from_statedata) are timed, and the extracted .hi data is checked against the planted bytes.
+
+usage:
+  state2hi_bench.py [--iterations N]   # run the benchmark, report MB/s and peak memory per format
+  state2hi_bench.py generate OUT_DIR   # write the corpus (*.state + the expected *.hi) to OUT_DIR
+
+env vars: HISCORE_DAT_PATH (entries used to plant the bytes), BENCH_STATE_SIZE (uncompressed savestate size, default 1MB)
+"""
+
+import sys
+import os
+import io
+import time
+import random
+import struct
+import zlib
+import zipfile
+import logging
+import tracemalloc
+
+import state2hi
+from state2hi import byteswap16, parse_hiscore_row, translate_state_address
+
+BENCH_STATE_SIZE = int(os.getenv("BENCH_STATE_SIZE", 1024 * 1024))
+BENCH_ITERATIONS = 20
+RAW_MEMORY_SIZE = 0x20000  # covers the addresses used by every supported system
+RZIP_CHUNK_SIZE = 128 * 1024  # same as Retroarch
+RANDOM_SEED = 0x41
+
+# used when the dat has no entry for a system
+FALLBACK_ROW = "@:maincpu,program,100,10,00,00"
+
+GAMBATTE_SIGNATURE = b'\x00\x01\x00\x00\x00\x61\x00\x00\x00\x01\x00\x62\x00\x00\x00\x01'
+
+# format name -> ( emulator, system looked up in the dat, function returning the header bytes preceding the raw memory )
+STATE_FORMATS = [
+	( "nestopia", "nestopia", "nes", lambda: b"NST" + b"\x00" * (0x38 - 3) ),
+	( "fceumm", "fceu", "nes", lambda: b"FCSX" + b"\x00" * 12 + b"RAM" + b"\x00" * 5 ),
+	( "gambatte", "gambatte", "gameboy", lambda: b"" ),
+	( "snes9x_0006", "snes9x2010", "snes", lambda: b"#!s9xsnp:0006".ljust(0x10B89, b"\x00") ),
+	( "snes9x_0010", "snes9x2018", "snes", lambda: b"#!s9xsnp:0010".ljust(0x10B96, b"\x00") ),
+	( "snes9x_0011", "snes9x", "snes", lambda: b"#!s9xsnp:0011".ljust(0x10B99, b"\x00") ),
+	( "snes9x2002", "snes9x2002", "snes", lambda: b"#!snes9x:0001".ljust(0x10C64, b"\x00") ),
+	( "bsnes_old", "bsnes", "snes", lambda: (b"BST1" + b"\x00" * 8 + b"Performance").ljust(0x21C, b"\x00") ),
+	( "bsnes", "bsnes", "snes", lambda: (b"BST1" + b"\x00" * 4 + b"11").ljust(0x284, b"\x00") ),
+	( "genplus", "genplus", "genesis", lambda: b"GENPLUS-GX".ljust(16, b"\x00") ),
+	( "picodrive", "picodrive", "genesis", lambda: b"Pico".ljust(0x76, b"\x00") ),
+	( "mednafen", "mednafen", "pce", lambda: b"MDFNSVST".ljust(0x40, b"\x00") + b"BaseRAM".ljust(0xE, b"\x00") ),
+]
+
+WRAPPERS = [ "raw", "rzip", "zip" ]
+
+
+def get_dat_rows(system):
+	""" returns the rows of the 1st entry in the dat for the passed system """
+	from hiscore_dat import get_default_dat
+	entries = [ entry for entry in get_default_dat().entries() if any(alias.split(",")[0] == system for alias in entry.aliases) ]
+	if not entries:
+		return [ FALLBACK_ROW ]
+	entries.sort(key=lambda entry: ( entry.source, entry.line_number ))
+	return list(entries[0].rows)
+
+
+def rzip_compress(statedata):
+	""" Retroarch RZIP format: 20 bytes header, then ( compressed chunk size (uint32), zlib data ) """
+	out = io.BytesIO()
+	out.write(b"#RZIPv\x01#" + struct.pack("<IQ", RZIP_CHUNK_SIZE, len(statedata)))
+	for pos in range(0, len(statedata), RZIP_CHUNK_SIZE):
+		chunk = zlib.compress(statedata[pos:pos+RZIP_CHUNK_SIZE])
+		out.write(struct.pack("<I", len(chunk)) + chunk)
+	return out.getvalue()
+
+
+def zip_compress(statedata):
+	out = io.BytesIO()
+	with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+		zip_file.writestr("game.state", statedata)
+	return out.getvalue()
+
+
+def make_savestate(emulator, header, rows, rng, wrapper="raw"):
+	"""
+	returns a tuple: savestate (bytes), expected .hi data (bytes)
+	the raw memory is filled with half random, half zero bytes so the compressed variants are realistic
+	"""
+	raw_memory = bytearray(rng.randbytes(RAW_MEMORY_SIZE // 2)) + bytearray(RAW_MEMORY_SIZE // 2)
+	expected = io.BytesIO()
+	for row in rows:
+		cputag, addresspace, address, length, start_byte, end_byte, prefill = parse_hiscore_row(row)
+		address = translate_state_address(emulator, address)
+		planted = rng.randbytes(length)
+		raw_memory[address:address+length] = planted
+		expected.write(planted)
+
+	if emulator in [ "genplus", "picodrive" ]:
+		# genesis memory is stored as 16-bit words
+		raw_memory = byteswap16(raw_memory)
+	if emulator == "gambatte":
+		# the signature is part of the raw memory
+		raw_memory[0:len(GAMBATTE_SIGNATURE)] = GAMBATTE_SIGNATURE
+
+	statedata = bytes(header) + bytes(raw_memory)
+	if len(statedata) < BENCH_STATE_SIZE:
+		statedata += bytes(BENCH_STATE_SIZE - len(statedata))
+
+	if wrapper == "rzip":
+		statedata = rzip_compress(statedata)
+	elif wrapper == "zip":
+		statedata = zip_compress(statedata)
+	return statedata, expected.getvalue()
+
+
+def extract_full(statedata, emulator, rows):
+	""" the state2hi.py main path: decode the whole savestate, then slice the rows """
+	raw_memory, candidate_systems, detected_emulator = state2hi.get_raw_memory_from_statedata(statedata)
+	if detected_emulator != emulator:
+		return None
+	hi_data = io.BytesIO()
+	for row in rows:
+		cputag, addresspace, address, length, start_byte, end_byte, prefill = parse_hiscore_row(row)
+		address = translate_state_address(emulator, address)
+		hi_data.write(raw_memory[address:address+length])
+	return hi_data.getvalue()
+
+
+def extract_partial(statedata, emulator, rows):
+	regions_data, candidate_systems, detected_emulator = state2hi.get_hiscore_regions_from_statedata(statedata, rows)
+	if detected_emulator != emulator:
+		return None
+	return b"".join(regions_data)
+
+
+def generate_corpus():
+	""" yields ( name, emulator, rows, savestate, expected .hi data ) for every format and wrapper """
+	rng = random.Random(RANDOM_SEED)
+	for name, emulator, system, make_header in STATE_FORMATS:
+		rows = get_dat_rows(system)
+		for wrapper in WRAPPERS:
+			statedata, expected = make_savestate(emulator, make_header(), rows, rng, wrapper)
+			yield name + "_" + wrapper, emulator, rows, statedata, expected
+
+
+def measure(function, statedata, emulator, rows, iterations):
+	""" returns a tuple: MB/s (of uncompressed savestate), peak memory (bytes), the extracted data """
+	started = time.perf_counter()
+	for i in range(iterations):
+		result = function(statedata, emulator, rows)
+	elapsed = time.perf_counter() - started
+	# tracemalloc slows down the parsing, so peak memory is measured in a separate run
+	tracemalloc.start()
+	function(statedata, emulator, rows)
+	peak_memory = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	mb_per_sec = BENCH_STATE_SIZE * iterations / elapsed / (1024 * 1024) if elapsed > 0 else float("inf")
+	return mb_per_sec, peak_memory, result
+
+
+def run_benchmark(iterations=BENCH_ITERATIONS):
+	""" returns the number of formats whose extracted .hi did not match """
+	failed = 0
+	print("%-22s %10s %12s %10s %12s %10s  %s" % ("format", "file size", "full MB/s", "full peak", "partial MB/s", "part. peak", "check"))
+	for name, emulator, rows, statedata, expected in generate_corpus():
+		full_speed, full_peak, full_data = measure(extract_full, statedata, emulator, rows, iterations)
+		partial_speed, partial_peak, partial_data = measure(extract_partial, statedata, emulator, rows, iterations)
+		ok = full_data == expected and partial_data == expected
+		if not ok:
+			failed += 1
+		print("%-22s %10d %12.1f %9dK %12.1f %9dK  %s" % (name, len(statedata), full_speed, full_peak // 1024, partial_speed, partial_peak // 1024, "ok" if ok else "MISMATCH"))
+	return failed
+
+
+def write_corpus(out_dir):
+	if not os.path.isdir(out_dir):
+		os.makedirs(out_dir)
+	for name, emulator, rows, statedata, expected in generate_corpus():
+		with open(os.path.join(out_dir, name + ".state"), 'wb') as state_file:
+			state_file.write(statedata)
+		with open(os.path.join(out_dir, name + ".hi"), 'wb') as hi_file:
+			hi_file.write(expected)
+		logging.info("written " + name + " (" + emulator + ", " + str(len(rows)) + " rows)")
+
+
+if __name__ == '__main__':
+	# the parser warns on every WIP format
+	logging.getLogger().setLevel(logging.INFO if len(sys.argv) >= 2 and sys.argv[1] == "generate" else logging.ERROR)
+	if len(sys.argv) >= 2 and sys.argv[1] == "generate":
+		if len(sys.argv) < 3:
+			print("usage: state2hi_bench.py generate OUT_DIR")
+			sys.exit(1)
+		write_corpus(sys.argv[2])
+	else:
+		iterations = BENCH_ITERATIONS
+		if "--iterations" in sys.argv:
+			iterations = int(sys.argv[sys.argv.index("--iterations") + 1])
+		sys.exit(1 if run_benchmark(iterations) else 0)